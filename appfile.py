@@ -0,0 +1,290 @@
+import os
+import json
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from steps import parse_steps
+from storage import CatalogFile, write_atomic
+
+# Bytes of app.txt parsed at a time; chunks end where a record starts
+CHUNK_SIZE = 1024 * 1024
+# Inputs at least this large are parsed on several processes
+PARALLEL_MIN = 8 * CHUNK_SIZE
+
+# app.txt is the legacy line format of the catalog:
+#
+#   App <name> <version>
+#   Commands: <command>, <command>, ...
+#   Description: <text>
+#
+# The version is the rest of the App line and may contain spaces. Commands
+# may span several Commands lines. Where the plain form cannot hold a
+# value, it is written as JSON instead: a name with spaces or a multi-line
+# description as a JSON string, and commands containing ", " or step
+# objects as a JSON list, e.g. Commands: ["echo a, b", {"run": "make"}].
+
+
+class FormatError(ValueError):
+    """Malformed records; errors lists them as "<file>:<line>: <message>"."""
+
+    def __init__(self, errors):
+        self.errors = errors
+        more = f" (and {len(errors) - 1} more)" if len(errors) > 1 else ""
+        super().__init__(errors[0] + more)
+
+
+def decode_text(value):
+    """A field value, unquoting it if it is a JSON string."""
+    if value.startswith('"'):
+        try:
+            text = json.loads(value)
+        except json.JSONDecodeError:
+            return value
+        if isinstance(text, str):
+            return text
+    return value
+
+
+def encode_text(text, words=False):
+    """A field value for text, JSON-quoted where the plain form would not read back.
+
+    With words, text must also be free of whitespace.
+    """
+    if (not text or text != text.strip() or text.startswith('"') or "\n" in text or "\r" in text
+            or (words and len(text.split()) > 1)):
+        return json.dumps(text)
+    return text
+
+
+def parse_app_line(rest):
+    """Return (name, version) from what follows "App "."""
+    if rest.startswith('"'):
+        name, end = json.JSONDecoder().raw_decode(rest)
+        if not isinstance(name, str):
+            raise ValueError("the name must be a string")
+        version = rest[end:].strip()
+    else:
+        name, _, version = rest.partition(" ")
+        version = version.strip()
+    if not name or not version:
+        raise ValueError("expected 'App <name> <version>'")
+    return name, decode_text(version)
+
+
+def parse_commands(value):
+    if not value.startswith("["):
+        return [command for command in value.split(", ") if command]
+    commands = json.loads(value)
+    if not isinstance(commands, list) or not all(
+        isinstance(command, str) or (isinstance(command, dict) and isinstance(command.get("run"), str))
+        for command in commands
+    ):
+        raise ValueError("a JSON Commands line must be a list of commands or step objects")
+    return commands
+
+
+def parse_chunk(data, first_line=1, source="app.txt"):
+    """Parse the app.txt records in data, whose first line is number first_line.
+
+    Returns (entries, errors): entries is a list of (line number of the App
+    line, app dict) and errors a list of messages. A malformed record is
+    left out and the rest still parsed.
+    """
+    entries = []
+    errors = []
+    record = None
+    bad = False
+
+    def finish():
+        if record is None:
+            return
+        number, app = record
+        if not app["commands"]:
+            errors.append(f"{source}:{number}: {app['name']} {app['version']} has no commands")
+            return
+        try:
+            parse_steps(app["commands"])
+        except ValueError as e:
+            errors.append(f"{source}:{number}: {e}")
+            return
+        entries.append(record)
+
+    try:
+        text = data.decode("utf-8")
+    except UnicodeDecodeError as e:
+        number = first_line + data.count(b"\n", 0, e.start)
+        errors.append(f"{source}:{number}: not valid UTF-8")
+        text = data.decode("utf-8", errors="replace")
+
+    # Only "\n" ends a line, as in iter_chunks: splitlines() would also break
+    # on characters such as "\x0c" or "\u2028" that a description may hold
+    for number, line in enumerate(text.split("\n"), first_line):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            if line == "App" or line.startswith("App "):
+                finish()
+                record, bad = None, False
+                name, version = parse_app_line(line[4:].strip())
+                record = (number, {"name": name, "version": version, "commands": [], "description": ""})
+            elif line.startswith("Commands:") or line.startswith("Description:"):
+                if record is None:
+                    if not bad:
+                        errors.append(f"{source}:{number}: {line.partition(':')[0]} line outside an App record")
+                    continue
+                field, _, value = line.partition(":")
+                value = value.strip()
+                if field == "Commands":
+                    record[1]["commands"].extend(parse_commands(value))
+                else:
+                    record[1]["description"] = decode_text(value)
+            else:
+                errors.append(f"{source}:{number}: unexpected line {line[:40]!r}")
+        except (ValueError, TypeError) as e:
+            errors.append(f"{source}:{number}: {e}")
+            # Skip the rest of a broken record rather than reporting each of its lines
+            record, bad = None, True
+    finish()
+    return entries, errors
+
+
+def _parse_chunk(job):
+    return parse_chunk(*job)
+
+
+def iter_chunks(file, chunk_size=CHUNK_SIZE, source="app.txt"):
+    """Yield (data, first line number, source) for chunks of a binary file, split where records start."""
+    line = 1
+    rest = b""
+    while True:
+        block = file.read(chunk_size)
+        buffer = rest + block
+        if not block:
+            if buffer:
+                yield buffer, line, source
+            return
+        cut = buffer.rfind(b"\nApp ", 1)
+        if cut < 0:
+            rest = buffer
+            continue
+        chunk, rest = buffer[:cut + 1], buffer[cut + 1:]
+        yield chunk, line, source
+        line += chunk.count(b"\n")
+
+
+def iter_app_txt(path, errors, workers=None):
+    """Yield the app dicts of an app.txt file in file order.
+
+    Malformed records are skipped and reported in errors, as are records
+    repeating an earlier name and version. Files of PARALLEL_MIN bytes or
+    more are parsed by workers processes (default: one per CPU), with a
+    bounded number of chunks in flight.
+    """
+    seen = {}
+
+    def accept(result):
+        entries, chunk_errors = result
+        errors.extend(chunk_errors)
+        for number, app in entries:
+            key = (app["name"], app["version"])
+            if key in seen:
+                errors.append(f"{path}:{number}: {app['name']} {app['version']} repeats line {seen[key]}")
+                continue
+            seen[key] = number
+            yield app
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    with open(path, "rb") as file:
+        chunks = iter_chunks(file, CHUNK_SIZE, path)
+        if workers <= 1 or os.fstat(file.fileno()).st_size < PARALLEL_MIN:
+            for chunk in chunks:
+                yield from accept(parse_chunk(*chunk))
+            return
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.submit(_parse_chunk, chunk))
+                if len(pending) >= 2 * workers:
+                    yield from accept(pending.popleft().result())
+            while pending:
+                yield from accept(pending.popleft().result())
+
+
+def import_app_txt(source, pkg_file, workers=None):
+    """Replace the catalog in pkg_file with the records of the app.txt file source.
+
+    Entries are written as they are parsed, into a temp file that replaces
+    pkg_file only once the whole input parsed cleanly. Raises FormatError,
+    leaving pkg_file alone, if any record is malformed. Returns the number
+    of apps written.
+    """
+    errors = []
+    count = [0]
+
+    def entries():
+        for app in iter_app_txt(source, errors, workers):
+            count[0] += 1
+            yield app
+        if errors:
+            raise FormatError(errors)
+
+    CatalogFile(pkg_file).write(entries())
+    return count[0]
+
+
+def format_record(app):
+    """The app.txt lines of an app dict."""
+    commands = app["commands"]
+    plain = all(
+        isinstance(command, str) and command and command == command.strip() and ", " not in command
+        and "\n" not in command for command in commands
+    ) and not commands[0].startswith("[")
+    return (
+        f"App {encode_text(app['name'], words=True)} {encode_text(app['version'])}\n"
+        f"Commands: {', '.join(commands) if plain else json.dumps(commands)}\n"
+        f"Description: {encode_text(app.get('description', '')) if app.get('description') else ''}\n"
+    )
+
+
+def validate_app(app):
+    """Raise ValueError if app is not a well-formed catalog entry."""
+    if not isinstance(app, dict):
+        raise ValueError("not an object")
+    for field in ("name", "version"):
+        if not isinstance(app.get(field), str) or not app[field]:
+            raise ValueError(f"missing or empty {field}")
+    if not isinstance(app.get("commands"), list) or not app["commands"]:
+        raise ValueError("missing or empty commands")
+    if not isinstance(app.get("description", ""), str):
+        raise ValueError("description is not a string")
+    parse_commands(json.dumps(app["commands"]))
+    parse_steps(app["commands"])
+
+
+def export_app_txt(pkg_file, dest):
+    """Write the catalog in pkg_file, with its journal applied, to dest in app.txt format.
+
+    Records are written as they are read, into a temp file that replaces
+    dest only if every entry was valid; otherwise FormatError is raised.
+    Returns the number of apps written.
+    """
+    errors = []
+    count = [0]
+    catalog = CatalogFile(pkg_file)
+
+    def records():
+        for number, app in enumerate(catalog.iter_entries(), 1):
+            try:
+                validate_app(app)
+            except (ValueError, TypeError, KeyError) as e:
+                errors.append(f"{pkg_file}: entry {number}: {e}")
+                continue
+            count[0] += 1
+            yield format_record(app)
+        if errors:
+            raise FormatError(errors)
+
+    write_atomic(dest, records())
+    return count[0]
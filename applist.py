@@ -0,0 +1,185 @@
+from PyQt5.QtCore import (
+    Qt, QAbstractListModel, QModelIndex, QObject, QThread, QTimer,
+    QCoreApplication, QItemSelection, QItemSelectionModel, pyqtSignal, pyqtSlot
+)
+
+# Delay after the last keystroke before the catalog is filtered
+DEBOUNCE_MS = 150
+# Most results shown for a search; an empty search lists the whole catalog
+RESULT_LIMIT = 1000
+# Catalog records handed to the UI thread at a time while loading
+LOAD_BATCH = 2000
+
+
+class AppListModel(QAbstractListModel):
+    """List model over a subset of catalog ids; labels are built on demand."""
+
+    def __init__(self, label, parent=None):
+        super().__init__(parent)
+        self.label = label
+        self.rows = []
+        self.positions = {}
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and index.isValid():
+            return self.label(self.rows[index.row()])
+        return None
+
+    def set_rows(self, rows):
+        self.beginResetModel()
+        self.rows = rows
+        self.positions = {app_id: row for row, app_id in enumerate(rows)}
+        self.endResetModel()
+
+    def app_id(self, index):
+        """Return the catalog id shown at index, or None."""
+        if not index.isValid() or index.row() >= len(self.rows):
+            return None
+        return self.rows[index.row()]
+
+    def index_of(self, app_id):
+        row = self.positions.get(app_id)
+        return QModelIndex() if row is None else self.index(row)
+
+
+class CatalogLoader(QThread):
+    """Reads catalog records on a worker thread and hands them over in batches.
+
+    read(on_error) returns an iterable of records; errors are forwarded
+    through the error signal so dialogs open on the UI thread.
+    """
+
+    batch = pyqtSignal(list)
+    error = pyqtSignal(str)
+
+    def __init__(self, read, batch_size=LOAD_BATCH, parent=None):
+        super().__init__(parent)
+        self.read = read
+        self.batch_size = batch_size
+        app = QCoreApplication.instance()
+        if app is not None:
+            app.aboutToQuit.connect(self.stop)
+
+    def run(self):
+        records = []
+        for record in self.read(self.error.emit):
+            if self.isInterruptionRequested():
+                return
+            records.append(record)
+            if len(records) >= self.batch_size:
+                self.batch.emit(records)
+                records = []
+        if records:
+            self.batch.emit(records)
+
+    def stop(self):
+        self.requestInterruption()
+        self.wait()
+
+
+class SearchWorker(QObject):
+    results = pyqtSignal(int, list)
+
+    def __init__(self, index, limit=RESULT_LIMIT):
+        super().__init__()
+        self.index = index
+        self.limit = limit
+
+    @pyqtSlot(int, str)
+    def search(self, generation, term):
+        if term.strip():
+            rows = self.index.rank(term, self.limit)
+        else:
+            rows = self.index.search("")
+        self.results.emit(generation, rows)
+
+
+class AppFilter(QObject):
+    """Debounced filtering of a list view, with the search run off the UI thread.
+
+    Matches are listed best first. Results that arrive after a newer query
+    was issued are dropped, and the selected items stay selected when they
+    are still part of the results.
+    """
+
+    requested = pyqtSignal(int, str)
+    filtered = pyqtSignal()
+
+    def __init__(self, index, model, view, delay=DEBOUNCE_MS, parent=None):
+        super().__init__(parent)
+        self.model = model
+        self.view = view
+        self.term = ""
+        self.generation = 0
+
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(delay)
+        self.timer.timeout.connect(self.run)
+
+        self.thread = QThread(self)
+        self.worker = SearchWorker(index)
+        self.worker.moveToThread(self.thread)
+        self.requested.connect(self.worker.search)
+        self.worker.results.connect(self.apply)
+        self.thread.start()
+        app = QCoreApplication.instance()
+        if app is not None:
+            app.aboutToQuit.connect(self.stop)
+
+    def schedule(self, term):
+        """Filter for term once typing has paused."""
+        self.term = term
+        self.timer.start()
+
+    def refresh(self):
+        """Filter again right away, e.g. after the catalog changed."""
+        self.timer.stop()
+        self.run()
+
+    def run(self):
+        self.generation += 1
+        self.requested.emit(self.generation, self.term)
+
+    def set_index(self, index):
+        """Search index from now on, e.g. after the catalog was reloaded.
+
+        Results of searches already under way are dropped; call refresh()
+        once the model's rows are ids of the new index.
+        """
+        self.generation += 1
+        self.worker.index = index
+
+    def apply(self, generation, rows):
+        if generation != self.generation:
+            return
+        self.set_rows(rows)
+        self.filtered.emit()
+
+    def set_rows(self, rows, selected=None, current=None):
+        """Show rows, then select the ids in selected and make current the current item.
+
+        Both default to what is selected and current now.
+        """
+        selection_model = self.view.selectionModel()
+        if selected is None:
+            selected = [self.model.app_id(index) for index in selection_model.selectedIndexes()]
+        if current is None:
+            current = self.model.app_id(self.view.currentIndex())
+        self.model.set_rows(rows)
+        selection = QItemSelection()
+        for app_id in selected:
+            index = self.model.index_of(app_id)
+            if index.isValid():
+                selection.select(index, index)
+        selection_model.select(selection, QItemSelectionModel.ClearAndSelect)
+        index = self.model.index_of(current)
+        if index.isValid():
+            selection_model.setCurrentIndex(index, QItemSelectionModel.NoUpdate)
+
+    def stop(self):
+        self.thread.quit()
+        self.thread.wait()
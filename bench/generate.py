@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""Generate a synthetic catalog for benchmarks.
+
+Entries look like the real pkg.cpm: apt preludes, downloads, build steps,
+several versions of some names and prose descriptions. The same count and
+seed always give the same catalog.
+"""
+import argparse
+import json
+import random
+
+WORDS = (
+    "audio video network editor player browser terminal manager font theme "
+    "driver server client library toolkit compiler debugger archive image "
+    "office game emulator scanner printer backup monitor shell python rust "
+    "gnome kde desktop codec stream sync secure fast light classic"
+).split()
+
+
+def generate_apps(count, seed=0):
+    """Return count app dicts."""
+    rng = random.Random(seed)
+    apps = []
+    for i in range(count):
+        name = f"{rng.choice(WORDS)}-{rng.choice(WORDS)}{i // 3}"
+        version = f"{rng.randint(0, 9)}.{rng.randint(0, 20)}.{i % 3}"
+        package = name.replace("-", "")
+        commands = [
+            "sudo apt-get update",
+            f"sudo apt-get install -y lib{rng.choice(WORDS)}-dev",
+            f"wget https://example.invalid/{package}-{version}.tar.gz",
+            f"tar xf {package}-{version}.tar.gz",
+            f"cd {package}-{version}",
+            "make -j4",
+        ]
+        description = " ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 14))).capitalize() + "."
+        apps.append({"name": name, "version": version, "commands": commands, "description": description})
+    return apps
+
+
+def write_pkg(apps, path):
+    with open(path, "w") as file:
+        json.dump(apps, file, indent=4)
+
+
+def write_app_txt(apps, path):
+    """Write apps in the legacy app.txt format read by convert_app_txt_to_pkg_cpm."""
+    with open(path, "w") as file:
+        for app in apps:
+            file.write(f"App {app['name']} {app['version']}\n")
+            file.write(f"Commands: {', '.join(app['commands'])}\n")
+            file.write(f"Description: {app['description']}\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic catalog")
+    parser.add_argument("count", type=int, help="Number of entries")
+    parser.add_argument("-o", "--output", default="pkg.cpm", help="File to write")
+    parser.add_argument("--app-txt", action="store_true", help="Write the legacy app.txt format")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    apps = generate_apps(args.count, args.seed)
+    (write_app_txt if args.app_txt else write_pkg)(apps, args.output)
+
+
+if __name__ == "__main__":
+    main()
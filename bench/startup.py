@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""Compare cold `main.py --cli --list` startup against the old Qt-importing path.
+
+The legacy run reproduces what every CLI call used to pay for: importing the
+PyQt5 widget stack and configuring DEBUG logging before handling the command.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+LEGACY = """
+import logging, sys
+import PyQt5.QtWidgets, PyQt5.QtCore
+logging.basicConfig(level=logging.DEBUG)
+sys.argv = ["main.py", "--list"]
+from cpm import cli_main
+cli_main()
+"""
+
+
+def time_command(cmd, runs):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(cmd, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def report(label, samples):
+    print(f"{label:<8} median {statistics.median(samples) * 1000:8.1f} ms   "
+          f"min {min(samples) * 1000:8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CLI startup benchmark")
+    parser.add_argument("--runs", type=int, default=20, help="Invocations per variant")
+    args = parser.parse_args()
+
+    current = time_command([sys.executable, "main.py", "--cli", "--list"], args.runs)
+    report("current", current)
+    try:
+        legacy = time_command([sys.executable, "-c", LEGACY], args.runs)
+    except subprocess.CalledProcessError:
+        print("legacy   skipped (PyQt5 is not installed)")
+        return
+    report("legacy", legacy)
+    print(f"speedup  {statistics.median(legacy) / statistics.median(current):.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""Benchmark catalog loading, app.txt import/export, search, filtering and step execution.
+
+Each benchmark runs against synthetic catalogs (see generate.py) of every
+requested size and records the median and minimum of several runs. Results
+are written as JSON; --compare checks them against an earlier file and
+exits non-zero when something got slower than the threshold allows.
+
+    python bench/suite.py --sizes 1000 10000 -o new.json
+    python bench/suite.py --sizes 1000 10000 --compare old.json
+
+The Qt benchmarks run headless and are skipped when PyQt5 is missing.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from generate import generate_apps, write_app_txt, write_pkg
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+SEARCH_TERMS = ("video", "netwrk", "py")
+# No-op steps per CommandRunner run
+RUNNER_STEPS = 50
+
+
+def measure(run, runs, setup=None):
+    """Time run() runs times, calling setup() untimed before each run."""
+    samples = []
+    for _ in range(runs):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        run()
+        samples.append(time.perf_counter() - start)
+    return {"median": statistics.median(samples), "min": min(samples), "runs": runs}
+
+
+def bench_load(apps, runs):
+    import cpm
+    from compiled import compile_catalog
+
+    write_pkg(apps, cpm.PKG_FILE)
+    results = {"load_apps/json": measure(cpm.load_apps, runs)}
+    compile_catalog(cpm.PKG_FILE)
+    results["load_apps/compiled"] = measure(lambda: cpm.load_apps().close(), runs)
+    os.remove(cpm.compiled_path(cpm.PKG_FILE))
+
+    results["convert_app_txt_to_pkg_cpm"] = measure(
+        cpm.convert_app_txt_to_pkg_cpm, runs, setup=lambda: write_app_txt(apps, cpm.APP_FILE)
+    )
+    write_pkg(apps, cpm.PKG_FILE)
+    return results
+
+
+def bench_appfile(apps, runs):
+    """Throughput of app.txt import, on one process and on every CPU, and of export."""
+    import appfile
+
+    write_app_txt(apps, "bulk.txt")
+    size = os.path.getsize("bulk.txt")
+    results = {}
+    parallel_min = appfile.PARALLEL_MIN
+    # Take the parallel path at every size, so its overhead on small catalogs shows too
+    appfile.PARALLEL_MIN = 0
+    try:
+        for name, workers in (("serial", 1), ("parallel", None)):
+            results[f"import_app_txt/{name}"] = measure(
+                lambda: appfile.import_app_txt("bulk.txt", "bulk.cpm", workers), runs
+            )
+    finally:
+        appfile.PARALLEL_MIN = parallel_min
+    results["export_app_txt"] = measure(lambda: appfile.export_app_txt("bulk.cpm", "bulk.txt"), runs)
+    for result in results.values():
+        result["mb_per_s"] = size / result["median"] / 1e6
+    return results
+
+
+def bench_cli_search(runs):
+    """Time whole `cpm.py --search` processes, against JSON and compiled catalogs."""
+    import cpm
+    from compiled import compile_catalog
+
+    def search(term):
+        subprocess.run(
+            [sys.executable, os.path.join(ROOT, "cpm.py"), "--search", term],
+            stdout=subprocess.DEVNULL, check=True,
+        )
+
+    results = {}
+    for term in SEARCH_TERMS:
+        results[f"cli_search/json/{term}"] = measure(lambda: search(term), runs)
+    compile_catalog(cpm.PKG_FILE)
+    for term in SEARCH_TERMS:
+        results[f"cli_search/compiled/{term}"] = measure(lambda: search(term), runs)
+    os.remove(cpm.compiled_path(cpm.PKG_FILE))
+    return results
+
+
+def bench_filters(apps, runs):
+    """Time each tool's filter_apps from a query to the list being updated."""
+    from PyQt5.QtCore import QEventLoop
+    from PyQt5.QtWidgets import QListView
+    from applist import AppListModel, AppFilter
+    from catalog import App, CatalogStore
+    from mod import AppGenerator
+    logging.getLogger().setLevel(logging.WARNING)
+
+    records = [App.from_dict(entry) for entry in apps]
+    stores = {
+        "main": CatalogStore(records),
+        "mod": CatalogStore(records, search_fields=AppGenerator.search_fields),
+    }
+    results = {}
+    for tool, store in stores.items():
+        model = AppListModel(lambda app_id: store[app_id].label)
+        view = QListView()
+        view.setModel(model)
+        app_filter = AppFilter(store.index, model, view, delay=0)
+        loop = QEventLoop()
+        app_filter.filtered.connect(loop.quit)
+
+        def run(term):
+            app_filter.schedule(term)
+            loop.exec_()
+
+        for term in SEARCH_TERMS + ("",):
+            results[f"filter_apps/{tool}/{term or 'all'}"] = measure(lambda: run(term), runs)
+        app_filter.stop()
+    return results
+
+
+def bench_runner(runs):
+    """Per-step overhead of CommandRunner on no-op steps."""
+    from catalog import App
+    from jobs import JobQueue
+    from main import CommandRunner
+    logging.getLogger().setLevel(logging.WARNING)
+
+    app = App("noop", "1", [":"] * RUNNER_STEPS)
+    queue = JobQueue()
+
+    def run():
+        runner = CommandRunner(queue, [app], force=True)
+        runner.start()
+        runner.job.wait()
+        if runner.job.errors:
+            raise RuntimeError(runner.job.errors)
+
+    result = measure(run, runs)
+    return {
+        "command_runner/step": {
+            key: value / RUNNER_STEPS if key != "runs" else value for key, value in result.items()
+        }
+    }
+
+
+def run_suite(sizes, runs, qt=True):
+    results = {}
+    workdir = tempfile.mkdtemp(prefix="cpm-bench-")
+    os.environ["CPM_STATE_DB"] = os.path.join(workdir, "state.db")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        if qt:
+            try:
+                from PyQt5.QtWidgets import QApplication
+            except ImportError:
+                print("PyQt5 is not installed; skipping the Qt benchmarks", file=sys.stderr)
+                qt = False
+        if qt:
+            os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+            qt_app = QApplication.instance() or QApplication([])
+            results.update(bench_runner(runs))
+
+        for size in sizes:
+            print(f"Benchmarking {size} entries", file=sys.stderr)
+            apps = generate_apps(size)
+            found = bench_load(apps, runs)
+            found.update(bench_appfile(apps, runs))
+            found.update(bench_cli_search(runs))
+            if qt:
+                found.update(bench_filters(apps, runs))
+            results.update({f"{name}/{size}": value for name, value in found.items()})
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new, threshold):
+    """Print a comparison of two result sets; returns the names that regressed."""
+    regressed = []
+    for name in sorted(set(old["results"]) | set(new["results"])):
+        before, after = old["results"].get(name), new["results"].get(name)
+        if before is None or after is None:
+            print(f"{name:<48} {'only in ' + ('new' if before is None else 'old'):>30}")
+            continue
+        ratio = after["median"] / before["median"] if before["median"] else float("inf")
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  REGRESSION"
+            regressed.append(name)
+        print(f"{name:<48} {before['median'] * 1000:10.2f} ms {after['median'] * 1000:10.2f} ms "
+              f"{ratio:6.2f}x{flag}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="cpm benchmark suite")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Catalog sizes to test")
+    parser.add_argument("--runs", type=int, default=5, help="Runs per benchmark")
+    parser.add_argument("--no-qt", action="store_true", help="Skip the Qt benchmarks")
+    parser.add_argument("-o", "--output", help="Write results as JSON to this file (default: stdout)")
+    parser.add_argument("--compare", metavar="BASELINE", help="Compare against an earlier results file")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Allowed slowdown of a median before it counts as a regression")
+    args = parser.parse_args()
+
+    data = {
+        "meta": {
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "runs": args.runs,
+        },
+        "results": run_suite(args.sizes, args.runs, qt=not args.no_qt),
+    }
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(data, file, indent=2)
+    elif not args.compare:
+        json.dump(data, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare, "r") as file:
+            baseline = json.load(file)
+        regressed = compare(baseline, data, args.threshold)
+        if regressed:
+            print(f"{len(regressed)} benchmark(s) regressed by more than {args.threshold:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+import os
+import json
+import fcntl
+import time
+import shlex
+import shutil
+import hashlib
+import logging
+import tempfile
+import urllib.parse
+import urllib.request
+import urllib.error
+from contextlib import contextmanager
+
+import tracing
+
+CACHE_DIR = os.environ.get(
+    "CPM_CACHE_DIR",
+    os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "cpm", "downloads"),
+)
+# Total size of cached downloads before least recently used ones are evicted
+CACHE_SIZE = int(os.environ.get("CPM_CACHE_SIZE", 1024 * 1024 * 1024))
+CHUNK_SIZE = 64 * 1024
+TIMEOUT = 30
+
+# wget options that do not change what ends up on disk
+WGET_FLAGS = ("-q", "--quiet", "-nv", "--no-verbose", "-c", "--continue")
+
+
+def parse_wget(command):
+    """Return (url, destination) for a plain `wget URL` step, else None."""
+    try:
+        words = shlex.split(command)
+    except ValueError:
+        return None
+    if not words or words[0] != "wget" or any(c in command for c in "|&;<>$`"):
+        return None
+
+    url, dest = None, None
+    args = iter(words[1:])
+    for arg in args:
+        if arg in WGET_FLAGS:
+            continue
+        if arg in ("-O", "--output-document"):
+            dest = next(args, None)
+        elif arg.startswith("--output-document="):
+            dest = arg.split("=", 1)[1]
+        elif arg.startswith("-") or url is not None:
+            return None
+        else:
+            url = arg
+
+    if url is None or urllib.parse.urlparse(url).scheme not in ("http", "https") or dest == "-":
+        return None
+    if not dest:
+        dest = os.path.basename(urllib.parse.urlparse(url).path) or "index.html"
+    return url, dest
+
+
+class DownloadCache:
+    """Downloads stored by content hash and indexed by URL.
+
+    Entries are revalidated with If-None-Match / If-Modified-Since unless
+    the server gave them a max-age that has not run out yet. Once the
+    objects grow past max_size the least recently used ones are evicted.
+    Every change to the index and object store happens under a lock on
+    index.lock, so threads and processes sharing the cache do not lose
+    each other's entries; a download is copied out from a file it opened
+    under the lock, so an eviction meanwhile cannot pull it away.
+    """
+
+    def __init__(self, path=CACHE_DIR, max_size=CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.index_path = os.path.join(path, "index.json")
+        self.lock_path = os.path.join(path, "index.lock")
+        self.objects = os.path.join(path, "objects")
+
+    @contextmanager
+    def _locked(self):
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def load_index(self):
+        try:
+            with open(self.index_path, "r") as file:
+                return json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {"urls": {}, "stats": {"hits": 0, "misses": 0, "revalidated": 0}}
+
+    def save_index(self, index):
+        os.makedirs(self.path, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, "w") as file:
+            json.dump(index, file)
+        os.replace(temp_path, self.index_path)
+
+    def object_path(self, digest):
+        return os.path.join(self.objects, digest[:2], digest)
+
+    def fetch(self, url, dest, on_line=None):
+        """Write the content of url to dest, using the cache when it is valid."""
+        with tracing.span("download", "step", url=url) as span:
+            self._fetch(url, dest, on_line, span)
+        return dest
+
+    def _fetch(self, url, dest, on_line, span):
+        with self._locked():
+            entry = self.load_index()["urls"].get(url)
+            try:
+                source = open(self.object_path(entry["sha256"]), "rb") if entry else None
+            except FileNotFoundError:
+                source = entry = None
+        part = None
+        try:
+            if entry and entry.get("expires", 0) > time.time():
+                outcome = "hits"
+            else:
+                request = urllib.request.Request(url)
+                if entry and entry.get("etag"):
+                    request.add_header("If-None-Match", entry["etag"])
+                if entry and entry.get("last_modified"):
+                    request.add_header("If-Modified-Since", entry["last_modified"])
+                try:
+                    with urllib.request.urlopen(request, timeout=TIMEOUT) as response:
+                        entry, part = self.store(response)
+                    if source is not None:
+                        source.close()
+                    source = open(part, "rb")
+                    outcome = "misses"
+                except urllib.error.HTTPError as e:
+                    if e.code != 304 or not entry:
+                        raise
+                    entry["expires"] = self.expires(e.headers)
+                    outcome = "revalidated"
+
+            with self._locked():
+                path = self.object_path(entry["sha256"])
+                if part is not None:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    os.replace(part, path)
+                    part = None
+                index = self.load_index()
+                # The object may have been evicted since it was opened; then it is not indexed again
+                if os.path.exists(path):
+                    entry["last_used"] = time.time()
+                    index["urls"][url] = entry
+                index["stats"][outcome] += 1
+                self.evict(index, self.max_size)
+                self.save_index(index)
+
+            if on_line is not None:
+                on_line("stderr", f"{url}: {'downloaded' if outcome == 'misses' else 'served from cache'}")
+            with open(dest, "wb") as file:
+                shutil.copyfileobj(source, file, CHUNK_SIZE)
+        finally:
+            if source is not None:
+                source.close()
+            if part is not None:
+                os.unlink(part)
+        span.set(outcome=outcome, bytes=entry["size"])
+
+    @staticmethod
+    def expires(headers):
+        for directive in headers.get("Cache-Control", "").split(","):
+            name, _, value = directive.strip().partition("=")
+            if name == "max-age" and value.isdigit():
+                return time.time() + int(value)
+        return 0
+
+    def store(self, response):
+        """Stream a response body into a .part file in the object store.
+
+        Returns (entry, path of the .part file); the caller moves it into
+        place under the lock.
+        """
+        os.makedirs(self.objects, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        fd, temp_path = tempfile.mkstemp(dir=self.objects, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                for chunk in iter(lambda: response.read(CHUNK_SIZE), b""):
+                    digest.update(chunk)
+                    file.write(chunk)
+                    size += len(chunk)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        return {
+            "sha256": digest.hexdigest(),
+            "size": size,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "expires": self.expires(response.headers),
+        }, temp_path
+
+    def evict(self, index, max_size):
+        """Drop least recently used URLs until the objects fit in max_size."""
+        urls = index["urls"]
+        sizes = {entry["sha256"]: entry["size"] for entry in urls.values()}
+        total = sum(sizes.values())
+        for url in sorted(urls, key=lambda u: urls[u].get("last_used", 0)):
+            if total <= max_size:
+                break
+            digest = urls.pop(url)["sha256"]
+            if all(entry["sha256"] != digest for entry in urls.values()):
+                total -= sizes[digest]
+                try:
+                    os.remove(self.object_path(digest))
+                except FileNotFoundError:
+                    pass
+                logging.debug(f"Evicted {url} from the download cache")
+
+    def prune(self, max_size=None):
+        """Evict down to max_size (default: the cache limit) and drop orphans.
+
+        Downloads still in progress (.part files) are left alone.
+        """
+        with self._locked():
+            index = self.load_index()
+            self.evict(index, self.max_size if max_size is None else max_size)
+            self.save_index(index)
+            live = {entry["sha256"] for entry in index["urls"].values()}
+            for root, _, files in os.walk(self.objects):
+                for name in files:
+                    if name not in live and not name.endswith(".part"):
+                        os.remove(os.path.join(root, name))
+
+    def stats(self):
+        index = self.load_index()
+        digests = {entry["sha256"]: entry["size"] for entry in index["urls"].values()}
+        return {
+            "path": self.path,
+            "urls": len(index["urls"]),
+            "objects": len(digests),
+            "bytes": sum(digests.values()),
+            "max_bytes": self.max_size,
+            **index["stats"],
+        }
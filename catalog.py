@@ -0,0 +1,247 @@
+import re
+import sys
+import json
+
+from search import SearchIndex, DEFAULT_LIMIT
+
+VERSION_PART = re.compile(r"~|\d+|[^\W\d_]+")
+# Characters read from pkg.cpm at a time by iter_catalog
+READ_SIZE = 64 * 1024
+JSON_WHITESPACE = re.compile(r"[ \t\r\n]*")
+# Characters that may follow an entry of the top-level array; a tuple, so
+# that "" (the end of the buffer) is not among them
+VALUE_ENDS = (" ", "\t", "\r", "\n", ",", "]")
+
+
+def version_key(version):
+    """Sort key that orders versions naturally: 1.2 < 1.10 < 2.0.
+
+    Numeric parts compare as numbers and rank above words, so a numbered
+    version is newer than one such as "unknown". A word after a separator,
+    as in 1.0-rc1 or 1.0.beta, and anything after a "~", as in 2.0~beta1,
+    mark a pre-release that is older than the bare version; a word right
+    after a number, as in 1.0a, is newer.
+    """
+    key = []
+    for match in VERSION_PART.finditer(version):
+        part = match.group()
+        if part == "~":
+            key.append((-2, 0, ""))
+        elif part.isdigit():
+            key.append((2, int(part), ""))
+        elif match.start() and version[match.start() - 1].isdigit():
+            key.append((1, 0, part.lower()))
+        else:
+            key.append((-1, 0, part.lower()))
+    # The end of the version: above pre-releases, below anything longer
+    key.append((0, 0, ""))
+    return tuple(key)
+
+
+class App:
+    """One catalog entry. Names and versions are interned."""
+
+    __slots__ = ("name", "version", "commands", "description")
+
+    def __init__(self, name, version, commands, description=""):
+        self.name = sys.intern(name)
+        self.version = sys.intern(version)
+        self.commands = tuple(commands)
+        self.description = description
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["name"], data["version"], data["commands"], data.get("description", ""))
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "version": self.version,
+            "commands": list(self.commands),
+            "description": self.description,
+        }
+
+    @property
+    def key(self):
+        return (self.name, self.version)
+
+    @property
+    def label(self):
+        return f"{self.name} {self.version}"
+
+
+def iter_catalog(file, read_size=READ_SIZE):
+    """Yield the entries of a pkg.cpm file object one at a time.
+
+    The top-level JSON array is decoded entry by entry as the file is read,
+    so memory holds one chunk and the current entry rather than the whole
+    document. A {"apps": [...]} document is loaded in one go. Malformed
+    JSON raises json.JSONDecodeError, as json.load would, though only once
+    the entries before the error were yielded.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    eof = False
+
+    def more():
+        """Read another chunk after what is left of buffer; False at the end of the file."""
+        nonlocal buffer, position, eof
+        chunk = file.read(read_size)
+        eof = not chunk
+        buffer = buffer[position:] + chunk
+        position = 0
+        return not eof
+
+    def skip():
+        """Move past whitespace and return the next character, or "" at the end of the file."""
+        nonlocal position
+        while True:
+            position = JSON_WHITESPACE.match(buffer, position).end()
+            if position < len(buffer) or not more():
+                return buffer[position:position + 1]
+
+    first = skip()
+    if first == "{":
+        yield from json.loads(buffer[position:] + file.read()).get("apps", [])
+        return
+    if first != "[":
+        raise json.JSONDecodeError("Expected a list of apps", buffer, position)
+    position += 1
+    if skip() == "]":
+        position += 1
+    else:
+        while True:
+            if skip() in ("", ",", "]"):
+                raise json.JSONDecodeError("Expecting value", buffer, position)
+            try:
+                entry, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if eof or not more():
+                    raise
+                continue
+            # A number, as in "2.5e3", may go on past the buffer edge
+            if not eof and buffer[end:end + 1] not in VALUE_ENDS:
+                more()
+                continue
+            yield entry
+            position = end
+            separator = skip()
+            position += 1
+            if separator == "]":
+                break
+            if separator != ",":
+                raise json.JSONDecodeError("Expecting ',' delimiter", buffer, position - 1)
+    if skip():
+        raise json.JSONDecodeError("Extra data", buffer, position)
+
+
+def default_search_fields(app):
+    return (app.name, app.description)
+
+
+# Ranking weight of each search field: name matches outrank description ones
+SEARCH_WEIGHTS = (4.0, 1.0)
+
+
+class CatalogStore:
+    """The loaded catalog, keyed by id, name and (name, version).
+
+    Ids are stable integers handed out in insertion order; iteration
+    follows catalog order. (name, version) is unique: adding an app whose
+    key already exists replaces that entry. The search index is kept in
+    step with every change.
+    """
+
+    def __init__(self, apps=(), search_fields=default_search_fields, search_weights=SEARCH_WEIGHTS):
+        self.search_fields = search_fields
+        self.records = {}
+        self.by_key = {}
+        self.by_name = {}
+        self.index = SearchIndex(search_weights)
+        self.next_id = 0
+        for app in apps:
+            self.add(app)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records.values())
+
+    def __getitem__(self, app_id):
+        return self.records[app_id]
+
+    def items(self):
+        return self.records.items()
+
+    def add(self, app):
+        """Add an app, or replace the entry with the same name and version."""
+        app_id = self.by_key.get(app.key)
+        if app_id is not None:
+            self.update(app_id, app)
+            return app_id
+        app_id = self.next_id
+        self.next_id += 1
+        self._insert(app_id, app)
+        return app_id
+
+    def update(self, app_id, app):
+        old = self.records[app_id]
+        if app.key != old.key:
+            if app.key in self.by_key:
+                raise KeyError(f"App '{app.label}' already exists")
+            self._unlink(app_id, old)
+        self._insert(app_id, app)
+
+    def remove(self, app_id):
+        app = self.records.pop(app_id)
+        self._unlink(app_id, app)
+        self.index.remove(app_id)
+        return app
+
+    def _insert(self, app_id, app):
+        self.records[app_id] = app
+        if self.by_key.get(app.key) != app_id:
+            self.by_key[app.key] = app_id
+            self.by_name.setdefault(app.name, []).append(app_id)
+        self.index.add(app_id, *self.search_fields(app))
+
+    def _unlink(self, app_id, app):
+        del self.by_key[app.key]
+        ids = self.by_name[app.name]
+        ids.remove(app_id)
+        if not ids:
+            del self.by_name[app.name]
+
+    def find(self, name, version):
+        """Return the id of name at version, or None."""
+        return self.by_key.get((name, version))
+
+    def versions(self, name):
+        """Return the ids of every version of name, oldest first."""
+        ids = self.by_name.get(name, ())
+        return sorted(ids, key=lambda app_id: version_key(self.records[app_id].version))
+
+    def newest(self, name):
+        ids = self.by_name.get(name)
+        if not ids:
+            return None
+        return max(ids, key=lambda app_id: version_key(self.records[app_id].version))
+
+    def resolve(self, spec):
+        """Resolve "name version", or a bare name to its newest version."""
+        name, _, version = spec.strip().rpartition(" ")
+        if name:
+            app_id = self.find(name, version)
+            if app_id is not None:
+                return app_id
+        return self.newest(spec.strip())
+
+    def search(self, term):
+        """Return the ids of apps matching term, in catalog order."""
+        return self.index.search(term)
+
+    def rank(self, term, limit=DEFAULT_LIMIT):
+        """Return the ids of the best matches for term, best first."""
+        return self.index.rank(term, limit)
@@ -0,0 +1,315 @@
+import os
+import sys
+import json
+import mmap
+import struct
+from array import array
+
+from catalog import App, SEARCH_WEIGHTS, default_search_fields, iter_catalog, version_key
+from search import SearchIndex, DEFAULT_LIMIT, ngrams
+from storage import write_atomic
+
+# Layout of a compiled catalog, all integers little-endian:
+#   header | field table | records | search field refs | key index
+#   | gram tables | postings | string table
+# Strings are UTF-8 and referenced as (offset, length) into the string
+# table; equal strings are stored once. Records are fixed size, so record i
+# is found without reading the ones before it. The key index lists record
+# ids sorted by (name, version) bytes, each gram table lists a field's
+# trigrams sorted by bytes, and each posting list holds ascending ids.
+MAGIC = b"CPMC"
+FORMAT = 1
+# magic, format, source size, source mtime (ns), records, search fields,
+# then the offsets of the records, field refs, key index and string table
+HEADER = struct.Struct("<4sIQqIIQQQQ")
+# gram count, gram table offset
+FIELD = struct.Struct("<IQ")
+# name, version, commands (as JSON) and description references
+RECORD = struct.Struct("<QIQIQIQI")
+REF = struct.Struct("<QI")
+# gram reference, postings offset, postings length
+GRAM = struct.Struct("<QIQI")
+ID = struct.Struct("<I")
+
+
+def compiled_path(pkg_file):
+    return pkg_file + ".bin"
+
+
+def compile_catalog(source, path=None, search_fields=default_search_fields):
+    """Compile the pkg.cpm file source into a binary catalog at path.
+
+    Duplicate (name, version) entries collapse the way CatalogStore does:
+    the last one wins at the position of the first. The file is written
+    next to source by default and replaced atomically. Returns the number
+    of records written.
+    """
+    path = path or compiled_path(source)
+    stat = os.stat(source)
+    records = {}
+    with open(source, "r") as file:
+        for entry in iter_catalog(file):
+            app = App.from_dict(entry)
+            records[app.key] = app
+    apps = list(records.values())
+
+    strings = bytearray()
+    refs = {}
+
+    def ref(text):
+        found = refs.get(text)
+        if found is None:
+            data = text.encode()
+            found = refs[text] = (len(strings), len(data))
+            strings.extend(data)
+        return found
+
+    record_table = bytearray()
+    field_refs = bytearray()
+    postings = []
+    for app_id, app in enumerate(apps):
+        record_table += RECORD.pack(
+            *ref(app.name), *ref(app.version),
+            *ref(json.dumps(list(app.commands))), *ref(app.description),
+        )
+        for field, text in enumerate(search_fields(app)):
+            field_refs += REF.pack(*ref(text))
+            while len(postings) <= field:
+                postings.append({})
+            for gram in ngrams(text.lower()):
+                postings[field].setdefault(gram, []).append(app_id)
+    field_count = len(postings)
+    if apps and len(field_refs) != len(apps) * field_count * REF.size:
+        raise ValueError("Every app must have the same number of search fields")
+
+    keys = sorted(range(len(apps)), key=lambda i: (apps[i].name.encode(), apps[i].version.encode()))
+    key_table = b"".join(ID.pack(app_id) for app_id in keys)
+
+    records_offset = HEADER.size + FIELD.size * field_count
+    refs_offset = records_offset + len(record_table)
+    keys_offset = refs_offset + len(field_refs)
+    offset = keys_offset + len(key_table)
+
+    field_table = bytearray()
+    grams = []
+    for field_postings in postings:
+        ordered = sorted(field_postings, key=str.encode)
+        field_table += FIELD.pack(len(ordered), offset)
+        grams.append(ordered)
+        offset += GRAM.size * len(ordered)
+    gram_tables = bytearray()
+    posting_lists = bytearray()
+    for field_postings, ordered in zip(postings, grams):
+        for gram in ordered:
+            ids = array("I", field_postings[gram])
+            if sys.byteorder == "big":
+                ids.byteswap()
+            gram_tables += GRAM.pack(*ref(gram), offset + len(posting_lists), len(ids))
+            posting_lists += ids.tobytes()
+    strings_offset = offset + len(posting_lists)
+
+    header = HEADER.pack(
+        MAGIC, FORMAT, stat.st_size, stat.st_mtime_ns, len(apps), field_count,
+        records_offset, refs_offset, keys_offset, strings_offset,
+    )
+    write_atomic(path, (header, field_table, record_table, field_refs, key_table,
+                        gram_tables, posting_lists, strings), mode="wb")
+    return len(apps)
+
+
+class CompiledIndex(SearchIndex):
+    """Read-only SearchIndex over the postings of a CompiledCatalog."""
+
+    def __init__(self, catalog, weights=SEARCH_WEIGHTS):
+        super().__init__(weights)
+        self.catalog = catalog
+
+    def __len__(self):
+        return len(self.catalog)
+
+    def __contains__(self, doc_id):
+        return 0 <= doc_id < len(self.catalog)
+
+    def add(self, doc_id, *fields):
+        raise TypeError("A compiled catalog is read-only")
+
+    def remove(self, doc_id):
+        raise TypeError("A compiled catalog is read-only")
+
+    def _doc_ids(self):
+        return range(len(self.catalog))
+
+    def _field_count(self):
+        return self.catalog.field_count
+
+    def _text(self, doc_id, field):
+        return self.catalog.field_text(doc_id, field).lower()
+
+    def _posting(self, field, gram):
+        return self.catalog.posting(field, gram)
+
+    def _scan(self, field):
+        for doc_id in range(len(self.catalog)):
+            yield doc_id, self._text(doc_id, field)
+
+
+class CompiledCatalog:
+    """A compiled catalog, memory-mapped and decoded lazily.
+
+    Offers the read side of CatalogStore: ids are record positions, and
+    only the records and postings a lookup touches are decoded. The mapping
+    is shared through the page cache by every process reading the file.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as file:
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.source_size, self.source_mtime, self.count, self.field_count,
+         self.records_offset, self.refs_offset, self.keys_offset,
+         self.strings_offset) = HEADER.unpack_from(self.data)
+        if magic != MAGIC or version != FORMAT:
+            self.data.close()
+            raise ValueError(f"{path} is not a compiled catalog")
+        self.fields = [
+            FIELD.unpack_from(self.data, HEADER.size + field * FIELD.size)
+            for field in range(self.field_count)
+        ]
+        self.decoded = {}
+        self.index = CompiledIndex(self)
+
+    @classmethod
+    def open_fresh(cls, source, path=None):
+        """Open the compiled form of source, or return None if it is missing or stale."""
+        path = path or compiled_path(source)
+        try:
+            stat = os.stat(source)
+            catalog = cls(path)
+        except (OSError, ValueError, struct.error):
+            return None
+        if (stat.st_size, stat.st_mtime_ns) != (catalog.source_size, catalog.source_mtime):
+            catalog.close()
+            return None
+        return catalog
+
+    def close(self):
+        self.data.close()
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        # A full pass decodes every record; keep none of them around
+        for app_id in range(self.count):
+            yield self.decoded.get(app_id) or self._decode(app_id)
+
+    def __getitem__(self, app_id):
+        app = self.decoded.get(app_id)
+        if app is None:
+            if not 0 <= app_id < self.count:
+                raise KeyError(app_id)
+            app = self.decoded[app_id] = self._decode(app_id)
+        return app
+
+    def _decode(self, app_id):
+        refs = RECORD.unpack_from(self.data, self.records_offset + app_id * RECORD.size)
+        name, version, commands, description = (
+            self.string(refs[i], refs[i + 1]) for i in range(0, 8, 2)
+        )
+        return App(name, version, json.loads(commands), description)
+
+    def items(self):
+        for app_id in range(self.count):
+            yield app_id, self[app_id]
+
+    def string(self, offset, length, decode=True):
+        start = self.strings_offset + offset
+        data = self.data[start:start + length]
+        return data.decode() if decode else data
+
+    def field_text(self, app_id, field):
+        position = self.refs_offset + (app_id * self.field_count + field) * REF.size
+        return self.string(*REF.unpack_from(self.data, position))
+
+    def posting(self, field, gram):
+        """Return the set of ids whose field contains the trigram gram."""
+        count, offset = self.fields[field]
+        target = gram.encode()
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            entry = GRAM.unpack_from(self.data, offset + middle * GRAM.size)
+            found = self.string(entry[0], entry[1], decode=False)
+            if found == target:
+                ids = array("I", self.data[entry[2]:entry[2] + entry[3] * ID.size])
+                if sys.byteorder == "big":
+                    ids.byteswap()
+                return set(ids)
+            if found < target:
+                low = middle + 1
+            else:
+                high = middle
+        return set()
+
+    def _key(self, position):
+        app_id = ID.unpack_from(self.data, self.keys_offset + position * ID.size)[0]
+        refs = RECORD.unpack_from(self.data, self.records_offset + app_id * RECORD.size)
+        return app_id, (self.string(refs[0], refs[1], False), self.string(refs[2], refs[3], False))
+
+    def _lower_bound(self, key):
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle)[1] < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _name_ids(self, name):
+        target = name.encode()
+        position = self._lower_bound((target, b""))
+        ids = []
+        while position < self.count:
+            app_id, key = self._key(position)
+            if key[0] != target:
+                break
+            ids.append(app_id)
+            position += 1
+        return ids
+
+    def find(self, name, version):
+        """Return the id of name at version, or None."""
+        key = (name.encode(), version.encode())
+        position = self._lower_bound(key)
+        if position < self.count:
+            app_id, found = self._key(position)
+            if found == key:
+                return app_id
+        return None
+
+    def versions(self, name):
+        """Return the ids of every version of name, oldest first."""
+        return sorted(self._name_ids(name), key=lambda app_id: version_key(self[app_id].version))
+
+    def newest(self, name):
+        ids = self._name_ids(name)
+        if not ids:
+            return None
+        return max(ids, key=lambda app_id: version_key(self[app_id].version))
+
+    def resolve(self, spec):
+        """Resolve "name version", or a bare name to its newest version."""
+        name, _, version = spec.strip().rpartition(" ")
+        if name:
+            app_id = self.find(name, version)
+            if app_id is not None:
+                return app_id
+        return self.newest(spec.strip())
+
+    def search(self, term):
+        """Return the ids of apps matching term, in catalog order."""
+        return self.index.search(term)
+
+    def rank(self, term, limit=DEFAULT_LIMIT):
+        """Return the ids of the best matches for term, best first."""
+        return self.index.rank(term, limit)
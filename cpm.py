@@ -0,0 +1,484 @@
+import sys
+import os
+import logging
+import json
+import argparse
+import time
+import threading
+import tracing
+from catalog import App, CatalogStore
+from compiled import CompiledCatalog, compile_catalog, compiled_path
+from storage import CatalogFile, FileWatcher
+from search import DEFAULT_LIMIT
+from steps import DEFAULT_WORKERS, step_commands
+from sync import CATALOG_URL, SOURCES_FILE
+# The download cache, install state, job queue, app.txt converter and
+# daemon are imported where they are used, so `--list` and `--search`
+# do not pay for urllib.request, sqlite3 or multiprocessing.
+
+PKG_FILE = "pkg.cpm"
+APP_FILE = "app.txt"
+# Seconds between checks that whoever waits for an install is still there
+KEEPALIVE = 1.0
+
+def convert_app_txt_to_pkg_cpm():
+    """Import a waiting app.txt into pkg.cpm; app.txt is kept if it has malformed records."""
+    if not os.path.exists(APP_FILE):
+        return
+    from appfile import FormatError, import_app_txt
+
+    logging.info(f"Converting {APP_FILE} to {PKG_FILE}.")
+    try:
+        count = import_app_txt(APP_FILE, PKG_FILE)
+        os.remove(APP_FILE)
+        logging.info(f"Converted {count} packages from {APP_FILE} to {PKG_FILE} successfully.")
+    except FormatError as e:
+        for error in e.errors:
+            logging.error(error)
+        logging.error(f"Not converting {APP_FILE} to {PKG_FILE}; fix the records above first.")
+    except OSError as e:
+        logging.error(f"Error converting {APP_FILE} to {PKG_FILE}: {e}")
+
+def open_compiled():
+    """Return the compiled catalog if it is current, or None.
+
+    It is current when built from this pkg.cpm, with no app.txt waiting
+    to be converted and no journaled edits on top.
+    """
+    if os.path.exists(APP_FILE) or CatalogFile(PKG_FILE).pending():
+        return None
+    return CompiledCatalog.open_fresh(PKG_FILE)
+
+def iter_apps(on_error=None):
+    """Yield the catalog's App records as pkg.cpm is read.
+
+    on_error(message) is called for user-facing errors; the records read
+    before a parse error have already been yielded.
+    """
+    def report(message):
+        logging.error(message)
+        if on_error is not None:
+            on_error(message)
+
+    try:
+        convert_app_txt_to_pkg_cpm()
+
+        if not os.path.exists(PKG_FILE):
+            report("No package file found!")
+            return
+
+        compiled = open_compiled()
+        if compiled is not None:
+            logging.info(f"Loading app list from: {compiled_path(PKG_FILE)}")
+            with tracing.span("catalog.load", "catalog", source="compiled") as span:
+                try:
+                    yield from compiled
+                finally:
+                    compiled.close()
+                span.set(records=len(compiled))
+            return
+
+        logging.info(f"Loading app list from: {PKG_FILE}")
+        with tracing.span("catalog.load", "catalog", source="json") as span:
+            records = 0
+            for entry in CatalogFile(PKG_FILE).iter_entries():
+                records += 1
+                yield App.from_dict(entry)
+            span.set(records=records)
+    except FileNotFoundError:
+        report("Package file not found!")
+    except (json.JSONDecodeError, KeyError, TypeError, AttributeError) as e:
+        report(f"Error parsing {PKG_FILE}: {e}")
+
+def load_apps(on_error=None):
+    """Load the catalog into a CatalogStore.
+
+    When a compiled catalog built from the current pkg.cpm exists, it is
+    memory-mapped and returned instead; it has the same read interface and
+    decodes records only as they are looked up. on_error(message) is called
+    for user-facing errors.
+    """
+    with tracing.span("catalog.open", "catalog") as span:
+        compiled = open_compiled()
+        if compiled is not None:
+            span.set(source="compiled", records=len(compiled))
+            return compiled
+        apps = CatalogStore(iter_apps(on_error))
+        span.set(source="json", records=len(apps))
+        return apps
+
+def requires_sudo(commands):
+    return any(cmd.startswith("sudo ") for cmd in step_commands(commands))
+
+def print_line(stream, line):
+    print(line, file=sys.stderr if stream == "stderr" else sys.stdout, flush=True)
+
+def install_apps(targets, password=None, jobs=DEFAULT_WORKERS, force=False, emit=print_line, queue=None,
+                 keepalive=None):
+    """Install targets as one job, reporting progress through emit(stream, line).
+
+    Returns the error messages. Invalid install steps raise KeyError,
+    TypeError or ValueError before anything runs. queue is the JobQueue
+    to run in; by default the job gets one of its own. The job is
+    cancelled if emit raises OSError, as when a daemon's client went away,
+    or on a KeyboardInterrupt while waiting. keepalive() is called every
+    KEEPALIVE seconds while waiting and may raise OSError the same way.
+    """
+    from jobs import JobQueue, format_seconds
+
+    def report(job, stream, line):
+        try:
+            emit(stream, line)
+        except OSError:
+            queue.cancel(job.id)
+
+    def on_start(job, step):
+        report(job, "stdout", f"Executing: {step.command}")
+
+    def on_step(job, step, error, percents):
+        packages = ", ".join(f"{label} {percent}%" for label, percent in percents.items())
+        if step.skipped:
+            outcome = "Already done"
+        else:
+            outcome = f"{'Failed' if error else 'Done'} in {step.seconds:.1f}s"
+        left = job.seconds_left()
+        eta = f", about {format_seconds(left)} left" if left else ""
+        report(job, "stdout", f"Progress: {job.progress}%{eta} [{packages}] - {outcome}: {step.command}")
+
+    if queue is None:
+        queue = JobQueue(max_jobs=1)
+    job = queue.submit(
+        targets, password, force, workers=jobs,
+        on_output=report, on_start=on_start, on_step=on_step,
+    )
+    try:
+        while not job.wait(KEEPALIVE if keepalive else None):
+            try:
+                keepalive()
+            except OSError:
+                queue.cancel(job.id)
+                job.wait()
+    except KeyboardInterrupt:
+        queue.cancel(job.id)
+        job.wait()
+        raise
+    return job.errors
+
+def catalog_files():
+    """Every file the loaded catalog depends on."""
+    return [PKG_FILE, CatalogFile(PKG_FILE).journal_path, compiled_path(PKG_FILE), APP_FILE]
+
+class CatalogService:
+    """The catalog and installed state a `--daemon` keeps in memory.
+
+    The catalog is reloaded when one of its files changed since the last
+    request. Installs from all clients share one JobQueue.
+    """
+
+    def __init__(self, max_jobs=None):
+        from state import InstallState
+        from jobs import MAX_JOBS, JobQueue
+
+        self.lock = threading.Lock()
+        self.state = InstallState()
+        self.jobs = JobQueue(max_jobs or MAX_JOBS, state=self.state)
+        self.apps = None
+        self.watcher = None
+
+    def catalog(self):
+        with self.lock:
+            if self.watcher is None or self.watcher.changed():
+                # Watch from before the load, so changes made during it are seen next time
+                self.watcher = FileWatcher(catalog_files())
+                # A replaced compiled catalog stays mapped while requests still use it
+                self.apps = load_apps()
+                logging.info(f"Loaded {len(self.apps)} packages")
+            return self.apps
+
+    def resolve(self, specs):
+        apps = self.catalog()
+        return [None if app_id is None else apps[app_id] for app_id in map(apps.resolve, specs)]
+
+    def do_ping(self, request, send):
+        return os.getpid()
+
+    def do_list(self, request, send):
+        for app in self.catalog():
+            send(app=app.to_dict())
+
+    def do_search(self, request, send):
+        apps = self.catalog()
+        return [apps[i].to_dict() for i in apps.rank(request["term"], request.get("limit") or DEFAULT_LIMIT)]
+
+    def do_detail(self, request, send):
+        return [app and app.to_dict() for app in self.resolve(request["specs"])]
+
+    def do_install(self, request, send):
+        targets = {}
+        for spec, app in zip(request["specs"], self.resolve(request["specs"])):
+            if app is None:
+                raise ValueError(f"Package '{spec}' not found.")
+            targets.setdefault(app.key, app)
+        try:
+            return install_apps(
+                list(targets.values()), request.get("password"), request.get("jobs") or DEFAULT_WORKERS,
+                request.get("force", False), lambda stream, line: send(stream=stream, line=line), self.jobs,
+                keepalive=send,
+            )
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError(f"Invalid install steps: {e}") from e
+
+    def do_jobs(self, request, send):
+        return [job.to_dict() for job in self.jobs.list()]
+
+    def do_cancel(self, request, send):
+        if not self.jobs.cancel(request["job"]):
+            raise ValueError(f"No queued or running job {request['job']}")
+
+def cli_main():
+    parser = argparse.ArgumentParser(description='Chilly Package Manager CLI')
+    parser.add_argument('--list', action='store_true', help='List all available packages')
+    parser.add_argument('--search', type=str, help='Search for packages by name or description')
+    parser.add_argument('--limit', type=int, default=DEFAULT_LIMIT, help='Maximum number of search results')
+    parser.add_argument('--install', type=str, nargs='+', metavar='"NAME [VERSION]"', help='Install one or more packages in one transaction; a bare name picks the newest version')
+    parser.add_argument('--info', type=str, metavar='"NAME [VERSION]"', help='Show the details of a package')
+    parser.add_argument('--jobs', type=int, default=DEFAULT_WORKERS, help='Maximum number of install steps to run at once')
+    parser.add_argument('--force', action='store_true', help='Run every install step, even ones already done')
+    parser.add_argument('--plan', action='store_true', help='Show the steps of an --install and how long they should take, without running them')
+    parser.add_argument('--installed', action='store_true', help='List installed packages')
+    parser.add_argument('--sync', nargs='?', const='', metavar='URL', help=f'Fetch catalog changes since the last sync, from URL or else every source in {SOURCES_FILE} (default: {CATALOG_URL})')
+    parser.add_argument('--import', dest='import_file', nargs='?', const=APP_FILE, metavar='FILE', help=f'Replace {PKG_FILE} with the packages of an app.txt file (default: {APP_FILE})')
+    parser.add_argument('--export', dest='export_file', nargs='?', const=APP_FILE, metavar='FILE', help=f'Write {PKG_FILE} out as an app.txt file (default: {APP_FILE})')
+    parser.add_argument('--compile-catalog', action='store_true', help=f'Compile {PKG_FILE} into a binary catalog for faster startup')
+    parser.add_argument('--daemon', action='store_true', help='Keep the catalog in memory and answer CLI requests over a local socket')
+    parser.add_argument('--max-jobs', type=int, help='Maximum number of install jobs the daemon runs at once')
+    parser.add_argument('--queue', action='store_true', help="List the daemon's install jobs")
+    parser.add_argument('--cancel', type=int, metavar='JOB', help='Cancel a queued or running install job in the daemon')
+    parser.add_argument('--no-daemon', action='store_true', help='Do not use a running daemon')
+    parser.add_argument('--profile', metavar='FILE', help='Record timing spans and write them to FILE (Chrome trace JSON, or JSON lines for *.jsonl)')
+    parser.add_argument('--cache-stats', action='store_true', help='Show download cache statistics')
+    parser.add_argument('--cache-prune', action='store_true', help='Evict cached downloads down to the cache size limit')
+    parser.add_argument('--cache-max', type=int, metavar='BYTES', help='Size limit to prune the download cache to')
+    args = parser.parse_args()
+    if args.limit < 1:
+        parser.error("--limit must be at least 1")
+
+    logging.basicConfig(level=logging.WARNING)
+    if args.profile:
+        tracing.enable(args.profile)
+
+    if args.cache_stats or args.cache_prune:
+        from cache import DownloadCache
+
+        cache = DownloadCache()
+        if args.cache_prune:
+            cache.prune(args.cache_max)
+        for key, value in cache.stats().items():
+            print(f"{key}: {value}")
+        return
+
+    if args.installed:
+        from state import InstallState
+
+        state = InstallState()
+        try:
+            for row in state.installed():
+                print(f"{row['name']} {row['version']} - installed "
+                      f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(row['installed']))}")
+        finally:
+            state.close()
+        return
+
+    if args.import_file or args.export_file:
+        from appfile import FormatError, export_app_txt, import_app_txt
+
+        try:
+            if args.import_file:
+                count = import_app_txt(args.import_file, PKG_FILE)
+                print(f"Imported {count} packages from {args.import_file} into {PKG_FILE}")
+                if os.path.exists(compiled_path(PKG_FILE)):
+                    compile_catalog(PKG_FILE)
+            else:
+                count = export_app_txt(PKG_FILE, args.export_file)
+                print(f"Exported {count} packages from {PKG_FILE} to {args.export_file}")
+        except FormatError as e:
+            for error in e.errors:
+                print(f"Error: {error}")
+            print(f"Nothing written; {len(e.errors)} malformed records.")
+            sys.exit(1)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        return
+
+    if args.sync is not None:
+        from sync import load_sources, sync_catalog, sync_sources
+
+        try:
+            sources = [] if args.sync else load_sources()
+            if sources:
+                changed = sync_sources(sources, PKG_FILE)
+            else:
+                sync_catalog(PKG_FILE, args.sync or CATALOG_URL)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Error: Catalog sync failed: {e}")
+            sys.exit(1)
+        if sources and not changed:
+            compiled = open_compiled()
+            if compiled is not None:
+                compiled.close()
+                return
+        # Merged sources always get a compiled catalog; a single one keeps an existing one in step
+        if not sources and not os.path.exists(compiled_path(PKG_FILE)):
+            return
+
+    if args.sync is not None or args.compile_catalog:
+        convert_app_txt_to_pkg_cpm()
+        try:
+            CatalogFile(PKG_FILE).compact()
+            count = compile_catalog(PKG_FILE)
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            print(f"Error: Could not compile {PKG_FILE}: {e}")
+            sys.exit(1)
+        print(f"Compiled {count} packages into {compiled_path(PKG_FILE)}")
+        return
+
+    if args.daemon:
+        from daemon import DaemonError, serve
+
+        logging.getLogger().setLevel(logging.INFO)
+        try:
+            serve(CatalogService(args.max_jobs), os.path.abspath(PKG_FILE))
+        except DaemonError as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        return
+
+    from daemon import DaemonError, connect
+
+    client = None
+    if not args.no_daemon and (args.list or args.search or args.info or args.install):
+        client = connect(os.path.abspath(PKG_FILE))
+
+    if args.queue or args.cancel is not None:
+        from jobs import format_seconds
+
+        client = connect(os.path.abspath(PKG_FILE))
+        if client is None:
+            print("Error: No daemon is running; install jobs run in the foreground without one.")
+            sys.exit(1)
+        try:
+            if args.cancel is not None:
+                client.cancel(args.cancel)
+                print(f"Cancelled job {args.cancel}.")
+            else:
+                for job in client.jobs():
+                    left = f", about {format_seconds(job['seconds_left'])} left" if job['seconds_left'] else ""
+                    print(f"{job['id']}: {job['status']} {job['progress']}%{left} - {', '.join(job['packages'])}")
+        except (OSError, DaemonError) as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        return
+
+    if args.list:
+        print("Available packages:")
+        for app in client.list() if client else iter_apps():
+            print(f"{app.name} {app.version} - {app.description}")
+        return
+
+    if client is None:
+        apps = load_apps()
+
+    if args.search:
+        if client:
+            found = client.search(args.search, args.limit)
+        else:
+            found = [apps[i] for i in apps.rank(args.search, args.limit)]
+        if found:
+            print(f"Found {len(found)} packages matching '{args.search}':")
+            for app in found:
+                print(f"{app.name} {app.version} - {app.description}")
+        else:
+            print(f"No packages found matching '{args.search}'.")
+    elif args.info or args.install:
+        specs = args.install or [args.info]
+        found = client.detail(specs) if client else [
+            None if app_id is None else apps[app_id] for app_id in map(apps.resolve, specs)
+        ]
+        targets = {}
+        for spec, app in zip(specs, found):
+            if app is None:
+                print(f"Error: Package '{spec}' not found.")
+                sys.exit(1)
+            targets.setdefault(app.key, app)
+        targets = list(targets.values())
+
+        if args.info:
+            app = targets[0]
+            print(f"Name: {app.name}\nVersion: {app.version}\nDescription: {app.description}\nCommands:")
+            for command in step_commands(app.commands):
+                print(f"  {command}")
+            return
+
+        from jobs import estimate_install, format_seconds
+
+        if args.plan:
+            try:
+                steps, estimates, total = estimate_install(targets, args.jobs, args.force)
+            except (KeyError, TypeError, ValueError) as e:
+                print(f"Error: Invalid install steps: {e}")
+                sys.exit(1)
+            print(f"Plan for {', '.join(app.label for app in targets)}:")
+            for step in steps:
+                seconds, known = estimates[step.index]
+                if known and not seconds:
+                    estimate = "done"
+                else:
+                    estimate = format_seconds(seconds) + ("" if known else "?")
+                print(f"  {estimate:>8}  [{', '.join(step.packages)}] {step.command}")
+            work = sum(seconds for seconds, _ in estimates.values())
+            print(f"Estimated time: {format_seconds(total)} with --jobs {args.jobs} ({format_seconds(work)} of work)")
+            if not all(known for _, known in estimates.values()):
+                print("Steps marked ? have no recorded run; their time is a guess.")
+            return
+
+        password = None
+        if any(requires_sudo(app.commands) for app in targets):
+            import getpass
+
+            password = getpass.getpass("Enter your sudo password: ")
+            if not password:
+                print("Installation cancelled.")
+                sys.exit(1)
+
+        try:
+            if client:
+                errors = client.install(specs, password, args.jobs, args.force, print_line)
+            else:
+                errors = install_apps(targets, password, args.jobs, args.force)
+        except (KeyError, TypeError, ValueError) as e:
+            print(f"Error: Invalid install steps: {e}")
+            sys.exit(1)
+        except KeyboardInterrupt:
+            print("Installation cancelled.")
+            sys.exit(1)
+        except DaemonError as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        except OSError as e:
+            print(f"Error: Lost the connection to the daemon: {e}")
+            sys.exit(1)
+
+        if errors:
+            print("Errors occurred:")
+            for error in errors:
+                print(f"  - {error}")
+            sys.exit(1)
+        else:
+            print("Installation successful!")
+            sys.exit(0)
+    else:
+        parser.print_help()
+
+if __name__ == "__main__":
+    cli_main()
@@ -0,0 +1,191 @@
+import os
+import json
+import socket
+import struct
+import logging
+import tempfile
+import socketserver
+
+from catalog import App
+
+SOCKET_PATH = os.environ.get(
+    "CPM_SOCKET",
+    os.path.join(os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir(), f"cpm-{os.getuid()}.sock"),
+)
+CONNECT_TIMEOUT = 0.5
+
+# Protocol: the client sends one JSON request per connection on one line,
+#
+#   {"op": "list" | "search" | "detail" | "install" | "jobs" | "cancel", "catalog": <abs path>, ...}
+#
+# and reads JSON lines back until one carrying "ok". Lines before it are
+# {"app": <app>} entries of a list, {"stream": "stdout", "line": ...}
+# output of an install or {} keepalives while an install waits. The final
+# line is {"ok": true, "result": ...} or {"ok": false, "error": <message>}.
+# A daemon only answers for the catalog it was started on; requests naming
+# another are refused, so the client runs them in-process instead.
+# Installs run in the daemon's job queue; closing the connection of an
+# install cancels its job.
+
+
+class DaemonError(Exception):
+    pass
+
+
+def peer_uid(sock):
+    """The uid of the process on the other end of a Unix socket."""
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+    return struct.unpack("3i", creds)[1]
+
+
+class Client:
+    """Connection to a running daemon; each call uses a new connection."""
+
+    def __init__(self, catalog, path=SOCKET_PATH):
+        self.catalog = catalog
+        self.path = path
+
+    def _request(self, op, **fields):
+        """Send a request and yield its messages, ending with the final one."""
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(CONNECT_TIMEOUT)
+            sock.connect(self.path)
+            sock.settimeout(None)
+            sock.sendall((json.dumps({"op": op, "catalog": self.catalog, **fields}) + "\n").encode())
+            with sock.makefile("r") as reader:
+                for line in reader:
+                    message = json.loads(line)
+                    if message.get("ok") is False:
+                        raise DaemonError(message["error"])
+                    yield message
+                    if "ok" in message:
+                        return
+        raise DaemonError("The daemon closed the connection")
+
+    def _result(self, op, **fields):
+        for message in self._request(op, **fields):
+            if "ok" in message:
+                return message.get("result")
+
+    def ping(self):
+        return self._result("ping")
+
+    def list(self):
+        """Yield every App in catalog order."""
+        for message in self._request("list"):
+            if "app" in message:
+                yield App.from_dict(message["app"])
+
+    def search(self, term, limit):
+        return [App.from_dict(app) for app in self._result("search", term=term, limit=limit)]
+
+    def detail(self, specs):
+        """Resolve each spec to an App, or None if it is not in the catalog."""
+        return [App.from_dict(app) if app else None for app in self._result("detail", specs=specs)]
+
+    def install(self, specs, password=None, jobs=None, force=False, emit=None):
+        """Install specs in the daemon, forwarding output to emit(stream, line); returns the errors."""
+        for message in self._request("install", specs=specs, password=password, jobs=jobs, force=force):
+            if "line" in message and emit is not None:
+                emit(message["stream"], message["line"])
+            elif "ok" in message:
+                return message["result"]
+
+    def jobs(self):
+        """Return the daemon's install jobs as dicts, oldest first."""
+        return self._result("jobs")
+
+    def cancel(self, job_id):
+        self._result("cancel", job=job_id)
+
+
+def connect(catalog, path=SOCKET_PATH):
+    """Return a Client if a daemon serving catalog is running, else None."""
+    if not os.path.exists(path):
+        return None
+    client = Client(catalog, path)
+    try:
+        client.ping()
+    except (OSError, ValueError, DaemonError) as e:
+        logging.debug(f"Not using the daemon at {path}: {e}")
+        return None
+    return client
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            self.respond()
+        except BrokenPipeError:
+            logging.debug("Client went away")
+
+    def respond(self):
+        if peer_uid(self.connection) != os.getuid():
+            self.send(ok=False, error="Permission denied")
+            return
+        line = self.rfile.readline()
+        if not line:
+            # A liveness probe; see serve()
+            return
+        try:
+            request = json.loads(line)
+            op = request["op"]
+        except (json.JSONDecodeError, KeyError, TypeError):
+            self.send(ok=False, error="Malformed request")
+            return
+        if request.get("catalog") != self.server.catalog:
+            self.send(ok=False, error=f"This daemon serves {self.server.catalog}")
+            return
+        method = getattr(self.server.service, f"do_{op}", None)
+        if method is None:
+            self.send(ok=False, error=f"Unknown request '{op}'")
+            return
+        try:
+            result = method(request, self.send)
+        except (KeyError, TypeError, ValueError) as e:
+            self.send(ok=False, error=str(e))
+        else:
+            self.send(ok=True, result=result)
+
+    def send(self, **message):
+        self.wfile.write((json.dumps(message) + "\n").encode())
+        self.wfile.flush()
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(service, catalog, path=SOCKET_PATH):
+    """Answer requests for catalog with service's do_<op>(request, send) methods.
+
+    Runs until SIGINT or SIGTERM. A stale socket file left by a daemon that
+    died is replaced; a live daemon on path is an error. The socket is only
+    accessible to this user.
+    """
+    if os.path.exists(path):
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.connect(path)
+            raise DaemonError(f"A daemon is already listening on {path}")
+        except ConnectionRefusedError:
+            os.unlink(path)
+
+    umask = os.umask(0o177)
+    try:
+        server = Server(path, Handler)
+    finally:
+        os.umask(umask)
+    server.service = service
+    server.catalog = catalog
+    import signal
+
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    logging.info(f"Serving {catalog} on {path}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
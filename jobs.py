@@ -0,0 +1,384 @@
+import os
+import re
+import time
+import fcntl
+import sqlite3
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+import tracing
+from cache import DownloadCache, parse_wget
+from session import SessionPool
+from state import STATE_DB, InstallState, StepTracker
+from steps import DEFAULT_WORKERS, run_steps
+from transaction import PackageProgress, TimedProgress, classify, plan_transaction
+
+# Install jobs running at once
+MAX_JOBS = 2
+# Held by every cpm process while it runs a step that drives apt or dpkg
+PACKAGE_MANAGER_LOCK = os.path.join(os.path.dirname(os.path.abspath(STATE_DB)), "package-manager.lock")
+PACKAGE_MANAGER_TOOLS = ("apt", "apt-get", "aptitude", "dpkg", "add-apt-repository", "apt-add-repository")
+LOCK_POLL = 0.2
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+
+
+def uses_package_manager(command):
+    """True if command may take the apt/dpkg lock."""
+    if classify(command) is not None:
+        return True
+    words = re.split(r"[\s;&|()`]+", command)
+    return any(os.path.basename(word) in PACKAGE_MANAGER_TOOLS for word in words)
+
+
+def format_seconds(seconds):
+    if seconds < 10:
+        return f"{seconds:.1f}s"
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return f"{seconds}s"
+    minutes, seconds = divmod(seconds, 60)
+    if minutes < 60:
+        return f"{minutes}m{seconds:02d}s"
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m"
+
+
+def estimate_install(apps, workers=DEFAULT_WORKERS, force=False, state=None):
+    """Plan apps without running anything, estimating from the step history.
+
+    Returns (steps, {step index: (seconds, known)}, seconds), the last being
+    the expected run time with workers steps at once. Steps that would be
+    skipped take 0 seconds; known is False for guesses. Invalid install
+    steps raise KeyError, TypeError or ValueError.
+    """
+    steps = plan_transaction(apps)
+    own_state = state is None
+    if own_state:
+        state = InstallState()
+    try:
+        tracker = StepTracker(state, steps, force=force)
+        estimates = {step.index: tracker.estimate(step) for step in steps}
+    finally:
+        if own_state:
+            state.close()
+    timing = TimedProgress(steps, {index: seconds for index, (seconds, _) in estimates.items()}, workers)
+    return steps, estimates, timing.seconds_left()
+
+
+def run_command(command, session, on_line=None):
+    """Run one install step in a ShellSession.
+
+    Returns (error, seconds); error is None on success. Output is streamed
+    to on_line(stream, line) and the error message carries the last lines
+    of output. Plain `wget URL` steps are served through the download
+    cache, relative to the session's working directory. While tracing,
+    the exit code, output bytes and shell CPU time go on the current span.
+    """
+    download = parse_wget(command)
+    if download is not None:
+        url, dest = download
+        start = time.perf_counter()
+        try:
+            DownloadCache().fetch(url, os.path.join(session.cwd, dest), on_line=on_line)
+        except (OSError, ValueError) as e:
+            return f"Command '{command}' failed: {e}", time.perf_counter() - start
+        return None, time.perf_counter() - start
+
+    if tracing.enabled():
+        output = [0]
+
+        def counted(stream, line):
+            output[0] += len(line) + 1
+            if on_line is not None:
+                on_line(stream, line)
+
+        cpu = session.cpu_time() or 0.0
+        returncode, tail, seconds = session.run(command, counted)
+        after = session.cpu_time()
+        tracing.annotate(exit=returncode, bytes=output[0],
+                         shell_cpu=None if after is None else max(0.0, after - cpu))
+    else:
+        returncode, tail, seconds = session.run(command, on_line)
+    if returncode != 0:
+        return f"Command '{command}' failed: " + "\n".join(tail).strip(), seconds
+    return None, seconds
+
+
+def run_step(step, sessions, on_line=None, tracker=None):
+    """Run one planned Step in its session from a SessionPool.
+
+    Records the step's duration in step.seconds. With a StepTracker, a step
+    that is already satisfied is skipped (step.skipped) and the others are
+    recorded. Errors name the packages the step belongs to.
+    """
+    with tracing.span("step", "step", command=step.command, packages=list(step.packages)) as span:
+        session = sessions.session_for(step)
+        if tracker is not None:
+            cwd = tracker.satisfied(step)
+            if cwd is not None:
+                session.chdir(cwd)
+                step.seconds, step.skipped = 0.0, True
+                span.set(skipped=True)
+                return None
+        error, step.seconds = run_command(step.command, session, on_line)
+        if tracker is not None:
+            tracker.done(step, error, session.cwd)
+        span.set(failed=bool(error))
+    return step_error(step, error)
+
+
+def step_error(step, error):
+    if error and step.packages:
+        return f"[{', '.join(step.packages)}] {error}"
+    return error
+
+
+class Job:
+    """One install transaction in a JobQueue.
+
+    status goes from "queued" to "running" and ends as "done", "failed" or
+    "cancelled". progress is the share of the expected run time done, in
+    percent, and packages the same for each package label by finished
+    steps; seconds_left() is the expected time left. The callbacks run on the
+    job's thread and get the job first: on_output(job, stream, line),
+    on_start(job, step), on_step(job, step, error, {label: percent}) for
+    the packages of a finished step, and on_change(job) whenever status or
+    progress changes.
+    """
+
+    def __init__(self, job_id, apps, steps, password=None, force=False,
+                 on_output=None, on_start=None, on_step=None, on_change=None):
+        self.id = job_id
+        self.apps = apps
+        self.steps = steps
+        self.password = password
+        self.force = force
+        self.on_output = on_output
+        self.on_start = on_start
+        self.on_step = on_step
+        self.on_change = on_change
+        self.status = QUEUED
+        self.timing = None
+        self.packages = {app.label: 0 for app in apps}
+        self.errors = []
+        self.workers = DEFAULT_WORKERS
+        self.sessions = None
+        self.cancelled = threading.Event()
+        self.finished = threading.Event()
+
+    @property
+    def label(self):
+        return ", ".join(app.label for app in self.apps)
+
+    @property
+    def progress(self):
+        if self.status in (DONE, FAILED):
+            return 100
+        return 0 if self.timing is None else int(self.timing.fraction() * 100)
+
+    def seconds_left(self):
+        """Expected seconds until the job ends, or None before it started."""
+        if self.finished.is_set():
+            return 0.0
+        return None if self.timing is None else self.timing.seconds_left()
+
+    def to_dict(self):
+        return {"id": self.id, "packages": list(self.packages), "status": self.status,
+                "progress": self.progress, "seconds_left": self.seconds_left(), "errors": self.errors}
+
+    def wait(self, timeout=None):
+        """Block until the job ends; returns False on timeout."""
+        return self.finished.wait(timeout)
+
+    def output(self, stream, line):
+        if self.on_output is not None:
+            self.on_output(self, stream, line)
+
+    def set_status(self, status):
+        self.status = status
+        if status in (DONE, FAILED, CANCELLED):
+            self.finished.set()
+        if self.on_change is not None:
+            self.on_change(self)
+
+    def start_step(self, step):
+        self.timing.start(step)
+        if self.on_start is not None:
+            self.on_start(self, step)
+
+    def step_done(self, step, error, percents):
+        self.timing.done(step)
+        self.packages.update(percents)
+        if self.on_step is not None:
+            self.on_step(self, step, error, percents)
+        if self.on_change is not None:
+            self.on_change(self)
+
+
+class JobQueue:
+    """Runs install jobs on background threads, at most max_jobs at a time.
+
+    Jobs start in the order they were submitted. Within a job, steps run
+    as run_steps allows with up to workers at once. Steps that drive apt
+    or dpkg hold the package manager lock, a file lock shared with other
+    cpm processes, so only one runs at a time on this host while the
+    downloads and builds of other jobs carry on. state is an open
+    InstallState shared by the jobs; by default each job opens its own.
+    """
+
+    def __init__(self, max_jobs=MAX_JOBS, workers=DEFAULT_WORKERS, state=None, lock_path=PACKAGE_MANAGER_LOCK):
+        self.max_jobs = max(1, max_jobs)
+        self.workers = workers
+        self.state = state
+        self.lock_path = lock_path
+        self.lock = threading.Lock()
+        self.package_lock = threading.Lock()
+        self.jobs = {}
+        self.queued = deque()
+        self.running = 0
+        self.next_id = 1
+
+    def submit(self, apps, password=None, force=False, workers=None, **callbacks):
+        """Plan apps as one transaction and queue it; returns the Job.
+
+        workers overrides the queue's steps at once for this job. Invalid
+        install steps raise KeyError, TypeError or ValueError here, before
+        anything is queued.
+        """
+        steps = plan_transaction(apps)
+        with self.lock:
+            job = Job(self.next_id, apps, steps, password, force, **callbacks)
+            job.workers = workers or self.workers
+            self.next_id += 1
+            self.jobs[job.id] = job
+        job.set_status(QUEUED)
+        with self.lock:
+            self.queued.append(job)
+        self._start_ready()
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    def active(self):
+        """True while a job is queued or running."""
+        return any(not job.finished.is_set() for job in self.list())
+
+    def cancel(self, job_id):
+        """Cancel a queued or running job; returns False if there is none.
+
+        A queued job is dropped. A running job starts no further steps and
+        the shells of its running steps are terminated.
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.finished.is_set():
+                return False
+            job.cancelled.set()
+            dropped = job in self.queued
+            if dropped:
+                self.queued.remove(job)
+        if dropped:
+            job.errors.append(f"Install job {job.id} was cancelled")
+            job.set_status(CANCELLED)
+        elif job.sessions is not None:
+            job.sessions.terminate()
+        return True
+
+    def cancel_all(self):
+        for job in self.list():
+            self.cancel(job.id)
+
+    def _start_ready(self):
+        with self.lock:
+            while self.queued and self.running < self.max_jobs:
+                job = self.queued.popleft()
+                self.running += 1
+                threading.Thread(target=self._run, args=(job,), name=f"cpm-job-{job.id}", daemon=True).start()
+
+    @contextmanager
+    def _package_manager(self, job):
+        """Hold the package manager lock; yields False if job was cancelled while waiting.
+
+        Jobs of this queue wait on a thread lock, so the next one starts as
+        soon as it is released; other processes are polled for.
+        """
+        while not self.package_lock.acquire(timeout=LOCK_POLL):
+            if job.cancelled.is_set():
+                yield False
+                return
+        try:
+            os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+            with open(self.lock_path, "a") as lock:
+                while True:
+                    try:
+                        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        if job.cancelled.wait(LOCK_POLL):
+                            yield False
+                            return
+                try:
+                    yield True
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+        finally:
+            self.package_lock.release()
+
+    def _execute(self, job, step, tracker):
+        cancelled = step_error(step, f"Cancelled: {step.command}")
+        if job.cancelled.is_set():
+            return cancelled
+        if not uses_package_manager(step.command):
+            return run_step(step, job.sessions, job.output, tracker)
+        with self._package_manager(job) as acquired:
+            if not acquired or job.cancelled.is_set():
+                return cancelled
+            return run_step(step, job.sessions, job.output, tracker)
+
+    def _run(self, job):
+        job.sessions = SessionPool(job.password)
+        state = self.state
+        try:
+            if state is None:
+                state = InstallState()
+            tracker = StepTracker(state, job.steps, force=job.force)
+            estimates = {step.index: tracker.estimate(step)[0] for step in job.steps}
+            tracker.begin()
+            job.timing = TimedProgress(job.steps, estimates, job.workers)
+            progress = PackageProgress(job.steps, estimates)
+            job.set_status(RUNNING)
+            with tracing.span("install", "step", job=job.id, packages=list(job.packages)) as span:
+                job.errors = run_steps(
+                    job.steps, lambda step: self._execute(job, step, tracker), workers=job.workers,
+                    on_start=job.start_step,
+                    on_done=lambda step, error, finished, total: job.step_done(
+                        step, error, progress.step_done(step)
+                    ),
+                )
+                span.set(steps=len(job.steps), errors=len(job.errors))
+            if not job.cancelled.is_set():
+                tracker.finish(job.apps)
+        except (OSError, sqlite3.Error) as e:
+            logging.error(f"Install job {job.id} failed: {e}")
+            job.errors.append(f"Install job failed: {e}")
+        finally:
+            job.sessions.close()
+            if self.state is None and state is not None:
+                state.close()
+            with self.lock:
+                self.running -= 1
+            if job.cancelled.is_set():
+                job.errors.insert(0, f"Install job {job.id} was cancelled")
+                job.set_status(CANCELLED)
+            else:
+                job.set_status(FAILED if job.errors else DONE)
+            self._start_ready()
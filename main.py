@@ -2,20 +2,9 @@
 import sys
 import os
 import logging
-import subprocess
-import json
-import argparse
-import getpass
-import shlex
 import base64
-from PyQt5.QtWidgets import (
-    QApplication, QWidget, QLabel, QLineEdit, QListWidget,
-    QPushButton, QVBoxLayout, QHBoxLayout, QMessageBox, QInputDialog,
-    QCheckBox, QProgressBar, QTextEdit
-)
-from PyQt5.QtCore import Qt, QThread, pyqtSignal
 
-# Easter egg check - must be first executable code after imports
+# Easter egg check - must be first executable code after the stdlib imports
 if len(sys.argv) > 1 and sys.argv[1] == "moo":
     CHICKEN_CODE = b"""
 ZGVmIGNoaWNrZW5fbW9vKCk6CiAgICBwcmludCgiIiIKICAgICAgIF8gIAogICAgICB7bz4KICAgICAg
@@ -31,114 +20,121 @@ Y2hpY2tlbl9tb28oKQ==
         print("Egg cracked!", e)
     sys.exit(0)
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+# CLI mode must not pay for importing Qt or DEBUG logging
+if __name__ == "__main__" and "--cli" in sys.argv:
+    sys.argv.remove("--cli")
+    from cpm import cli_main
+    cli_main()
+    sys.exit(0)
 
-PKG_FILE = "pkg.cpm"
-APP_FILE = "app.txt"
-THEME_FILE = ".theme.cfg"
+from PyQt5.QtWidgets import (
+    QApplication, QWidget, QLabel, QLineEdit, QListView,
+    QPushButton, QVBoxLayout, QHBoxLayout, QMessageBox, QInputDialog,
+    QCheckBox, QProgressBar, QTextEdit, QPlainTextEdit, QAbstractItemView, QListWidget,
+    QListWidgetItem
+)
+from PyQt5.QtCore import Qt, QObject, QTimer, pyqtSignal
+from cpm import catalog_files, iter_apps, requires_sudo
+from steps import DEFAULT_WORKERS
+from jobs import DONE, FAILED, RUNNING, JobQueue, format_seconds
+from stream import TAIL_LINES
+from storage import FileWatcher
+from applist import AppListModel, AppFilter, CatalogLoader
+from catalog import CatalogStore
+import tracing
 
-def convert_app_txt_to_pkg_cpm():
-    try:
-        if os.path.exists(APP_FILE):
-            logging.info(f"Converting {APP_FILE} to {PKG_FILE}.")
-            apps = []
-            with open(APP_FILE, "r") as file:
-                app_name, version, commands, description = None, None, [], ""
-                for line in file:
-                    line = line.strip()
-                    if line.startswith("Commands:"):
-                        commands.extend(line.split(": ")[1].split(", "))
-                    elif line.startswith("Description:"):
-                        description = line.split(": ", 1)[1]
-                    elif line.startswith("App"):
-                        if app_name and version and commands:
-                            apps.append({
-                                "name": app_name,
-                                "version": version,
-                                "commands": commands,
-                                "description": description
-                            })
-                        parts = line.split()
-                        app_name, version = parts[1], parts[2]
-                        commands, description = [], ""
-                if app_name and version and commands:
-                    apps.append({
-                        "name": app_name,
-                        "version": version,
-                        "commands": commands,
-                        "description": description
-                    })
-            with open(PKG_FILE, "w") as pkg_file:
-                json.dump(apps, pkg_file, indent=4)
-            os.remove(APP_FILE)
-            logging.info(f"Converted {APP_FILE} to {PKG_FILE} successfully.")
-    except Exception as e:
-        logging.error(f"Error converting {APP_FILE} to {PKG_FILE}: {e}")
+# Configure logging
+logging.basicConfig(level=tracing.LOG_LEVEL)
 
-def load_apps():
-    try:
-        convert_app_txt_to_pkg_cpm()
-
-        if not os.path.exists(PKG_FILE):
-            logging.error("No package file found!")
-            if QApplication.instance() is not None:
-                QMessageBox.critical(None, "Error", "No package file found!")
-            return []
-
-        logging.info(f"Loading app list from: {PKG_FILE}")
-        with open(PKG_FILE, "r") as file:
-            return json.load(file)
-    except FileNotFoundError:
-        logging.error("Package file not found!")
-        if QApplication.instance() is not None:
-            QMessageBox.critical(None, "Error", "Package file not found!")
-        return []
-    except json.JSONDecodeError as e:
-        logging.error(f"Error parsing {PKG_FILE}: {e}")
-        if QApplication.instance() is not None:
-            QMessageBox.critical(None, "Error", f"Error parsing {PKG_FILE}: {e}")
-        return []
-
-class CommandRunner(QThread):
+THEME_FILE = ".theme.cfg"
+# Lines of live install output kept in the output box
+OUTPUT_LINES = 20 * TAIL_LINES
+# How often the catalog files are checked for changes
+WATCH_MS = 2000
+# How often the progress of running install jobs is redrawn
+PROGRESS_MS = 1000
+
+def code_files():
+    """The source files of the modules this program has loaded."""
+    root = os.path.dirname(os.path.abspath(__file__))
+    paths = {os.path.abspath(sys.argv[0])}
+    for module in list(sys.modules.values()):
+        path = getattr(module, "__file__", None)
+        if path and path.endswith(".py") and os.path.dirname(os.path.abspath(path)) == root:
+            paths.add(os.path.abspath(path))
+    return sorted(paths)
+
+def show_load_error(message):
+    if QApplication.instance() is not None:
+        QMessageBox.critical(None, "Error", message)
+
+class CommandRunner(QObject):
+    """Qt signals for one install job in a JobQueue.
+
+    The queue calls back on the job's thread; the signals hand the updates
+    to the GUI thread.
+    """
     progress = pyqtSignal(int)
+    package_progress = pyqtSignal(str, int)
+    output = pyqtSignal(str, str)
+    changed = pyqtSignal()
     error_signal = pyqtSignal(list)
     success_signal = pyqtSignal()
 
-    def __init__(self, commands, password=None):
-        super().__init__()
-        self.commands = commands
+    def __init__(self, queue, apps, password=None, workers=DEFAULT_WORKERS, force=False, parent=None):
+        super().__init__(parent)
+        self.queue = queue
+        self.apps = apps
         self.password = password
-
-    def run(self):
-        errors = []
-        for index, command in enumerate(self.commands):
-            try:
-                if command.startswith("sudo "):
-                    full_command = f"echo {self.password} | sudo -S {command[5:]}"
-                    logging.debug(f"Running with sudo: {full_command}")
-                else:
-                    full_command = command
-                    logging.debug(f"Running: {full_command}")
-
-                subprocess.run(full_command, shell=True, check=True, stderr=subprocess.PIPE)
-
-            except subprocess.CalledProcessError as e:
-                error_message = f"Command '{command}' failed: {e.stderr.decode().strip()}"
-                logging.error(error_message)
-                errors.append(error_message)
-
-            self.progress.emit(int((index + 1) / len(self.commands) * 100))
-
-        if errors:
-            self.error_signal.emit(errors)
-        else:
+        self.workers = workers
+        self.force = force
+        self.job = None
+
+    def start(self):
+        """Queue the job; returns False if its install steps are invalid."""
+        try:
+            self.job = self.queue.submit(
+                self.apps, self.password, self.force, workers=self.workers,
+                on_output=self.job_output, on_start=self.step_started, on_step=self.step_done,
+                on_change=self.job_changed,
+            )
+        except (KeyError, TypeError, ValueError) as e:
+            self.error_signal.emit([f"Invalid install steps: {e}"])
+            return False
+        return True
+
+    def cancel(self):
+        if self.job is not None:
+            self.queue.cancel(self.job.id)
+
+    def job_output(self, job, stream, line):
+        self.output.emit(stream, line)
+
+    def step_started(self, job, step):
+        logging.debug(f"Running: {step.command}")
+
+    def step_done(self, job, step, error, percents):
+        if step.skipped:
+            self.output.emit("stdout", f"Already done: {step.command}")
+        if error:
+            logging.error(error)
+        for label, percent in percents.items():
+            self.package_progress.emit(label, percent)
+        self.progress.emit(job.progress)
+
+    def job_changed(self, job):
+        self.changed.emit()
+        if job.status == FAILED:
+            self.error_signal.emit(job.errors)
+        elif job.status == DONE:
             self.success_signal.emit()
 
 class AppInstaller(QWidget):
     def __init__(self):
         super().__init__()
-        self.apps = load_apps()
+        self.apps = CatalogStore()
+        self.job_queue = JobQueue()
+        self.runners = {}
         self.dark_mode = self.load_theme_setting()
         self.init_ui()
 
@@ -153,9 +149,14 @@ class AppInstaller(QWidget):
         search_layout.addWidget(self.search_entry)
         layout.addLayout(search_layout)
 
-        self.app_list = QListWidget()
-        self.app_list.itemClicked.connect(self.show_details)
+        self.app_model = AppListModel(self.app_label, self)
+        self.app_list = QListView()
+        self.app_list.setUniformItemSizes(True)
+        self.app_list.setModel(self.app_model)
+        self.app_list.setSelectionMode(QAbstractItemView.ExtendedSelection)
+        self.app_list.clicked.connect(self.show_details)
         layout.addWidget(self.app_list)
+        self.app_filter = AppFilter(self.apps.index, self.app_model, self.app_list, parent=self)
 
         self.details_box = QTextEdit()
         self.details_box.setReadOnly(True)
@@ -166,11 +167,31 @@ class AppInstaller(QWidget):
         self.progress_bar.hide()
         layout.addWidget(self.progress_bar)
 
+        self.output_box = QPlainTextEdit()
+        self.output_box.setReadOnly(True)
+        self.output_box.setMaximumBlockCount(OUTPUT_LINES)
+        self.output_box.hide()
+        layout.addWidget(self.output_box)
+
+        self.job_list = QListWidget()
+        self.job_list.setMaximumHeight(100)
+        self.job_list.hide()
+        layout.addWidget(self.job_list)
+
         button_layout = QHBoxLayout()
         self.install_button = QPushButton("Install")
         self.install_button.clicked.connect(self.on_install)
         button_layout.addWidget(self.install_button)
 
+        self.force_toggle = QCheckBox("Force")
+        self.force_toggle.setToolTip("Run every install step, even ones already done")
+        button_layout.addWidget(self.force_toggle)
+
+        self.cancel_button = QPushButton("Cancel Job")
+        self.cancel_button.clicked.connect(self.on_cancel)
+        self.cancel_button.hide()
+        button_layout.addWidget(self.cancel_button)
+
         self.theme_toggle = QCheckBox("Dark Mode")
         self.theme_toggle.setChecked(self.dark_mode)
         self.theme_toggle.stateChanged.connect(self.toggle_theme)
@@ -185,65 +206,214 @@ class AppInstaller(QWidget):
 
         self.apply_theme()
         self.show()
-        self.filter_apps()
+        self.app_filter.refresh()
+
+        self.code_watcher = FileWatcher(code_files())
+        self.catalog_watcher = FileWatcher(catalog_files())
+        self.reloaded = None
+        self.reload_pending = False
+        self.loader = CatalogLoader(iter_apps, parent=self)
+        self.loader.batch.connect(self.add_apps)
+        self.loader.error.connect(show_load_error)
+        self.loader.finished.connect(self.catalog_loaded)
+        self.loader.start()
+
+        self.watch_timer = QTimer(self)
+        self.watch_timer.setInterval(WATCH_MS)
+        self.watch_timer.timeout.connect(self.check_catalog)
+        self.watch_timer.start()
+
+        self.package_text = ""
+        self.progress_timer = QTimer(self)
+        self.progress_timer.setInterval(PROGRESS_MS)
+        self.progress_timer.timeout.connect(self.refresh_jobs)
+
+    def add_apps(self, apps):
+        """Add a batch of records from the catalog loader and refilter."""
+        for app in apps:
+            self.apps.add(app)
+        self.app_filter.refresh()
+
+    def check_catalog(self):
+        """Reload the catalog if one of its files changed."""
+        if self.catalog_watcher.changed():
+            self.reload_catalog()
+
+    def reload_catalog(self):
+        """Read the catalog again in the background and swap it in when complete."""
+        if self.loader.isRunning():
+            self.reload_pending = True
+            return
+        self.reload_pending = False
+        self.reloaded = CatalogStore()
+        self.loader = CatalogLoader(iter_apps, parent=self)
+        self.loader.batch.connect(self.reloaded_apps)
+        self.loader.error.connect(self.reload_failed)
+        self.loader.finished.connect(self.catalog_loaded)
+        self.loader.start()
+
+    def reloaded_apps(self, apps):
+        # The loader still hands over what it read before an error
+        if self.reloaded is None:
+            return
+        for app in apps:
+            self.reloaded.add(app)
+
+    def reload_failed(self, message):
+        logging.error(f"Keeping the loaded catalog: {message}")
+        self.reloaded = None
+
+    def catalog_loaded(self):
+        if self.reloaded is not None:
+            self.swap_catalog(self.reloaded)
+            self.reloaded = None
+        if self.reload_pending:
+            self.reload_catalog()
+
+    def swap_catalog(self, apps):
+        """Show apps in place of the loaded catalog, keeping the search and selection."""
+        def new_id(app_id):
+            return apps.by_key.get(self.apps[app_id].key)
+
+        selection = self.app_list.selectionModel()
+        selected = [new_id(self.app_model.app_id(index)) for index in selection.selectedIndexes()]
+        current = self.app_model.app_id(self.app_list.currentIndex())
+        current = None if current is None else new_id(current)
+        rows = [app_id for app_id in map(new_id, self.app_model.rows) if app_id is not None]
+
+        self.apps = apps
+        self.app_filter.set_index(apps.index)
+        self.app_filter.set_rows(rows, selected, current)
+        self.app_filter.refresh()
+        if current is not None:
+            self.show_details(self.app_model.index_of(current))
+        logging.info(f"Reloaded {len(apps)} packages")
+
+    def app_label(self, app_id):
+        return self.apps[app_id].label
 
     def filter_apps(self):
-        search_term = self.search_entry.text().lower()
-        self.app_list.clear()
-        for app in self.apps:
-            if search_term in app["name"].lower() or search_term in app["description"].lower():
-                self.app_list.addItem(f"{app['name']} {app['version']}")
-
-    def show_details(self, item):
-        app_name = item.text()
-        for app in self.apps:
-            full_name = f"{app['name']} {app['version']}"
-            if full_name == app_name:
-                self.details_box.setText(f"Name: {app['name']}\nVersion: {app['version']}\n\nDescription:\n{app['description']}")
+        self.app_filter.schedule(self.search_entry.text())
+
+    def show_details(self, index):
+        app_id = self.app_model.app_id(index)
+        if app_id is not None:
+            app = self.apps[app_id]
+            self.details_box.setText(f"Name: {app.name}\nVersion: {app.version}\n\nDescription:\n{app.description}")
 
     def on_install(self):
-        selected_item = self.app_list.currentItem()
-        if selected_item:
-            app_name = selected_item.text()
-            for app in self.apps:
-                full_name = f"{app['name']} {app['version']}"
-                if full_name == app_name:
-                    requires_sudo = any(cmd.startswith("sudo ") for cmd in app['commands'])
-                    password = None
-
-                    if requires_sudo:
-                        password, ok = QInputDialog.getText(
-                            self, "Sudo Password", "Enter your sudo password:", QLineEdit.Password
-                        )
-                        if not ok or not password:
-                            QMessageBox.warning(self, "Cancelled", "Installation cancelled.")
-                            return
-
-                    self.install_button.setEnabled(False)
-                    self.progress_bar.show()
-
-                    self.runner = CommandRunner(app['commands'], password)
-                    self.runner.progress.connect(self.progress_bar.setValue)
-                    self.runner.error_signal.connect(self.on_errors)
-                    self.runner.success_signal.connect(self.on_success)
-                    self.runner.start()
-                    return
-        else:
+        selected_ids = sorted(
+            self.app_model.app_id(index) for index in self.app_list.selectionModel().selectedIndexes()
+        )
+        selected_apps = [self.apps[app_id] for app_id in selected_ids]
+        if not selected_apps:
             QMessageBox.critical(self, "Error", "Please select an app to install.")
+            return
+
+        password = None
+        if any(requires_sudo(app.commands) for app in selected_apps):
+            password, ok = QInputDialog.getText(
+                self, "Sudo Password", "Enter your sudo password:", QLineEdit.Password
+            )
+            if not ok or not password:
+                QMessageBox.warning(self, "Cancelled", "Installation cancelled.")
+                return
+
+        runner = CommandRunner(
+            self.job_queue, selected_apps, password, force=self.force_toggle.isChecked(), parent=self
+        )
+        runner.package_progress.connect(self.show_package_progress)
+        runner.output.connect(lambda stream, line: self.show_output(runner, line))
+        runner.changed.connect(lambda: self.show_job(runner))
+        runner.error_signal.connect(self.on_errors)
+        runner.success_signal.connect(self.on_success)
+        if not runner.start():
+            return
+
+        if not self.runners:
+            self.output_box.clear()
+        self.runners[runner.job.id] = runner
+        item = QListWidgetItem()
+        item.setData(Qt.UserRole, runner.job.id)
+        self.job_list.addItem(item)
+        self.job_list.setCurrentItem(item)
+        self.show_job(runner)
+        self.progress_bar.show()
+        self.progress_timer.start()
+        self.output_box.show()
+        self.job_list.show()
+        self.cancel_button.show()
+
+    def job_item(self, job_id):
+        for row in range(self.job_list.count()):
+            item = self.job_list.item(row)
+            if item.data(Qt.UserRole) == job_id:
+                return item
+        return None
+
+    def show_job(self, runner):
+        """Refresh a job's line in the job list and the overall progress bar."""
+        job = runner.job
+        item = self.job_item(job.id) if job is not None else None
+        if item is None:
+            return
+        left = job.seconds_left()
+        eta = f", about {format_seconds(left)} left" if left else ""
+        item.setText(f"#{job.id} {job.label} - {job.status} {job.progress}%{eta}")
+        self.show_progress()
+
+    def show_progress(self):
+        """Show the mean progress of the active jobs and when the last should end."""
+        active = [runner.job for runner in self.runners.values() if not runner.job.finished.is_set()]
+        if not active:
+            self.progress_timer.stop()
+            self.progress_bar.hide()
+            return
+        self.progress_bar.setValue(sum(job.progress for job in active) // len(active))
+        left = max((job.seconds_left() or 0.0) for job in active)
+        eta = f" - about {format_seconds(left)} left" if left else ""
+        self.progress_bar.setFormat(f"%p%{self.package_text}{eta}")
+
+    def refresh_jobs(self):
+        """Move the progress of running jobs along between their steps."""
+        for runner in self.runners.values():
+            if runner.job.status == RUNNING:
+                self.show_job(runner)
+
+    def on_cancel(self):
+        item = self.job_list.currentItem()
+        runner = item and self.runners.get(item.data(Qt.UserRole))
+        if runner is not None:
+            runner.cancel()
+
+    def show_package_progress(self, label, percent):
+        self.package_text = f" ({label}: {percent}%)"
+        self.show_progress()
+
+    def show_output(self, runner, line):
+        if len(self.runners) > 1:
+            line = f"[#{runner.job.id}] {line}"
+        self.output_box.appendPlainText(line)
 
     def on_errors(self, errors):
-        self.install_button.setEnabled(True)
-        self.progress_bar.hide()
         QMessageBox.warning(
             self, "Installation Completed with Errors",
             "Installation completed, but some commands failed:\n" + "\n".join(errors)
         )
 
     def on_success(self):
-        self.install_button.setEnabled(True)
-        self.progress_bar.hide()
         QMessageBox.information(self, "Installation", "Installation completed successfully!")
-        os.execv(sys.argv[0], sys.argv)
+        # Restarting would end the jobs still queued or running
+        if self.job_queue.active():
+            return
+        if self.code_watcher.changed():
+            tracing.save()
+            os.execv(sys.argv[0], sys.argv)
+        self.check_catalog()
+
+    def closeEvent(self, event):
+        self.job_queue.cancel_all()
+        super().closeEvent(event)
 
     def toggle_theme(self):
         self.dark_mode = self.theme_toggle.isChecked()
@@ -255,13 +425,13 @@ class AppInstaller(QWidget):
             self.setStyleSheet("""
                 QWidget { background-color: #2e2e2e; color: white; }
                 QPushButton { background-color: #1e1e1e; color: white; }
-                QLineEdit, QListWidget, QProgressBar, QTextEdit { background-color: #444; color: white; }
+                QLineEdit, QListView, QProgressBar, QTextEdit, QPlainTextEdit { background-color: #444; color: white; }
             """)
         else:
             self.setStyleSheet("""
                 QWidget { background-color: white; color: black; }
                 QPushButton { background-color: #2ecc71; color: white; }
-                QLineEdit, QListWidget, QProgressBar, QTextEdit { background-color: #fff; color: black; }
+                QLineEdit, QListView, QProgressBar, QTextEdit, QPlainTextEdit { background-color: #fff; color: black; }
             """)
 
     def save_theme_setting(self):
@@ -274,78 +444,13 @@ class AppInstaller(QWidget):
                 return file.read().strip() == "dark"
         return False
 
-def cli_main():
-    parser = argparse.ArgumentParser(description='Chilly Package Manager CLI')
-    parser.add_argument('--list', action='store_true', help='List all available packages')
-    parser.add_argument('--search', type=str, help='Search for packages by name or description')
-    parser.add_argument('--install', type=str, help='Install a package by name and version')
-    args = parser.parse_args()
-
-    apps = load_apps()
-
-    if args.list:
-        print("Available packages:")
-        for app in apps:
-            print(f"{app['name']} {app['version']} - {app['description']}")
-    elif args.search:
-        term = args.search.lower()
-        found = [app for app in apps if term in app['name'].lower() or term in app['description'].lower()]
-        if found:
-            print(f"Found {len(found)} packages matching '{args.search}':")
-            for app in found:
-                print(f"{app['name']} {app['version']} - {app['description']}")
-        else:
-            print(f"No packages found matching '{args.search}'.")
-    elif args.install:
-        app_name_version = args.install
-        target_app = next((app for app in apps if f"{app['name']} {app['version']}" == app_name_version), None)
-        if not target_app:
-            print(f"Error: Package '{app_name_version}' not found.")
-            sys.exit(1)
-        
-        requires_sudo = any(cmd.startswith("sudo ") for cmd in target_app['commands'])
-        password = None
-        if requires_sudo:
-            password = getpass.getpass("Enter your sudo password: ")
-            if not password:
-                print("Installation cancelled.")
-                sys.exit(1)
-        
-        total = len(target_app['commands'])
-        errors = []
-        for idx, cmd in enumerate(target_app['commands'], 1):
-            progress = int((idx / total) * 100)
-            print(f"Progress: {progress}% - Executing: {cmd}")
-            
-            if cmd.startswith("sudo ") and password:
-                full_cmd = f"echo {shlex.quote(password)} | sudo -S {cmd[5:]}"
-            else:
-                full_cmd = cmd
-            
-            try:
-                subprocess.run(full_cmd, shell=True, check=True, stderr=subprocess.PIPE)
-            except subprocess.CalledProcessError as e:
-                errors.append(f"Command '{cmd}' failed: {e.stderr.decode().strip()}")
-        
-        if errors:
-            print("Errors occurred:")
-            for error in errors:
-                print(f"  - {error}")
-            sys.exit(1)
-        else:
-            print("Installation successful!")
-            sys.exit(0)
-    else:
-        parser.print_help()
-
 if __name__ == "__main__":
-    if "--cli" in sys.argv:
-        sys.argv.remove("--cli")
-        cli_main()
-    else:
-        app = QApplication(sys.argv)
-        installer = AppInstaller()
-        sys.exit(app.exec_())
+    if "--profile" in sys.argv:
+        position = sys.argv.index("--profile") + 1
+        tracing.enable(sys.argv[position] if position < len(sys.argv) else "cpm-trace.json")
+    app = QApplication(sys.argv)
+    installer = AppInstaller()
+    sys.exit(app.exec_())
 # End of the script
 
 # Chilly Package Manager (CPM)
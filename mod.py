@@ -1,27 +1,58 @@
 import sys
 import os
-import logging
 import json
-import tempfile
-import shutil
+import logging
 from PyQt5.QtWidgets import (
-    QApplication, QWidget, QLabel, QLineEdit, QListWidget,
+    QApplication, QWidget, QLabel, QLineEdit, QListView,
     QPushButton, QVBoxLayout, QHBoxLayout, QMessageBox,
     QTextEdit, QCheckBox
 )
 from PyQt5.QtCore import Qt
+from catalog import App, CatalogStore
+from storage import CatalogFile
+from appfile import parse_commands
+from steps import parse_steps
+from applist import AppListModel, AppFilter
+import tracing
 
 # Configure logging
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=tracing.LOG_LEVEL)
+
+
+def commands_text(commands):
+    """The editor text of commands: one per line, or a JSON list where lines cannot hold them."""
+    plain = all(
+        isinstance(command, str) and command.strip() and command == command.strip() and "\n" not in command
+        for command in commands
+    ) and not (commands and commands[0].startswith("["))
+    return "\n".join(commands) if plain else json.dumps(commands, indent=2)
+
+
+def parse_commands_text(text):
+    """Commands from editor text; raises ValueError if a JSON list is malformed."""
+    text = text.strip()
+    if text.startswith("["):
+        try:
+            commands = parse_commands(text)
+        except json.JSONDecodeError:
+            # Not JSON after all, e.g. a `[ -f file ]` test
+            commands = None
+        if commands is not None:
+            parse_steps(commands)
+            return commands
+    return [line.strip() for line in text.splitlines() if line.strip()]
+
 
 class AppGenerator(QWidget):
     def __init__(self):
         super().__init__()
         self.original_pkg_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pkg.cpm")
-        self.temp_dir = tempfile.mkdtemp()
-        self.temp_app_path = os.path.join(self.temp_dir, "app.txt")
+        self.catalog = CatalogFile(self.original_pkg_path)
+        # Edits not yet saved: {(name, version): app dict, or None if removed}
+        self.changes = {}
+        self.compaction = None
 
-        self.apps = self.load_apps()
+        self.apps = CatalogStore(self.load_apps(), search_fields=self.search_fields)
         self.init_ui()
 
     def init_ui(self):
@@ -37,9 +68,13 @@ class AppGenerator(QWidget):
         layout.addLayout(search_layout)
 
         # App List
-        self.app_list = QListWidget()
-        self.app_list.itemSelectionChanged.connect(self.load_app_details)
+        self.app_model = AppListModel(self.app_label, self)
+        self.app_list = QListView()
+        self.app_list.setUniformItemSizes(True)
+        self.app_list.setModel(self.app_model)
+        self.app_list.selectionModel().currentChanged.connect(self.load_app_details)
         layout.addWidget(self.app_list)
+        self.app_filter = AppFilter(self.apps.index, self.app_model, self.app_list, parent=self)
 
         # App Details (Name, Version, Commands, Description)
         self.app_name_input = QLineEdit()
@@ -51,7 +86,7 @@ class AppGenerator(QWidget):
         layout.addWidget(self.version_input)
 
         self.commands_input = QTextEdit()
-        self.commands_input.setPlaceholderText("Enter commands separated by commas")
+        self.commands_input.setPlaceholderText("Enter one command per line, or a JSON list for step objects")
         layout.addWidget(self.commands_input)
 
         self.description_input = QTextEdit()
@@ -83,132 +118,145 @@ class AppGenerator(QWidget):
         self.setWindowTitle("App Generator")
         self.setMinimumWidth(500)
         self.setStyleSheet(
-            "QListWidget::item:selected { background-color: #3498db; color: white; }"
+            "QListView::item:selected { background-color: #3498db; color: white; }"
             "QPushButton { background-color: #2ecc71; color: white; border: none; padding: 10px; border-radius: 5px; }"
             "QPushButton:hover { background-color: #27ae60; }"
             "QLineEdit, QTextEdit { border: 1px solid #ccc; border-radius: 5px; padding: 5px; }"
         )
-        self.filter_apps()
+        self.app_filter.refresh()
 
     def load_apps(self):
-        """Load the apps from pkg.cpm into a list."""
+        """Load the apps from pkg.cpm and its edit journal into a list."""
         if not os.path.exists(self.original_pkg_path):
             QMessageBox.critical(self, "Error", "pkg.cpm file not found!")
             return []
 
-        # Convert pkg.cpm to app.txt in a temporary folder
         try:
-            with open(self.original_pkg_path, "r") as file:
-                data = json.load(file)
-
-            apps = []
-            with open(self.temp_app_path, "w") as temp_file:
-                for app in data.get("apps", []):
-                    name = app["name"]
-                    version = app["version"]
-                    commands = app["commands"]
-                    description = app.get("description", "")
-                    temp_file.write(f"App {name} {version}\n")
-                    temp_file.write(f"Commands: {', '.join(commands)}\n")
-                    if description:
-                        temp_file.write(f"Description: {description}\n")
-                    apps.append((name, version, commands, description))
-
-            logging.debug(f"Converted pkg.cpm to app.txt at {self.temp_app_path}")
-            return apps
+            return [App.from_dict(entry) for entry in self.catalog.iter_entries()]
         except Exception as e:
             logging.error(f"Error processing pkg.cpm: {e}")
             QMessageBox.critical(self, "Error", f"Failed to process pkg.cpm: {e}")
             return []
 
+    def record_change(self, key, app=None):
+        """Remember that key now holds app, or was removed if app is None."""
+        self.changes.pop(key, None)
+        self.changes[key] = app.to_dict() if app is not None else None
+
+    @staticmethod
+    def search_fields(app):
+        """Search matches across name, version and description together."""
+        return (f"{app.name} {app.version} {app.description}",)
+
+    def app_label(self, app_id):
+        return self.apps[app_id].label
+
+    def selected_app_id(self):
+        """Return the id of the app under the list cursor, or None."""
+        return self.app_model.app_id(self.app_list.currentIndex())
+
     def filter_apps(self):
         """Filter and display apps based on search input."""
-        search_term = self.search_entry.text().lower()
-        self.app_list.clear()
-        for app_name, version, _, description in self.apps:
-            if search_term in f"{app_name} {version} {description}".lower():
-                self.app_list.addItem(f"{app_name} {version}")
+        self.app_filter.schedule(self.search_entry.text())
 
     def load_app_details(self):
         """Load the details of the selected app into the input fields."""
-        selected_item = self.app_list.currentItem()
-        if selected_item:
-            app_name, version = selected_item.text().split()
-            for name, ver, commands, description in self.apps:
-                if name == app_name and ver == version:
-                    self.app_name_input.setText(name)
-                    self.version_input.setText(ver)
-                    self.commands_input.setText(", ".join(commands))
-                    self.description_input.setText(description)
-                    break
+        app_id = self.selected_app_id()
+        if app_id is not None:
+            app = self.apps[app_id]
+            self.app_name_input.setText(app.name)
+            self.version_input.setText(app.version)
+            self.commands_input.setPlainText(commands_text(app.commands))
+            self.description_input.setText(app.description)
 
     def add_app(self):
         """Add a new app to the list."""
         name = self.app_name_input.text().strip()
         version = self.version_input.text().strip()
-        commands = self.commands_input.toPlainText().strip().split(", ")
         description = self.description_input.toPlainText().strip()
+        try:
+            commands = parse_commands_text(self.commands_input.toPlainText())
+        except ValueError as e:
+            QMessageBox.critical(self, "Error", f"Invalid commands: {e}")
+            return
 
         if not name or not version or not commands:
             QMessageBox.critical(self, "Error", "All fields (except description) are required to add an app.")
             return
+        if self.apps.find(name, version) is not None:
+            QMessageBox.critical(self, "Error", f"App '{name} {version}' already exists.")
+            return
 
-        self.apps.append((name, version, commands, description))
-        self.filter_apps()
+        app = App(name, version, commands, description)
+        self.apps.add(app)
+        self.record_change(app.key, app)
+        self.app_filter.refresh()
         QMessageBox.information(self, "Success", f"App '{name}' added.")
 
     def edit_app(self):
         """Edit the selected app's details."""
-        selected_item = self.app_list.currentItem()
-        if not selected_item:
+        app_id = self.selected_app_id()
+        if app_id is None:
             QMessageBox.critical(self, "Error", "Please select an app to edit.")
             return
 
-        old_name, old_version = selected_item.text().split()
+        old = self.apps[app_id]
         new_name = self.app_name_input.text().strip()
         new_version = self.version_input.text().strip()
-        new_commands = self.commands_input.toPlainText().strip().split(", ")
         new_description = self.description_input.toPlainText().strip()
+        try:
+            new_commands = parse_commands_text(self.commands_input.toPlainText())
+        except ValueError as e:
+            QMessageBox.critical(self, "Error", f"Invalid commands: {e}")
+            return
+        if not new_name or not new_version or not new_commands:
+            QMessageBox.critical(self, "Error", "All fields (except description) are required to edit an app.")
+            return
 
-        for i, (name, version, commands, description) in enumerate(self.apps):
-            if name == old_name and version == old_version:
-                self.apps[i] = (new_name, new_version, new_commands, new_description)
-                self.filter_apps()
-                QMessageBox.information(self, "Success", f"App '{old_name}' edited.")
-                return
+        app = App(new_name, new_version, new_commands, new_description)
+        try:
+            self.apps.update(app_id, app)
+        except KeyError as e:
+            QMessageBox.critical(self, "Error", str(e.args[0]))
+            return
+        if app.key != old.key:
+            self.record_change(old.key)
+        self.record_change(app.key, app)
+        self.app_filter.refresh()
+        QMessageBox.information(self, "Success", f"App '{old.name}' edited.")
 
     def remove_app(self):
         """Remove the selected app from the list."""
-        selected_item = self.app_list.currentItem()
-        if not selected_item:
+        app_id = self.selected_app_id()
+        if app_id is None:
             QMessageBox.critical(self, "Error", "Please select an app to remove.")
             return
 
-        app_name, version = selected_item.text().split()
-        self.apps = [(name, ver, cmds, desc) for name, ver, cmds, desc in self.apps if name != app_name or ver != version]
-        self.filter_apps()
-        QMessageBox.information(self, "Success", f"App '{app_name}' removed.")
+        app = self.apps.remove(app_id)
+        self.record_change(app.key)
+        self.app_filter.refresh()
+        QMessageBox.information(self, "Success", f"App '{app.name}' removed.")
 
     def save_to_pkg(self):
-        """Save the modified apps list back to pkg.cpm."""
+        """Save the edits since the last save to the pkg.cpm journal.
+
+        Only the changed apps are written; once the journal has grown large
+        it is compacted into pkg.cpm on a background thread.
+        """
         try:
-            data = {
-                "apps": [
-                    {"name": name, "version": version, "commands": commands, "description": description}
-                    for name, version, commands, description in self.apps
-                ]
-            }
-            with open(self.original_pkg_path, "w") as file:
-                json.dump(data, file, indent=4)
+            self.catalog.append(self.changes)
+            self.changes = {}
+            if self.catalog.needs_compaction() and not (self.compaction and self.compaction.is_alive()):
+                self.compaction = self.catalog.compact_in_background()
             QMessageBox.information(self, "Success", "Changes saved successfully.")
         except Exception as e:
             logging.error(f"Error saving to pkg.cpm: {e}")
             QMessageBox.critical(self, "Error", "Failed to save changes.")
 
     def closeEvent(self, event):
-        """Cleanup the temporary folder."""
-        shutil.rmtree(self.temp_dir)
-        logging.debug(f"Temporary directory {self.temp_dir} removed.")
+        """Let a running compaction finish before closing."""
+        if self.compaction is not None:
+            self.compaction.join()
         event.accept()
 
 
@@ -0,0 +1,296 @@
+import heapq
+import threading
+from collections import Counter, defaultdict
+
+import tracing
+
+# Length of the n-grams stored in the index. Queries of exactly this length
+# are answered straight from a posting set, longer ones intersect their
+# n-gram postings and verify; shorter ones match most of the catalog anyway
+# and are answered by scanning the lowercased texts.
+NGRAM_SIZE = 3
+# Default number of results returned by a ranked search
+DEFAULT_LIMIT = 50
+# Characters of a query per typo it may contain and still match: one typo
+# in up to 7 characters, two in up to 11 and so on
+CHARS_PER_TYPO = 4
+
+
+def ngrams(text, size=NGRAM_SIZE):
+    """Return the set of substrings of text that are size characters long."""
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+def typo_distance(term, text):
+    """Fewest typos that make term a substring of text.
+
+    A typo is a missing, extra or wrong character, or two adjacent
+    characters swapped. Uses Hyyrö's bit-parallel form of the edit distance
+    table, one column per character of text.
+    """
+    size = len(term)
+    mask = (1 << size) - 1
+    last = 1 << (size - 1)
+    positions = {}
+    for i, char in enumerate(term):
+        positions[char] = positions.get(char, 0) | 1 << i
+    up, down, diagonal, previous = mask, 0, 0, 0
+    distance = best = size
+    for char in text:
+        match = positions.get(char, 0)
+        diagonal = ((~diagonal & match) << 1) & previous | (((match & up) + up) ^ up) | match | down
+        right = down | ~(diagonal | up)
+        left = up & diagonal
+        if right & last:
+            distance += 1
+        elif left & last:
+            distance -= 1
+        # A match may start anywhere in text, so row 0 stays zero
+        right = (right << 1) & mask
+        left = (left << 1) & mask
+        up = (left | ~(diagonal | right)) & mask
+        down = right & diagonal
+        previous = match
+        if distance < best:
+            best = distance
+    return best
+
+
+def fuzzy_quality(term, distance):
+    """Score below 1 for a term found in a text with distance typos; match_quality is at least 1."""
+    return 0.99 * (1 - distance / len(term))
+
+
+def match_quality(term, text):
+    """Score in [1, 2] for a term found in text; earlier and fuller is better."""
+    position = text.find(term)
+    quality = 1.0 + 0.25 * len(term) / len(text)
+    if position == 0:
+        quality += 0.5
+    elif not text[position - 1].isalnum():
+        quality += 0.25
+    return quality
+
+
+class SearchIndex:
+    """Inverted index for case-insensitive substring search over the catalog.
+
+    Documents are identified by an integer id chosen by the caller (the
+    position of the app in the catalog) and carry one or more text fields.
+    A query matches a document when it is a substring of any of its fields,
+    which is the same rule the old per-keystroke scans used. The index may be
+    searched from a worker thread while the UI thread updates it.
+
+    weights gives the ranking weight of each field; fields past the end of
+    the tuple use its last weight.
+    """
+
+    def __init__(self, weights=(1.0,)):
+        self.weights = weights
+        self._lock = threading.RLock()
+        self._texts = {}
+        self._postings = []
+
+    def __len__(self):
+        return len(self._texts)
+
+    def __contains__(self, doc_id):
+        return doc_id in self._texts
+
+    def weight(self, field):
+        return self.weights[min(field, len(self.weights) - 1)]
+
+    def add(self, doc_id, *fields):
+        """Index a document, replacing any previous entry with the same id."""
+        texts = tuple(field.lower() for field in fields)
+        with self._lock:
+            if doc_id in self._texts:
+                self.remove(doc_id)
+            self._texts[doc_id] = texts
+            while len(self._postings) < len(texts):
+                self._postings.append(defaultdict(set))
+            for field, text in enumerate(texts):
+                postings = self._postings[field]
+                for gram in ngrams(text):
+                    postings[gram].add(doc_id)
+
+    def update(self, doc_id, *fields):
+        self.add(doc_id, *fields)
+
+    def remove(self, doc_id):
+        with self._lock:
+            texts = self._texts.pop(doc_id, None)
+            if texts is None:
+                return
+            for field, text in enumerate(texts):
+                for gram in ngrams(text):
+                    self._discard(self._postings[field], gram, doc_id)
+
+    @staticmethod
+    def _discard(postings, key, doc_id):
+        ids = postings.get(key)
+        if ids is not None:
+            ids.discard(doc_id)
+            if not ids:
+                del postings[key]
+
+    def search(self, term):
+        """Return the ids of documents matching term, in ascending order."""
+        term = term.lower()
+        with tracing.span("search", term=term) as span, self._lock:
+            if not term:
+                matches = self._doc_ids()
+            else:
+                matches = set()
+                for field in range(self._field_count()):
+                    matches |= self._field_matches(field, term)
+            span.set(results=len(matches))
+            return sorted(matches)
+
+    # Storage accessors; a read-only index over another store overrides these
+
+    def _doc_ids(self):
+        return self._texts.keys()
+
+    def _field_count(self):
+        return len(self._postings)
+
+    def _text(self, doc_id, field):
+        return self._texts[doc_id][field]
+
+    def _posting(self, field, gram):
+        return self._postings[field].get(gram, set())
+
+    def _scan(self, field):
+        """Yield (doc_id, text) for every document that has field."""
+        for doc_id, texts in self._texts.items():
+            if field < len(texts):
+                yield doc_id, texts[field]
+
+    def _field_matches(self, field, term):
+        """Return the ids whose field contains term as a substring."""
+        if len(term) < NGRAM_SIZE:
+            return {doc_id for doc_id, text in self._scan(field) if term in text}
+        if len(term) == NGRAM_SIZE:
+            return self._posting(field, term)
+
+        candidates = []
+        for gram in ngrams(term):
+            ids = self._posting(field, gram)
+            if not ids:
+                return set()
+            candidates.append(ids)
+        candidates.sort(key=len)
+        return {
+            doc_id for doc_id in candidates[0].intersection(*candidates[1:])
+            if term in self._text(doc_id, field)
+        }
+
+    def rank(self, term, limit=DEFAULT_LIMIT):
+        """Return the ids of the best limit matches for term, best first.
+
+        Substring matches score by field weight times match_quality. When
+        fewer than limit documents contain the term, documents it matches
+        with a typo or two are added below them (see typo_distance). Only a
+        bounded heap of limit entries is kept while selecting.
+        """
+        term = term.lower().strip()
+        if limit < 1:
+            return []
+        with tracing.span("rank", term=term, limit=limit) as span, self._lock:
+            if not term:
+                return sorted(self._doc_ids())[:limit]
+
+            scores = {}
+            fields = sorted(range(self._field_count()), key=self.weight, reverse=True)
+            for position, field in enumerate(fields):
+                weight = self.weight(field)
+                for doc_id in self._field_matches(field, term):
+                    score = weight * match_quality(term, self._text(doc_id, field))
+                    if score > scores.get(doc_id, 0):
+                        scores[doc_id] = score
+                # Lower-weight fields cannot beat a full page of results
+                if len(scores) >= limit and position + 1 < len(fields):
+                    floor = heapq.nlargest(limit, scores.values())[-1]
+                    if floor >= 2 * self.weight(fields[position + 1]):
+                        break
+
+            if len(scores) < limit and len(term) > NGRAM_SIZE:
+                self._add_fuzzy(term, scores, limit)
+            span.set(candidates=len(scores))
+
+            best = heapq.nlargest(limit, scores.items(), key=lambda item: (item[1], -item[0]))
+            return [doc_id for doc_id, _ in best]
+
+    def _add_fuzzy(self, term, scores, limit):
+        """Add the documents whose first field matches term with a few typos to scores.
+
+        Only the first field (the app name) is checked: longer texts share
+        a few n-grams with almost any term, and checking them all would not
+        stay interactive.
+        """
+        if not self._field_count():
+            return
+        typos = len(term) // CHARS_PER_TYPO
+        grams = {}
+        for offset in range(len(term) - NGRAM_SIZE + 1):
+            grams.setdefault(term[offset:offset + NGRAM_SIZE], offset)
+        # Each typo breaks at most NGRAM_SIZE + 1 of the term's n-grams, so
+        # a name sharing fewer has more typos
+        breaks = NGRAM_SIZE + 1
+        needed = max(1, len(grams) - breaks * typos)
+        total = len(grams)
+        # In a short term a swap can break every n-gram; those of the term
+        # with the swap undone still find the name
+        for i in range(len(term) - 1 if total <= breaks * typos else 0):
+            swapped = term[:i] + term[i + 1] + term[i] + term[i + 2:]
+            for offset in range(max(0, i - NGRAM_SIZE + 1), min(i + 2, len(term) - NGRAM_SIZE + 1)):
+                grams.setdefault(swapped[offset:offset + NGRAM_SIZE], offset)
+        weight = self.weight(0)
+        top = heapq.nlargest(limit, scores.values())
+        heapq.heapify(top)
+
+        counts = Counter()
+        for gram in grams:
+            counts.update(self._posting(0, gram))
+        # Most shared n-grams first, then catalog order
+        candidates = sorted(
+            ((shared, doc_id) for doc_id, shared in counts.items() if shared >= needed),
+            key=lambda item: (-item[0], item[1]),
+        )
+        for shared, doc_id in candidates:
+            # The best score this and later candidates can still reach
+            fewest = max(1, -(-(total - shared) // breaks))
+            if len(top) >= limit and top[0] >= weight * fuzzy_quality(term, fewest):
+                break
+            if doc_id in scores:
+                continue
+            distance = self._typo_distance(term, grams, self._text(doc_id, 0), typos)
+            if distance > typos:
+                continue
+            score = weight * fuzzy_quality(term, distance)
+            scores[doc_id] = score
+            if len(top) < limit:
+                heapq.heappush(top, score)
+            elif score > top[0]:
+                heapq.heapreplace(top, score)
+
+    @staticmethod
+    def _typo_distance(term, grams, text, typos):
+        """typo_distance of term in text, or typos + 1 if more.
+
+        Only the parts of text around the n-grams it shares with term
+        (grams, mapped to their offset in term) are checked: a match with
+        at most typos typos lies within typos characters of where one of
+        its intact n-grams puts it.
+        """
+        best = typos + 1
+        starts = set()
+        for gram, offset in grams.items():
+            position = text.find(gram)
+            while position >= 0:
+                starts.add(max(0, position - offset - typos))
+                position = text.find(gram, position + 1)
+        for start in starts:
+            best = min(best, typo_distance(term, text[start:start + len(term) + 2 * typos]))
+        return best
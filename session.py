@@ -0,0 +1,205 @@
+import os
+import time
+import shlex
+import signal
+import secrets
+import logging
+import threading
+import subprocess
+from collections import deque
+
+import tracing
+from stream import TAIL_LINES, pump_lines
+
+SHELL = "/bin/bash"
+
+
+class ShellSession:
+    """One long-lived shell that runs install steps one after another.
+
+    The working directory and environment carry over between steps. After
+    each step the shell prints a marker line carrying the exit status and
+    working directory on stdout, and a bare marker on stderr, so output is
+    attributed to the right step. Each step is passed to the shell as one
+    quoted eval, so a step that does not parse fails on its own instead of
+    swallowing the markers. Before each sudo step the credentials are
+    checked with `sudo -n -v`, which also extends them, and the password is
+    only sent again with `sudo -S -v` once they have expired; the step then
+    runs with `sudo -n`.
+    """
+
+    def __init__(self, password=None, cwd=None, shell=SHELL):
+        self.password = password
+        self.shell = shell
+        self.marker = f"__cpm_step_{secrets.token_hex(8)}__"
+        self.process = None
+        self.cwd = cwd or os.getcwd()
+        self.authenticated = False
+
+    def start(self):
+        self.process = subprocess.Popen(
+            [self.shell], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            cwd=self.cwd, start_new_session=True,
+        )
+        self.authenticated = False
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def close(self):
+        if self.alive():
+            self.process.stdin.close()
+            self.process.wait()
+        self.process = None
+
+    def terminate(self):
+        """Kill the shell and the commands it is running.
+
+        The shell leads its own process group, so a running step's children
+        go with it; sudo passes the signal on to the command it runs.
+        """
+        if self.alive():
+            try:
+                os.killpg(self.process.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def cpu_time(self):
+        """CPU seconds used by the shell and the commands it has waited for.
+
+        Read from /proc, so None where that is not available.
+        """
+        if not self.alive():
+            return None
+        try:
+            with open(f"/proc/{self.process.pid}/stat", "r") as file:
+                fields = file.read().rpartition(")")[2].split()
+        except OSError:
+            return None
+        # utime, stime, cutime and cstime, in clock ticks
+        return sum(int(value) for value in fields[11:15]) / os.sysconf("SC_CLK_TCK")
+
+    def chdir(self, path):
+        """Move the session to path, as a skipped step would have left it."""
+        if not self.alive():
+            self.cwd = path
+        elif path != self.cwd:
+            self.execute(f"cd {shlex.quote(path)}")
+
+    def authenticate(self, on_line=None):
+        """Make sure sudo credentials are valid for the next step.
+
+        Cached credentials run out after sudo's timestamp_timeout, e.g.
+        during a long build, so they are checked before every sudo step.
+        """
+        if not self.password:
+            return 0
+        if self.authenticated and self.execute("sudo -n -v 2>/dev/null")[0] == 0:
+            return 0
+        with tracing.span("sudo", "step") as span:
+            status, _, _ = self.execute(
+                f"printf '%s\\n' {shlex.quote(self.password)} | sudo -S -p '' -v", on_line
+            )
+            span.set(exit=status)
+        self.authenticated = status == 0
+        return status
+
+    def run(self, command, on_line=None, tail=TAIL_LINES):
+        """Run one step. Returns (returncode, tail_lines, seconds)."""
+        if not self.alive():
+            self.start()
+        if command.startswith("sudo "):
+            status = self.authenticate(on_line)
+            if status != 0:
+                return status, ["sudo authentication failed"], 0.0
+            command = f"sudo -n {command[5:]}"
+        status, last, seconds = self.execute(command, on_line, tail)
+        logging.debug(f"Step finished with status {status} in {seconds:.2f}s: {command}")
+        return status, last, seconds
+
+    def execute(self, command, on_line=None, tail=TAIL_LINES):
+        if not self.alive():
+            self.start()
+        last = deque(maxlen=tail)
+        result = {}
+
+        def handle(stream, line):
+            position = line.find(self.marker)
+            if position < 0:
+                last.append(line)
+                if on_line is not None:
+                    on_line(stream, line)
+                return
+            if position > 0:
+                handle(stream, line[:position])
+            result[stream] = line[position + len(self.marker):].strip()
+
+        script = (
+            f"eval {shlex.quote(command)} < /dev/null\n"
+            f"__cpm_status=$?\n"
+            f"printf '%s %d %s\\n' {self.marker} \"$__cpm_status\" \"$PWD\"\n"
+            f"printf '%s\\n' {self.marker} >&2\n"
+        )
+        start = time.perf_counter()
+        try:
+            self.process.stdin.write(script.encode())
+            self.process.stdin.flush()
+        except BrokenPipeError:
+            pass
+        pump_lines(
+            {"stdout": self.process.stdout, "stderr": self.process.stderr}, handle,
+            done=lambda: len(result) == 2,
+        )
+        seconds = time.perf_counter() - start
+
+        if "stdout" not in result:
+            # The step ended the shell (e.g. `exit`); the next step starts a new one
+            returncode = self.process.wait()
+            self.process = None
+            return returncode, list(last), seconds
+        status, _, cwd = result["stdout"].partition(" ")
+        self.cwd = cwd or self.cwd
+        return int(status), list(last), seconds
+
+
+class SessionPool:
+    """Hands each step the shell session of a step it waits for.
+
+    A step continues the session of its first dependency that no other step
+    has continued yet, so a chain of steps shares one shell while parallel
+    branches get shells of their own, starting in their parent's directory.
+    """
+
+    def __init__(self, password=None):
+        self.password = password
+        self.lock = threading.Lock()
+        self.by_step = {}
+        self.continued = set()
+        self.sessions = []
+
+    def session_for(self, step):
+        with self.lock:
+            session = self.by_step.get(step.index)
+            if session is not None:
+                return session
+            for dep in step.after:
+                if dep in self.by_step and dep not in self.continued:
+                    self.continued.add(dep)
+                    session = self.by_step[dep]
+                    break
+            else:
+                parent = self.by_step.get(step.after[0]) if step.after else None
+                session = ShellSession(self.password, parent.cwd if parent else None)
+                self.sessions.append(session)
+            self.by_step[step.index] = session
+            return session
+
+    def terminate(self):
+        with self.lock:
+            sessions = list(self.sessions)
+        for session in sessions:
+            session.terminate()
+
+    def close(self):
+        for session in self.sessions:
+            session.close()
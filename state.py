@@ -0,0 +1,297 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import logging
+import threading
+import subprocess
+
+from cache import parse_wget
+from transaction import classify
+
+STATE_DB = os.environ.get(
+    "CPM_STATE_DB",
+    os.path.join(os.environ.get("XDG_DATA_HOME", os.path.expanduser("~/.local/share")), "cpm", "state.db"),
+)
+# An apt index refresh or upgrade counts as done for this many seconds
+REFRESH_AGE = 24 * 3600
+# Weight of the latest run in a step's average duration
+HISTORY_WEIGHT = 0.3
+# Expected duration of a step with no history
+DEFAULT_STEP_SECONDS = 5.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS steps (
+    fingerprint TEXT PRIMARY KEY,
+    command TEXT NOT NULL,
+    packages TEXT NOT NULL,
+    status INTEGER NOT NULL,
+    digest TEXT,
+    cwd TEXT,
+    outputs TEXT,
+    seconds REAL,
+    finished REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS durations (
+    packages TEXT NOT NULL,
+    command TEXT NOT NULL,
+    seconds REAL NOT NULL,
+    runs INTEGER NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (packages, command)
+);
+CREATE TABLE IF NOT EXISTS attempts (
+    package TEXT PRIMARY KEY,
+    started REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS installed (
+    name TEXT NOT NULL,
+    version TEXT NOT NULL,
+    installed REAL NOT NULL,
+    PRIMARY KEY (name, version)
+);
+"""
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(65536), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def history_key(step):
+    """The names of the packages a step belongs to; durations carry over between versions."""
+    return ",".join(sorted({label.rsplit(" ", 1)[0] for label in step.packages}))
+
+
+def apt_installed(packages):
+    """True if dpkg reports every one of packages as installed."""
+    names = [package.split("=")[0] for package in packages]
+    try:
+        result = subprocess.run(
+            ["dpkg-query", "-W", "-f=${db:Status-Abbrev}\\n", *names],
+            capture_output=True, text=True,
+        )
+    except OSError:
+        return False
+    lines = result.stdout.splitlines()
+    return result.returncode == 0 and len(lines) == len(names) and all(line.startswith("ii") for line in lines)
+
+
+class InstallState:
+    """SQLite record of finished install steps and installed packages.
+
+    Safe to share between the worker threads of one transaction.
+    """
+
+    def __init__(self, path=STATE_DB):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.db.row_factory = sqlite3.Row
+        with self.db:
+            self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def step(self, fingerprint):
+        with self.lock:
+            return self.db.execute("SELECT * FROM steps WHERE fingerprint = ?", (fingerprint,)).fetchone()
+
+    def record_step(self, fingerprint, step, status, digest=None, cwd=None, outputs=None):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO steps VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (fingerprint, step.command, json.dumps(list(step.packages)), status, digest, cwd,
+                 json.dumps(outputs) if outputs else None, step.seconds, time.time()),
+            )
+
+    def record_duration(self, step):
+        """Fold step.seconds into the moving average duration of the step's command."""
+        key = history_key(step)
+        with self.lock, self.db:
+            row = self.db.execute(
+                "SELECT seconds, runs FROM durations WHERE packages = ? AND command = ?", (key, step.command)
+            ).fetchone()
+            if row is None:
+                seconds, runs = step.seconds, 1
+            else:
+                seconds, runs = row["seconds"] + HISTORY_WEIGHT * (step.seconds - row["seconds"]), row["runs"] + 1
+            self.db.execute(
+                "INSERT OR REPLACE INTO durations VALUES (?, ?, ?, ?, ?)",
+                (key, step.command, seconds, runs, time.time()),
+            )
+
+    def duration(self, step):
+        """Expected seconds of step from its history, or None if the command never ran.
+
+        The history of the same packages comes first, then that of the same
+        command in any package.
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT seconds FROM durations WHERE packages = ? AND command = ?", (history_key(step), step.command)
+            ).fetchone()
+            if row is None:
+                row = self.db.execute(
+                    "SELECT AVG(seconds) AS seconds FROM durations WHERE command = ?", (step.command,)
+                ).fetchone()
+        return None if row is None else row["seconds"]
+
+    def attempts(self, labels):
+        """Return {label: start time} for the packages among labels whose last install did not finish."""
+        labels = list(labels)
+        with self.lock:
+            rows = self.db.execute(
+                f"SELECT * FROM attempts WHERE package IN ({', '.join('?' * len(labels))})", labels
+            ).fetchall()
+        return {row["package"]: row["started"] for row in rows}
+
+    def start_attempt(self, labels):
+        """Note that the packages labels are being installed; an unfinished attempt keeps its start time."""
+        now = time.time()
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR IGNORE INTO attempts VALUES (?, ?)", [(label, now) for label in labels])
+
+    def mark_installed(self, app):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO installed VALUES (?, ?, ?)", (app.name, app.version, time.time())
+            )
+            self.db.execute("DELETE FROM attempts WHERE package = ?", (app.label,))
+
+    def installed(self):
+        """Return (name, version, installed time) rows, by name."""
+        with self.lock:
+            return self.db.execute("SELECT * FROM installed ORDER BY name, version").fetchall()
+
+
+class StepTracker:
+    """Decides which steps of a transaction are already satisfied.
+
+    A step's fingerprint covers its command, its packages and the digests
+    of the same-package steps it depends on, so editing or re-downloading
+    something earlier in a chain invalidates the steps after it. A step is
+    satisfied when its fingerprint was recorded as successful and:
+
+    - apt installs while dpkg reports the packages installed,
+    - apt index refreshes and upgrades for REFRESH_AGE seconds,
+    - steps declaring "creates" while those files exist,
+    - wget steps never; they run through the download cache, and the
+      digest of what they fetched feeds the fingerprints after them,
+    - any other step only if it succeeded during an install of its
+      packages that has not finished yet.
+
+    Re-running a transaction after a failure thus resumes at the failed
+    step, while installing again after a success runs every step whose
+    effect cannot be checked. With force, nothing is skipped but every
+    step is still recorded. Call begin() before running the steps.
+    """
+
+    def __init__(self, state, steps, force=False):
+        self.state = state
+        self.force = force
+        self.steps = {step.index: step for step in steps}
+        self.lock = threading.Lock()
+        self.digests = {}
+        self.failed = set()
+        self.labels = {label for step in steps for label in step.packages}
+        self.resumed = state.attempts(self.labels)
+
+    def begin(self):
+        """Record that the steps' packages are being installed, until finish() sees them succeed."""
+        self.state.start_attempt(self.labels)
+
+    def fingerprint(self, step):
+        """Return the step's fingerprint, or None if a step it needs failed."""
+        kind = classify(step.command)
+        parts = [step.command]
+        if kind is None:
+            parts.append(sorted(step.packages))
+            for dep in step.after:
+                parent = self.steps[dep]
+                if not set(parent.packages) & set(step.packages):
+                    continue
+                with self.lock:
+                    digest = self.digests.get(dep)
+                if digest is None:
+                    return None
+                parts.append(digest)
+        return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+    def satisfied(self, step):
+        """Return the recorded working directory if step can be skipped, else None."""
+        if self.force:
+            return None
+        fingerprint = self.fingerprint(step)
+        if fingerprint is None or parse_wget(step.command) is not None:
+            return None
+        record = self.state.step(fingerprint)
+        if record is None or record["status"] != 0 or not os.path.isdir(record["cwd"] or ""):
+            return None
+        if not self.still_done(step, record):
+            return None
+        with self.lock:
+            self.digests[step.index] = record["digest"]
+        logging.debug(f"Skipping satisfied step: {step.command}")
+        return record["cwd"]
+
+    def still_done(self, step, record):
+        """True if the effect of step's successful run in record can be relied on."""
+        kind = classify(step.command)
+        if kind is not None and kind[0] == "install":
+            return apt_installed(kind[3])
+        if kind is not None and kind[0] in ("refresh", "upgrade"):
+            return time.time() - record["finished"] <= REFRESH_AGE
+        if step.creates:
+            return all(os.path.exists(os.path.join(record["cwd"], path)) for path in step.creates)
+        return bool(step.packages) and all(
+            label in self.resumed and record["finished"] >= self.resumed[label] for label in step.packages
+        )
+
+    def done(self, step, error, cwd):
+        """Record the outcome of a step that ran, with the session's cwd after it."""
+        fingerprint = self.fingerprint(step)
+        if error:
+            with self.lock:
+                self.failed.update(step.packages)
+        if fingerprint is None:
+            return
+        digest, outputs = fingerprint, None
+        download = parse_wget(step.command)
+        if download is not None and not error:
+            path = os.path.join(cwd, download[1])
+            try:
+                digest = file_digest(path)
+            except OSError:
+                digest = None
+            outputs = {path: digest}
+        if not error:
+            with self.lock:
+                self.digests[step.index] = digest
+        self.state.record_step(fingerprint, step, 1 if error else 0, digest, cwd, outputs)
+        if not error:
+            self.state.record_duration(step)
+
+    def estimate(self, step):
+        """Return (expected seconds, whether known from history) for a step about to run.
+
+        Steps that will be skipped take no time. Call in step order, so the
+        steps after a satisfied one can be recognized as satisfied too.
+        """
+        if self.satisfied(step) is not None:
+            return 0.0, True
+        seconds = self.state.duration(step)
+        if seconds is None:
+            return DEFAULT_STEP_SECONDS, False
+        return seconds, True
+
+    def finish(self, apps):
+        """Mark the apps with no failed step as installed."""
+        for app in apps:
+            if app.label not in self.failed:
+                self.state.mark_installed(app)
@@ -0,0 +1,110 @@
+DEFAULT_WORKERS = 4
+
+# A package's "commands" may mix plain strings with step objects:
+#
+#     {"id": "fetch", "run": "wget https://...", "after": []}
+#
+# "run" is the shell command. "after" lists the ids of earlier steps that
+# must finish first; an empty list lets the step start right away. A plain
+# string, or an object without "after", waits for the step before it, so a
+# plain list of commands still runs strictly in order. "creates" names the
+# file, or list of files, the step makes, relative to its working
+# directory; once they exist the step counts as done and is not run again.
+
+
+class Step:
+    __slots__ = ("index", "command", "after", "packages", "creates", "seconds", "skipped")
+
+    def __init__(self, index, command, after, packages=(), creates=()):
+        self.index = index
+        self.command = command
+        self.after = after
+        self.packages = packages
+        self.creates = creates
+        self.seconds = None
+        self.skipped = False
+
+
+def parse_steps(commands):
+    """Turn a package's commands into Steps, resolving "after" references."""
+    steps = []
+    ids = {}
+    for index, entry in enumerate(commands):
+        if isinstance(entry, str):
+            command, step_id, after, creates = entry, None, None, ()
+        else:
+            command, step_id, after = entry["run"], entry.get("id"), entry.get("after")
+            creates = entry.get("creates", ())
+            if isinstance(creates, str):
+                creates = (creates,)
+            if not all(isinstance(path, str) and path for path in creates):
+                raise ValueError(f"Step '{command}' has an invalid 'creates'")
+            creates = tuple(creates)
+
+        if after is None:
+            deps = [index - 1] if index else []
+        else:
+            deps = []
+            for name in after:
+                if name not in ids:
+                    raise ValueError(f"Step '{command}' depends on unknown earlier step '{name}'")
+                deps.append(ids[name])
+
+        if step_id is not None:
+            ids[step_id] = index
+        steps.append(Step(index, command, deps, creates=creates))
+    return steps
+
+
+def step_commands(commands):
+    """Return the shell command of every step, in file order."""
+    return [entry if isinstance(entry, str) else entry["run"] for entry in commands]
+
+
+def run_steps(steps, execute, workers=DEFAULT_WORKERS, on_start=None, on_done=None):
+    """Run steps as soon as their dependencies have finished.
+
+    execute(step) returns an error message or None and runs on a worker
+    thread. on_start(step) and on_done(step, error, finished, total) are
+    called from the thread that called run_steps.
+    A failed step does not stop the steps after it, as with the sequential
+    runner. Returns the error messages in step order.
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+    total = len(steps)
+    waiting = {step.index: len(step.after) for step in steps}
+    dependents = {step.index: [] for step in steps}
+    for step in steps:
+        for dep in step.after:
+            dependents[dep].append(step)
+
+    errors = {}
+    finished = 0
+
+    def start(pool, step):
+        if on_start is not None:
+            on_start(step)
+        return pool.submit(execute, step)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        running = {start(pool, step): step for step in steps if not step.after}
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                step = running.pop(future)
+                try:
+                    error = future.result()
+                except Exception as e:
+                    error = f"Command '{step.command}' failed: {e}"
+                if error:
+                    errors[step.index] = error
+                finished += 1
+                if on_done is not None:
+                    on_done(step, error, finished, total)
+                for child in dependents[step.index]:
+                    waiting[child.index] -= 1
+                    if waiting[child.index] == 0:
+                        running[start(pool, child)] = child
+
+    return [errors[index] for index in sorted(errors)]
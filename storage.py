@@ -0,0 +1,319 @@
+import os
+import json
+import time
+import fcntl
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from catalog import iter_catalog
+
+# The journal is compacted into pkg.cpm once it is larger than this share
+# of pkg.cpm, and at least COMPACT_MIN bytes
+COMPACT_RATIO = 0.25
+COMPACT_MIN = 64 * 1024
+# A file modified this close to a check may change again without its
+# size or mtime changing, so FileWatcher compares its contents
+RACY_SECONDS = 2.0
+
+
+def dump_temp(path, data, **kwargs):
+    """Write data as JSON to a synced temp file next to path; returns its path."""
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as file:
+            json.dump(data, file, **kwargs)
+            file.flush()
+            os.fsync(file.fileno())
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    return temp_path
+
+
+def stream_temp(path, chunks, mode="w"):
+    """Write chunks to a synced temp file next to path as they come; returns its path.
+
+    chunks are strings, or bytes with mode "wb".
+    """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode) as file:
+            for chunk in chunks:
+                file.write(chunk)
+            file.flush()
+            os.fsync(file.fileno())
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    return temp_path
+
+
+def write_atomic(path, chunks, mode="w"):
+    """Write chunks to path atomically; nothing changes if producing them fails."""
+    temp_path = stream_temp(path, chunks, mode)
+    try:
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def json_list_chunks(entries):
+    """Yield entries as the text json.dump(list(entries), file, indent=4) would write."""
+    first = True
+    for entry in entries:
+        # Encoded JSON has no raw newlines, so this indents every line
+        yield ("[\n    " if first else ",\n    ") + json.dumps(entry, indent=4).replace("\n", "\n    ")
+        first = False
+    yield "[]" if first else "\n]"
+
+
+def write_json(path, data, **kwargs):
+    """Write data as JSON to path atomically."""
+    temp_path = dump_temp(path, data, **kwargs)
+    try:
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+class CatalogFile:
+    """pkg.cpm together with the journal of edits not yet written into it.
+
+    pkg.cpm is a JSON list of apps. Edits are appended to pkg.cpm.journal,
+    one JSON object per line in the shape of a sync delta entry:
+    {"upsert": <app>} or {"remove": {"name": ..., "version": ...}}. Readers
+    see pkg.cpm with the journal applied; compact() folds the journal back
+    into pkg.cpm. Every rewrite goes through a temp file and a rename, and
+    writers on the same host serialize on a lock file next to pkg.cpm.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.journal_path = path + ".journal"
+        self.lock_path = path + ".lock"
+
+    @contextmanager
+    def _locked(self, suffix="", blocking=True):
+        """Hold an exclusive lock; yields False if it is taken and not blocking."""
+        with open(self.lock_path + suffix, "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def journal_size(self):
+        try:
+            return os.path.getsize(self.journal_path)
+        except FileNotFoundError:
+            return 0
+
+    def pending(self):
+        """True if the journal holds edits not yet compacted into pkg.cpm."""
+        return self.journal_size() > 0
+
+    def needs_compaction(self):
+        size = self.journal_size()
+        try:
+            base = os.path.getsize(self.path)
+        except FileNotFoundError:
+            base = 0
+        return size >= max(COMPACT_MIN, COMPACT_RATIO * base)
+
+    def append(self, changes):
+        """Journal {(name, version): app dict, or None to remove it}, in order.
+
+        The cost is the size of the edit; pkg.cpm itself is not touched.
+        """
+        lines = [
+            json.dumps({"upsert": app} if app is not None else {"remove": {"name": name, "version": version}})
+            for (name, version), app in changes.items()
+        ]
+        if not lines:
+            return
+        data = ("\n".join(lines) + "\n").encode()
+        with self._locked():
+            fd = os.open(self.journal_path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                # Start on a fresh line after an append that was cut short
+                size = os.fstat(fd).st_size
+                if size and os.pread(fd, 1, size - 1) != b"\n":
+                    data = b"\n" + data
+                os.write(fd, data)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def read_journal(self):
+        """Return ({key: app dict, or None if removed}, bytes read).
+
+        Keys are in the order their final change was made. Lines that do not
+        parse, such as one left by an interrupted append, are skipped.
+        """
+        changes = {}
+        try:
+            with open(self.journal_path, "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
+            return changes, 0
+        lines = data.split(b"\n")
+        for number, line in enumerate(lines[:-1], 1):
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+                if "upsert" in entry:
+                    app = entry["upsert"]
+                    key, value = (app["name"], app["version"]), app
+                else:
+                    key, value = (entry["remove"]["name"], entry["remove"]["version"]), None
+            except (json.JSONDecodeError, KeyError, TypeError) as e:
+                logging.warning(f"Skipping {self.journal_path} line {number}: {e}")
+                continue
+            changes.pop(key, None)
+            changes[key] = value
+        return changes, len(data) - len(lines[-1])
+
+    def iter_entries(self, changes=None):
+        """Yield the catalog's app dicts with the journal applied.
+
+        pkg.cpm is streamed; changed apps keep their place and new ones
+        follow in journal order.
+        """
+        if changes is None:
+            changes, _ = self.read_journal()
+        applied = set()
+        if os.path.exists(self.path) or not changes:
+            with open(self.path, "r") as file:
+                for entry in iter_catalog(file):
+                    key = (entry["name"], entry["version"])
+                    if key in changes:
+                        applied.add(key)
+                        entry = changes[key]
+                        if entry is None:
+                            continue
+                    yield entry
+        for key, entry in changes.items():
+            if entry is not None and key not in applied:
+                yield entry
+
+    def write(self, apps):
+        """Replace the whole catalog with the app dicts apps, dropping the journal.
+
+        apps is written as it is iterated; if that raises, nothing changes.
+        """
+        with self._locked(".compact"), self._locked():
+            write_atomic(self.path, json_list_chunks(apps))
+            if os.path.exists(self.journal_path):
+                os.unlink(self.journal_path)
+
+    def compact(self):
+        """Fold the journal into pkg.cpm. Returns False if there was nothing to do.
+
+        pkg.cpm is rebuilt without holding the journal lock, so edits can be
+        appended meanwhile; they stay in the journal for the next compaction.
+        Only one compaction runs at a time.
+        """
+        with self._locked(".compact", blocking=False) as acquired:
+            if not acquired:
+                return False
+            changes, consumed = self.read_journal()
+            if not consumed:
+                return False
+            temp_path = stream_temp(self.path, json_list_chunks(self.iter_entries(changes)))
+            try:
+                with self._locked():
+                    with open(self.journal_path, "rb") as file:
+                        file.seek(consumed)
+                        rest = file.read()
+                    os.replace(temp_path, self.path)
+                    if rest:
+                        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix=".tmp")
+                        with os.fdopen(fd, "wb") as file:
+                            file.write(rest)
+                        os.replace(temp_path, self.journal_path)
+                    else:
+                        os.unlink(self.journal_path)
+            finally:
+                if os.path.exists(temp_path):
+                    os.unlink(temp_path)
+            logging.info(f"Compacted {consumed} journal bytes into {self.path}")
+            return True
+
+    def compact_in_background(self, on_error=None):
+        """Start compact() on a daemon thread and return the thread."""
+        def run():
+            try:
+                self.compact()
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                logging.error(f"Compacting {self.path} failed: {e}")
+                if on_error is not None:
+                    on_error(str(e))
+
+        thread = threading.Thread(target=run, name="catalog-compact", daemon=True)
+        thread.start()
+        return thread
+
+
+class FileWatcher:
+    """Tells whether any of a set of files changed since the last check.
+
+    Sizes and mtimes are compared first. The contents are hashed only when
+    those differ, so touching a file without changing it is not a change,
+    or when a file was modified shortly before the last check and could
+    since have been rewritten within the same mtime. Files are only hashed
+    once one of these calls for it, so a size or mtime change before any
+    hash was taken counts as a change.
+    """
+
+    def __init__(self, paths):
+        self.paths = list(paths)
+        self.stamp = self._stamp()
+        self.checked = time.time()
+        self.digest = self._digest() if self._racy() else None
+
+    def _stamp(self):
+        stamp = []
+        for path in self.paths:
+            try:
+                stat = os.stat(path)
+                stamp.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                stamp.append(None)
+        return stamp
+
+    def _digest(self):
+        import hashlib
+
+        digest = hashlib.sha256()
+        for path in self.paths:
+            try:
+                with open(path, "rb") as file:
+                    for chunk in iter(lambda: file.read(1024 * 1024), b""):
+                        digest.update(chunk)
+                digest.update(b"\0")
+            except FileNotFoundError:
+                digest.update(b"\1")
+        return digest.hexdigest()
+
+    def _racy(self):
+        limit = (self.checked - RACY_SECONDS) * 1e9
+        return any(entry is not None and entry[0] >= limit for entry in self.stamp)
+
+    def changed(self):
+        stamp, now = self._stamp(), time.time()
+        if stamp == self.stamp and not self._racy():
+            self.checked = now
+            return False
+        digest = self._digest()
+        changed = self.digest is None or digest != self.digest
+        self.stamp, self.checked, self.digest = stamp, now, digest
+        return changed
@@ -0,0 +1,46 @@
+import os
+import selectors
+
+# Lines of output kept per command for the error report
+TAIL_LINES = 50
+# Longest partial line buffered before it is forwarded without a newline
+MAX_LINE = 64 * 1024
+
+
+def pump_lines(pipes, handle, done=None):
+    """Read {stream: pipe} line by line, calling handle(stream, line).
+
+    Lines are decoded and lose their newline. Returns once every pipe has
+    closed, or as soon as done() is true after a line was handled; pipes
+    are left open in that case.
+    """
+    with selectors.DefaultSelector() as selector:
+        pending = {}
+        for stream, pipe in pipes.items():
+            selector.register(pipe, selectors.EVENT_READ, stream)
+            pending[stream] = b""
+
+        def emit(stream, data):
+            handle(stream, data.decode(errors="replace").rstrip("\r"))
+
+        while selector.get_map():
+            for key, _ in selector.select():
+                stream = key.data
+                chunk = os.read(key.fd, 65536)
+                if not chunk:
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+                    if pending[stream]:
+                        emit(stream, pending[stream])
+                    continue
+
+                buffer = pending[stream] + chunk
+                *lines, buffer = buffer.split(b"\n")
+                for line in lines:
+                    emit(stream, line)
+                while len(buffer) > MAX_LINE:
+                    emit(stream, buffer[:MAX_LINE])
+                    buffer = buffer[MAX_LINE:]
+                pending[stream] = buffer
+            if done is not None and done():
+                return
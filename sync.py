@@ -0,0 +1,260 @@
+import os
+import re
+import json
+import logging
+import urllib.error
+
+from storage import CatalogFile, write_json
+
+CATALOG_URL = os.environ.get("CPM_CATALOG_URL", "https://1t2.pages.dev/pybuild")
+SOURCES_FILE = os.environ.get("CPM_SOURCES", "sources.json")
+# Each source is synced into <dir>/<name>/pkg.cpm next to the merged pkg.cpm
+SOURCES_DIR = ".cpm-sources"
+SOURCE_NAME = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._-]*$")
+TIMEOUT = 30
+
+# The catalog server publishes, next to pkg.cpm:
+#
+#   manifest.json       {"revision": 42, "oldest": 30}
+#   deltas/<rev>.json   {"revision": 42,
+#                        "upsert": [<app>, ...],
+#                        "remove": [{"name": ..., "version": ...}, ...]}
+#
+# deltas/<rev>.json holds the changes from revision rev - 1 to rev. "oldest"
+# is the oldest revision a client can still sync from; older clients,
+# clients ahead of the server (after it was reset) and servers without a
+# manifest get the whole pkg.cpm instead. manifest.json and a whole pkg.cpm
+# are fetched conditionally on the ETag and Last-Modified of the previous
+# fetch.
+#
+# Several catalogs can be layered by listing them in sources.json:
+#
+#   [{"name": "internal", "url": "https://...", "priority": 10},
+#    {"name": "public", "url": "https://1t2.pages.dev/pybuild"}]
+#
+# Each source syncs as above into its own directory under SOURCES_DIR, all
+# at once. The sources are then merged into pkg.cpm: where several carry
+# the same name and version, the one with the highest priority (default 0,
+# ties going to the one listed first) wins.
+
+
+def state_path(pkg_file):
+    return os.path.join(os.path.dirname(os.path.abspath(pkg_file)), ".catalog-sync.json")
+
+
+def load_state(pkg_file):
+    try:
+        with open(state_path(pkg_file), "r") as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {"url": None, "revision": 0}
+
+
+def fetch_json(url, validators=None):
+    """Fetch url as JSON; returns (data, validators).
+
+    validators are the ETag and Last-Modified of an earlier response. When
+    the server answers that nothing changed since, data is None and the
+    validators are returned as they were.
+    """
+    # Imported here: it brings in http.client and ssl, which the CLI only needs to sync
+    import urllib.request
+
+    request = urllib.request.Request(url)
+    if validators:
+        if validators.get("etag"):
+            request.add_header("If-None-Match", validators["etag"])
+        if validators.get("last_modified"):
+            request.add_header("If-Modified-Since", validators["last_modified"])
+    try:
+        with urllib.request.urlopen(request, timeout=TIMEOUT) as response:
+            data = json.load(response)
+            return data, {"etag": response.headers.get("ETag"),
+                          "last_modified": response.headers.get("Last-Modified")}
+    except urllib.error.HTTPError as e:
+        if e.code == 304 and validators:
+            return None, validators
+        raise
+
+
+def add_delta(changes, delta):
+    """Fold one delta into {(name, version): app dict, or None if removed}, as CatalogFile.append takes."""
+    for key in delta.get("remove", []):
+        changes.pop((key["name"], key["version"]), None)
+        changes[(key["name"], key["version"])] = None
+    for app in delta.get("upsert", []):
+        changes.pop((app["name"], app["version"]), None)
+        changes[(app["name"], app["version"])] = app
+    return changes
+
+
+def sync_catalog(pkg_file, base_url=CATALOG_URL, log=print):
+    """Bring pkg_file up to date with the catalog server at base_url.
+
+    Returns the revision the catalog is at afterwards (0 when the server
+    has no manifest and the whole file was downloaded). A full download
+    replaces pkg_file; deltas are appended to its journal, so they cost
+    the size of the change, and folded in once the journal is large.
+    Nothing is written if the catalog did not change.
+    """
+    base_url = base_url.rstrip("/")
+    state = load_state(pkg_file)
+    catalog = CatalogFile(pkg_file)
+    same = state["url"] == base_url and os.path.exists(pkg_file)
+    local = state["revision"] if same else 0
+    validators = state.get("validators", {}) if same else {}
+
+    def save(revision, **fetched):
+        write_json(state_path(pkg_file), {
+            "url": base_url, "revision": revision, "validators": {**validators, **fetched},
+        })
+
+    try:
+        manifest, manifest_validators = fetch_json(f"{base_url}/manifest.json", validators.get("manifest"))
+        if manifest is None:
+            log(f"Catalog is up to date at revision {local}.")
+            return local
+    except urllib.error.HTTPError as e:
+        if e.code != 404:
+            raise
+        manifest = manifest_validators = None
+
+    if manifest is not None and local == manifest["revision"]:
+        save(local, manifest=manifest_validators)
+        log(f"Catalog is up to date at revision {local}.")
+        return local
+
+    # A local revision ahead of the server means the server was reset or rolled back
+    if (manifest is None or local == 0 or local > manifest["revision"]
+            or local + 1 < manifest.get("oldest", 1)):
+        apps, pkg_validators = fetch_json(f"{base_url}/pkg.cpm", validators.get("pkg") if manifest is None else None)
+        if apps is None:
+            log("Catalog is unchanged.")
+            return local
+        log(f"Downloaded the full catalog from {base_url}.")
+        revision = manifest["revision"] if manifest else 0
+        catalog.write(apps)
+    else:
+        changes, pkg_validators = {}, validators.get("pkg")
+        for revision in range(local + 1, manifest["revision"] + 1):
+            delta, _ = fetch_json(f"{base_url}/deltas/{revision}.json")
+            add_delta(changes, delta)
+            logging.debug(f"Fetched catalog delta {revision}")
+        catalog.append(changes)
+        if catalog.needs_compaction():
+            catalog.compact()
+        log(f"Synced catalog from revision {local} to {revision}.")
+
+    save(revision, manifest=manifest_validators, pkg=pkg_validators)
+    return revision
+
+
+class Source:
+    """One catalog server in sources.json."""
+
+    __slots__ = ("name", "url", "priority")
+
+    def __init__(self, name, url, priority=0):
+        self.name = name
+        self.url = url
+        self.priority = priority
+
+    @classmethod
+    def from_dict(cls, data):
+        name, url, priority = data["name"], data["url"], data.get("priority", 0)
+        if not isinstance(name, str) or not SOURCE_NAME.match(name):
+            raise ValueError(f"Invalid source name {name!r}")
+        if not isinstance(url, str) or not isinstance(priority, int):
+            raise ValueError(f"Source '{name}' needs a URL string and an integer priority")
+        return cls(name, url, priority)
+
+    def path(self, root):
+        return os.path.join(root, SOURCES_DIR, self.name, "pkg.cpm")
+
+
+def load_sources(path=SOURCES_FILE):
+    """Return the Sources configured in path, or [] if there is no such file."""
+    try:
+        with open(path, "r") as file:
+            entries = json.load(file)
+    except FileNotFoundError:
+        return []
+    if not isinstance(entries, list):
+        raise ValueError(f"{path} must hold a list of sources")
+    sources = [Source.from_dict(entry) for entry in entries]
+    names = [source.name for source in sources]
+    if len(set(names)) != len(names):
+        raise ValueError(f"{path} lists a source name twice")
+    return sources
+
+
+def file_stamp(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def merge_sources(sources, pkg_file, log=print):
+    """Merge the synced copies of sources into pkg_file by priority.
+
+    Returns False without reading anything if neither the sources nor
+    pkg_file changed since the last merge. Sources never synced are left out.
+    """
+    root = os.path.dirname(os.path.abspath(pkg_file))
+    merged_path = os.path.join(root, SOURCES_DIR, "merged.json")
+    stamp = [
+        [source.name, source.url, source.priority, file_stamp(source.path(root)),
+         file_stamp(CatalogFile(source.path(root)).journal_path)]
+        for source in sources
+    ]
+    try:
+        with open(merged_path, "r") as file:
+            last = json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        last = None
+    catalog = CatalogFile(pkg_file)
+    if last == {"sources": stamp, "merged": file_stamp(pkg_file)} and not catalog.pending():
+        return False
+
+    apps = {}
+    ranked = sorted(enumerate(sources), key=lambda item: (-item[1].priority, item[0]))
+    for _, source in ranked:
+        path = source.path(root)
+        if not os.path.exists(path):
+            log(f"{source.name}: not synced yet; leaving it out")
+            continue
+        for entry in CatalogFile(path).iter_entries():
+            apps.setdefault((entry["name"], entry["version"]), entry)
+    catalog.write(apps.values())
+    write_json(merged_path, {"sources": stamp, "merged": file_stamp(pkg_file)})
+    log(f"Merged {len(apps)} packages from {len(sources)} sources into {pkg_file}.")
+    return True
+
+
+def sync_sources(sources, pkg_file, log=print):
+    """Sync every source at once, then merge them into pkg_file.
+
+    A source that fails to sync is merged from its last copy. Returns True
+    if pkg_file was rewritten; raises the first error if every source failed.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    root = os.path.dirname(os.path.abspath(pkg_file))
+
+    def sync(source):
+        path = source.path(root)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            sync_catalog(path, source.url, log=lambda message: log(f"{source.name}: {message}"))
+        except (OSError, ValueError, KeyError) as e:
+            log(f"{source.name}: sync failed: {e}")
+            return e
+        return None
+
+    with ThreadPoolExecutor(max_workers=max(1, len(sources))) as pool:
+        errors = [error for error in pool.map(sync, sources) if error is not None]
+    if sources and len(errors) == len(sources):
+        raise errors[0]
+    return merge_sources(sources, pkg_file, log)
@@ -0,0 +1,54 @@
+import os
+import sys
+import functools
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+# The modules live at the top of the repository rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class Served:
+    """A directory served over HTTP at url.
+
+    requests lists the paths asked for so far; headers are added to every
+    response.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.url = None
+        self.requests = []
+        self.headers = {}
+
+
+@pytest.fixture
+def http_server(tmp_path):
+    """Serve a fresh directory over HTTP; yields a Served."""
+    served = Served(tmp_path / "www")
+    served.root.mkdir()
+
+    class Handler(QuietHandler):
+        def send_head(self):
+            served.requests.append(self.path)
+            return super().send_head()
+
+        def end_headers(self):
+            for name, value in served.headers.items():
+                self.send_header(name, value)
+            super().end_headers()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(Handler, directory=str(served.root)))
+    served.url = f"http://127.0.0.1:{server.server_address[1]}"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield served
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,106 @@
+import json
+
+import pytest
+
+import appfile
+from appfile import FormatError, export_app_txt, import_app_txt, iter_app_txt, parse_chunk
+
+
+def app(name, version="1.0", commands=("echo hi",), description=""):
+    return {"name": name, "version": version, "commands": list(commands), "description": description}
+
+
+def write_catalog(path, apps):
+    path.write_text(json.dumps(apps))
+
+
+def read_catalog(path):
+    return json.loads(path.read_text())
+
+
+def test_round_trip(tmp_path):
+    apps = [
+        app("plain", "2.0", ["sudo apt-get install -y plain"], "A plain app."),
+        app("with space", "1.0 beta", ["echo a, b", {"run": "make", "after": []}], " padded "),
+        app("breaks", "1.0", ["echo x"], "Form\x0cfeed, next\x85line and line separator."),
+        app("multi", "3", ["echo 1", "echo 2"], "First line\nsecond line\r\nthird"),
+        app('"quoted"', "1", ["[not json"], '"starts with a quote'),
+    ]
+    source = tmp_path / "pkg.cpm"
+    write_catalog(source, apps)
+    text = tmp_path / "app.txt"
+    assert export_app_txt(str(source), str(text)) == len(apps)
+
+    dest = tmp_path / "out.cpm"
+    assert import_app_txt(str(text), str(dest)) == len(apps)
+    assert read_catalog(dest) == apps
+
+
+def test_line_numbers_count_only_newlines():
+    data = "App a 1\nCommands: echo a\nDescription: x\x0cy\x85z w\nApp b 1\nDescription: no commands\n"
+    entries, errors = parse_chunk(data.encode(), first_line=10, source="f")
+    assert [(number, entry["description"]) for number, entry in entries] == [(10, "x\x0cy\x85z w")]
+    assert errors == ["f:13: b 1 has no commands"]
+
+
+def test_malformed_records_are_reported_with_their_line(tmp_path):
+    text = tmp_path / "app.txt"
+    text.write_text(
+        "Commands: echo orphan\n"
+        "App good 1\n"
+        "Commands: echo good\n"
+        "\n"
+        "App\n"
+        "Commands: echo broken\n"
+        "Description: skipped with its record\n"
+        "App json 1\n"
+        "Commands: [1, 2]\n"
+        "Something else\n"
+    )
+    dest = tmp_path / "pkg.cpm"
+    with pytest.raises(FormatError) as raised:
+        import_app_txt(str(text), str(dest))
+    assert raised.value.errors == [
+        f"{text}:1: Commands line outside an App record",
+        f"{text}:5: expected 'App <name> <version>'",
+        f"{text}:9: a JSON Commands line must be a list of commands or step objects",
+        f"{text}:10: unexpected line 'Something else'",
+    ]
+    assert not dest.exists()
+
+
+def test_invalid_utf8_is_reported_with_its_line():
+    entries, errors = parse_chunk(b"App a 1\nCommands: echo a\nDescription: \xff\n", source="f")
+    assert errors == ["f:3: not valid UTF-8"]
+    assert len(entries) == 1
+
+
+def test_duplicates_are_reported(tmp_path):
+    text = tmp_path / "app.txt"
+    text.write_text("App a 1\nCommands: echo 1\nApp b 1\nCommands: echo b\nApp a 1\nCommands: echo 2\n")
+    errors = []
+    assert [entry["commands"] for entry in iter_app_txt(str(text), errors, workers=1)] == [["echo 1"], ["echo b"]]
+    assert errors == [f"{text}:5: a 1 repeats line 1"]
+
+
+def test_parallel_parse_matches_serial(tmp_path, monkeypatch):
+    apps = [app(f"app{i}", f"1.{i}", [f"echo {i}"], f"App number {i}\x0c.") for i in range(300)]
+    source = tmp_path / "pkg.cpm"
+    write_catalog(source, apps)
+    text = tmp_path / "app.txt"
+    export_app_txt(str(source), str(text))
+    with open(text, "a") as file:
+        file.write("App broken\nApp app7 1.7\nCommands: echo again\n")
+
+    serial_errors = []
+    serial = list(iter_app_txt(str(text), serial_errors, workers=1))
+    monkeypatch.setattr(appfile, "PARALLEL_MIN", 0)
+    monkeypatch.setattr(appfile, "CHUNK_SIZE", 256)
+    parallel_errors = []
+    parallel = list(iter_app_txt(str(text), parallel_errors, workers=3))
+
+    assert parallel == serial == apps
+    assert parallel_errors == serial_errors == [
+        f"{text}:901: expected 'App <name> <version>'",
+        f"{text}:902: app7 1.7 repeats line 22",
+    ]
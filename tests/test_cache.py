@@ -0,0 +1,112 @@
+import os
+import threading
+
+import pytest
+
+from cache import DownloadCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return DownloadCache(str(tmp_path / "cache"))
+
+
+def serve(http_server, name, data):
+    (http_server.root / name).write_bytes(data)
+    return f"{http_server.url}/{name}"
+
+
+def fetch(cache, url, tmp_path, name="out"):
+    dest = tmp_path / name
+    cache.fetch(url, str(dest))
+    return dest.read_bytes()
+
+
+def test_miss_downloads_and_stores(http_server, cache, tmp_path):
+    url = serve(http_server, "a.bin", b"payload")
+    lines = []
+    cache.fetch(url, str(tmp_path / "out"), on_line=lambda stream, line: lines.append(line))
+    assert (tmp_path / "out").read_bytes() == b"payload"
+    assert lines == [f"{url}: downloaded"]
+    stats = cache.stats()
+    assert (stats["misses"], stats["urls"], stats["bytes"]) == (1, 1, len(b"payload"))
+
+
+def test_stale_entry_is_revalidated(http_server, cache, tmp_path):
+    url = serve(http_server, "a.bin", b"payload")
+    fetch(cache, url, tmp_path)
+    http_server.requests.clear()
+    assert fetch(cache, url, tmp_path, "again") == b"payload"
+    # The server was asked, answered 304 and the stored copy was used
+    assert http_server.requests == ["/a.bin"]
+    assert cache.stats()["revalidated"] == 1
+
+
+def test_changed_file_is_downloaded_again(http_server, cache, tmp_path):
+    url = serve(http_server, "a.bin", b"old")
+    fetch(cache, url, tmp_path)
+    path = http_server.root / "a.bin"
+    path.write_bytes(b"new")
+    stamp = os.stat(path).st_mtime + 10
+    os.utime(path, (stamp, stamp))
+    assert fetch(cache, url, tmp_path) == b"new"
+    assert cache.stats()["misses"] == 2
+
+
+def test_fresh_entry_is_served_without_asking(http_server, cache, tmp_path):
+    http_server.headers["Cache-Control"] = "max-age=3600"
+    url = serve(http_server, "a.bin", b"payload")
+    fetch(cache, url, tmp_path)
+    http_server.requests.clear()
+    assert fetch(cache, url, tmp_path, "again") == b"payload"
+    assert http_server.requests == []
+    assert cache.stats()["hits"] == 1
+
+
+def test_least_recently_used_is_evicted(http_server, tmp_path):
+    cache = DownloadCache(str(tmp_path / "cache"), max_size=250)
+    urls = {name: serve(http_server, name, name.encode() * 100) for name in ("a", "b", "c")}
+    fetch(cache, urls["a"], tmp_path)
+    fetch(cache, urls["b"], tmp_path)
+    fetch(cache, urls["a"], tmp_path)
+    fetch(cache, urls["c"], tmp_path)
+    assert set(cache.load_index()["urls"]) == {urls["a"], urls["c"]}
+    objects = {name for _, _, files in os.walk(cache.objects) for name in files}
+    assert len(objects) == 2
+
+
+def test_concurrent_fetches_keep_every_entry(http_server, tmp_path):
+    urls = [serve(http_server, f"{i}.bin", f"file {i}".encode() * 1000) for i in range(8)]
+    errors = []
+
+    def run(i):
+        try:
+            # Each step gets a cache object of its own, as install steps do
+            fetch(DownloadCache(str(tmp_path / "cache")), urls[i], tmp_path, f"out{i}")
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    cache = DownloadCache(str(tmp_path / "cache"))
+    assert set(cache.load_index()["urls"]) == set(urls)
+    assert cache.stats()["misses"] == 8
+
+
+def test_prune_leaves_downloads_in_progress(http_server, cache, tmp_path):
+    fetch(cache, serve(http_server, "a.bin", b"payload"), tmp_path)
+    os.makedirs(cache.objects, exist_ok=True)
+    part = os.path.join(cache.objects, "tmp1234.part")
+    orphan = os.path.join(cache.objects, "ff", "f" * 64)
+    os.makedirs(os.path.dirname(orphan))
+    for path in (part, orphan):
+        with open(path, "wb") as file:
+            file.write(b"x")
+    cache.prune()
+    assert os.path.exists(part)
+    assert not os.path.exists(orphan)
+    assert cache.stats()["urls"] == 1
@@ -0,0 +1,102 @@
+import io
+import json
+
+import pytest
+
+from catalog import App, CatalogStore, iter_catalog, version_key
+from compiled import CompiledCatalog, compile_catalog
+
+VERSIONS = ["1.0", "2.0~beta1", "1.0-rc1", "1.10", "2.0", "1.2", "2.0-rc2", "1.0.1", "unknown"]
+
+
+@pytest.fixture(params=["memory", "compiled"])
+def store(request, tmp_path):
+    apps = [{"name": "tool", "version": version, "commands": ["true"], "description": ""} for version in VERSIONS]
+    apps.append({"name": "tool 2", "version": "0.1", "commands": ["true"], "description": ""})
+    if request.param == "memory":
+        yield CatalogStore(App.from_dict(app) for app in apps)
+        return
+    source = tmp_path / "pkg.cpm"
+    source.write_text(json.dumps(apps))
+    compile_catalog(str(source))
+    catalog = CompiledCatalog.open_fresh(str(source))
+    yield catalog
+    catalog.close()
+
+
+def test_version_order():
+    ordered = ["unknown", "1.0~rc1", "1.0.beta", "1.0-rc1", "1.0", "1.0a", "1.0.1", "1.2", "1.10", "2.0~beta1", "2.0"]
+    assert sorted(reversed(ordered), key=version_key) == ordered
+
+
+def test_versions_are_oldest_first(store):
+    assert [store[app_id].version for app_id in store.versions("tool")] == [
+        "unknown", "1.0-rc1", "1.0", "1.0.1", "1.2", "1.10", "2.0~beta1", "2.0-rc2", "2.0",
+    ]
+    assert store.versions("missing") == []
+
+
+def test_bare_name_resolves_to_newest_release(store):
+    assert store[store.resolve("tool")].version == "2.0"
+
+
+def test_resolve_exact_version(store):
+    assert store[store.resolve("tool 2.0~beta1")].label == "tool 2.0~beta1"
+    assert store[store.resolve(" tool 1.0 ")].label == "tool 1.0"
+
+
+def test_resolve_prefers_a_name_with_spaces(store):
+    assert store[store.resolve("tool 2")].label == "tool 2 0.1"
+
+
+def test_resolve_unknown(store):
+    assert store.resolve("tool 9.9") is None
+    assert store.resolve("missing") is None
+
+
+VALID = [
+    "[]",
+    " \n\t[ ]\r\n",
+    " " * 300 + '[{"name": "a"}]',
+    '[1, 2.5e3, -7, "s, ]", {"a": [1, {}], "b": "}"}, null, true, false, []]',
+    '[12345678901234567890,{"x":"y"} ,  [ ]  ]  ',
+    '{"apps": [{"name": "a"}, {"name": "b"}]}',
+]
+INVALID = [
+    "",
+    "   ",
+    "x",
+    "[",
+    "[1",
+    "[1,",
+    "[1 2 3]",
+    "[,,{}]",
+    "[1,,2]",
+    "[1,]",
+    "[,]",
+    '[{"a": 1} {"b": 2}]',
+    '[{"a": 1}\n\n{"b": 2}]',
+    '[{"a": 1]',
+    "[1] x",
+    "[1]]",
+    "[tru]",
+]
+READ_SIZES = [1, 2, 3, 7, 64, 4096]
+
+
+@pytest.mark.parametrize("read_size", READ_SIZES)
+@pytest.mark.parametrize("text", VALID)
+def test_iter_catalog_matches_json(text, read_size):
+    expected = json.loads(text)
+    if isinstance(expected, dict):
+        expected = expected["apps"]
+    assert list(iter_catalog(io.StringIO(text), read_size)) == expected
+
+
+@pytest.mark.parametrize("read_size", READ_SIZES)
+@pytest.mark.parametrize("text", INVALID)
+def test_iter_catalog_rejects_what_json_rejects(text, read_size):
+    with pytest.raises(json.JSONDecodeError):
+        json.loads(text)
+    with pytest.raises(json.JSONDecodeError):
+        list(iter_catalog(io.StringIO(text), read_size))
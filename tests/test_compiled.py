@@ -0,0 +1,32 @@
+import os
+import json
+import threading
+
+from compiled import CompiledCatalog, compile_catalog, compiled_path
+
+
+def test_concurrent_compiles_do_not_race(tmp_path):
+    source = tmp_path / "pkg.cpm"
+    apps = [{"name": f"app{i}", "version": "1.0", "commands": [f"echo {i}"], "description": f"app number {i}"}
+            for i in range(2000)]
+    source.write_text(json.dumps(apps, indent=4))
+    errors = []
+
+    def compile_once():
+        try:
+            compile_catalog(str(source))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=compile_once) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert sorted(os.listdir(tmp_path)) == ["pkg.cpm", os.path.basename(compiled_path(str(source)))]
+    catalog = CompiledCatalog.open_fresh(str(source))
+    try:
+        assert len(catalog) == len(apps)
+    finally:
+        catalog.close()
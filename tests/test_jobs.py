@@ -0,0 +1,133 @@
+import fcntl
+import time
+
+import pytest
+
+from catalog import App
+from jobs import CANCELLED, DONE, FAILED, QUEUED, RUNNING, JobQueue, uses_package_manager
+from state import InstallState
+
+TIMEOUT = 10
+
+
+@pytest.fixture
+def state(tmp_path):
+    state = InstallState(str(tmp_path / "state.db"))
+    yield state
+    state.close()
+
+
+@pytest.fixture
+def queue(tmp_path, state):
+    queue = JobQueue(max_jobs=1, state=state, lock_path=str(tmp_path / "package-manager.lock"))
+    yield queue
+    queue.cancel_all()
+    for job in queue.list():
+        job.wait(TIMEOUT)
+
+
+def app(name, *commands):
+    return App(name, "1.0", commands)
+
+
+def wait_for(path):
+    """A step that waits until path exists."""
+    return f"while [ ! -e {path} ]; do sleep 0.02; done"
+
+
+def poll(condition):
+    deadline = time.monotonic() + TIMEOUT
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_jobs_run_in_order(queue, tmp_path):
+    log = tmp_path / "log"
+    go = tmp_path / "go"
+    first = queue.submit([app("first", wait_for(go), f"echo first >> {log}")])
+    second = queue.submit([app("second", f"echo second >> {log}")])
+    poll(lambda: first.status == RUNNING)
+    assert second.status == QUEUED
+    assert queue.active()
+
+    go.touch()
+    assert second.wait(TIMEOUT)
+    assert (first.status, second.status) == (DONE, DONE)
+    assert log.read_text() == "first\nsecond\n"
+    assert first.progress == 100 and first.seconds_left() == 0.0
+    assert first.packages == {"first 1.0": 100}
+    assert not queue.active()
+
+
+def test_failed_step_fails_the_job(queue):
+    job = queue.submit([app("broken", "echo nope; exit 3", "echo after")])
+    assert job.wait(TIMEOUT)
+    assert job.status == FAILED
+    assert len(job.errors) == 1 and job.errors[0].startswith("[broken 1.0] Command 'echo nope; exit 3' failed: nope")
+
+
+def test_cancel_queued_job(queue, tmp_path):
+    running = queue.submit([app("running", wait_for(tmp_path / "go"))])
+    queued = queue.submit([app("queued", f"touch {tmp_path / 'ran'}")])
+    assert queue.cancel(queued.id)
+    assert queued.status == CANCELLED and queued.finished.is_set()
+    assert queued.errors == [f"Install job {queued.id} was cancelled"]
+    assert not queue.cancel(queued.id)
+    assert not queue.cancel(999)
+
+    (tmp_path / "go").touch()
+    assert running.wait(TIMEOUT)
+    assert running.status == DONE
+    assert not (tmp_path / "ran").exists()
+
+
+def test_cancel_running_job(queue, tmp_path):
+    job = queue.submit([app("slow", f"touch {tmp_path / 'started'}; sleep 30", f"touch {tmp_path / 'ran'}")])
+    poll((tmp_path / "started").exists)
+    started = time.monotonic()
+    assert queue.cancel(job.id)
+    assert job.wait(TIMEOUT)
+    assert time.monotonic() - started < TIMEOUT
+    assert job.status == CANCELLED
+    assert job.errors[0] == f"Install job {job.id} was cancelled"
+    assert not (tmp_path / "ran").exists()
+
+
+def test_package_manager_steps_run_one_at_a_time(tmp_path, state):
+    queue = JobQueue(max_jobs=2, state=state, lock_path=str(tmp_path / "package-manager.lock"))
+    log = tmp_path / "log"
+    jobs = [
+        queue.submit([app(name, f": dpkg; echo {name} start >> {log}; sleep 0.3; echo {name} end >> {log}")])
+        for name in ("a", "b")
+    ]
+    for job in jobs:
+        assert job.wait(TIMEOUT)
+        assert job.status == DONE
+    lines = log.read_text().split("\n")
+    assert lines in (["a start", "a end", "b start", "b end", ""], ["b start", "b end", "a start", "a end", ""])
+
+
+def test_package_manager_lock_is_shared_with_other_processes(queue, tmp_path):
+    with open(queue.lock_path, "a") as held:
+        fcntl.flock(held, fcntl.LOCK_EX)
+        job = queue.submit([app("dpkg", f": dpkg; touch {tmp_path / 'ran'}")])
+        poll(lambda: job.status == RUNNING)
+        time.sleep(0.5)
+        assert not (tmp_path / "ran").exists()
+        # Cancelling does not wait for the lock
+        assert queue.cancel(job.id)
+        assert job.wait(TIMEOUT)
+    assert job.status == CANCELLED
+    assert not (tmp_path / "ran").exists()
+
+
+@pytest.mark.parametrize("command, expected", [
+    ("sudo apt-get install -y vlc", True),
+    ("sudo dpkg -i package.deb", True),
+    ("cd build && /usr/bin/apt update", True),
+    ("make install", False),
+    ("echo adapt", False),
+])
+def test_uses_package_manager(command, expected):
+    assert uses_package_manager(command) == expected
@@ -0,0 +1,64 @@
+import os
+import sys
+import json
+
+import pytest
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+pytest.importorskip("PyQt5")
+
+from PyQt5.QtWidgets import QApplication, QMessageBox
+
+import main
+
+
+def entry(name):
+    return {"name": name, "version": "1.0", "commands": [f"echo {name}"], "description": ""}
+
+
+@pytest.fixture
+def installer(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(QMessageBox, "critical", lambda *args: None)
+    # PyQt aborts on an exception in a slot unless sys.excepthook is replaced
+    errors = []
+    monkeypatch.setattr(sys, "excepthook", lambda kind, value, traceback: errors.append(value))
+    (tmp_path / "pkg.cpm").write_text(json.dumps([entry("a"), entry("b"), entry("c")]))
+    app = QApplication.instance() or QApplication([])
+    window = main.AppInstaller()
+    window.loader.wait()
+    app.processEvents()
+    window.errors = errors
+    yield window
+    window.watch_timer.stop()
+    window.loader.wait()
+    window.app_filter.stop()
+    window.close()
+
+
+def reload(window):
+    window.reload_catalog()
+    window.loader.wait()
+    QApplication.instance().processEvents()
+
+
+def names(window):
+    return sorted(app.name for app in window.apps)
+
+
+def test_reload_swaps_in_the_new_catalog(installer, tmp_path):
+    assert names(installer) == ["a", "b", "c"]
+    (tmp_path / "pkg.cpm").write_text(json.dumps([entry("a"), entry("d")]))
+    reload(installer)
+    assert installer.errors == []
+    assert names(installer) == ["a", "d"]
+
+
+def test_reload_with_a_parse_error_keeps_the_loaded_catalog(installer, tmp_path):
+    text = json.dumps([entry("x"), entry("y"), entry("z")])
+    # Corrupt the third entry, so the first two are read before the error
+    (tmp_path / "pkg.cpm").write_text(text[:text.rindex("{")] + '{"name": }]')
+    reload(installer)
+    assert installer.errors == []
+    assert installer.reloaded is None
+    assert names(installer) == ["a", "b", "c"]
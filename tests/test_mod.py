@@ -0,0 +1,26 @@
+import pytest
+
+pytest.importorskip("PyQt5")
+
+from mod import commands_text, parse_commands_text
+
+
+@pytest.mark.parametrize("commands", [
+    ["echo a", "make install"],
+    ["echo a, b", "[ -f x ] || touch x"],
+    ["[ -f x ] && echo found"],
+    [{"id": "fetch", "run": "wget https://example.com/a"}, {"run": "make", "after": ["fetch"]}],
+    ["printf 'a\\nb'", "echo multi\nline"],
+])
+def test_commands_round_trip(commands):
+    assert parse_commands_text(commands_text(commands)) == commands
+
+
+def test_plain_lines_are_commands():
+    assert parse_commands_text("  echo a \n\n[ -d build ] || mkdir build\n") == ["echo a", "[ -d build ] || mkdir build"]
+
+
+@pytest.mark.parametrize("text", ['[1, 2]', '[{"run": "x", "after": ["missing"]}]', '[{"id": "x"}]'])
+def test_malformed_json_is_rejected(text):
+    with pytest.raises(ValueError):
+        parse_commands_text(text)
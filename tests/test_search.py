@@ -0,0 +1,123 @@
+import pytest
+
+from catalog import App, CatalogStore
+from search import SearchIndex, typo_distance
+
+APPS = [
+    ("update_app", "Update the main Python script to the latest version."),
+    ("update_lists", "Refresh the list of available apps."),
+    ("vlc", "Media player that can play a DVD."),
+    ("dvdstyler", "Author DVD menus."),
+    ("handbrake", "Convert video, for example from a dvd."),
+    ("netbeans", "Java IDE; update plugins from the tools menu."),
+]
+
+
+@pytest.fixture
+def store():
+    return CatalogStore(App(name, "1.0", ["true"], description) for name, description in APPS)
+
+
+def names(store, ids):
+    return [store[app_id].name for app_id in ids]
+
+
+def test_name_matches_rank_above_description_matches(store):
+    found = names(store, store.rank("dvd"))
+    assert found[0] == "dvdstyler"
+    assert sorted(found[1:]) == ["handbrake", "vlc"]
+    assert names(store, store.rank("update"))[-1] == "netbeans"
+
+
+def test_rank_keeps_the_best_limit_results(store):
+    assert names(store, store.rank("dvd", 1)) == ["dvdstyler"]
+    assert names(store, store.rank("", 2)) == ["update_app", "update_lists"]
+
+
+@pytest.mark.parametrize("limit", [0, -1])
+def test_rank_without_room_for_results_is_empty(store, limit):
+    assert store.rank("update", limit) == []
+    assert store.rank("", limit) == []
+
+
+@pytest.mark.parametrize("term", ["udpate", "updte", "upadte", "UPDAET"])
+def test_names_with_a_typo_match(store, term):
+    assert names(store, store.rank(term))[:2] == ["update_app", "update_lists"]
+
+
+@pytest.mark.parametrize("term", ["mnetest", "qzxwv", "pythonic"])
+def test_unrelated_terms_do_not_match(store, term):
+    assert store.rank(term) == []
+
+
+def test_typo_matches_rank_below_substring_matches(store):
+    store.add(App("updte", "1.0", ["true"], "Spelled without the a."))
+    assert names(store, store.rank("updte"))[0] == "updte"
+
+
+@pytest.mark.parametrize("term, text, distance", [
+    ("update", "update_app", 0),
+    ("udpate", "update_app", 1),
+    ("updte", "my-update", 1),
+    ("updaet", "update", 1),
+    ("mnetest", "latest", 3),
+    ("abc", "", 3),
+])
+def test_typo_distance(term, text, distance):
+    assert typo_distance(term, text) == distance
+
+
+@pytest.fixture
+def index():
+    index = SearchIndex()
+    index.add(3, "VLC media player", "Plays DVDs")
+    index.add(1, "HandBrake", "Video transcoder")
+    index.add(2, "dvdstyler", "DVD authoring")
+    return index
+
+
+@pytest.mark.parametrize("term, expected", [
+    ("", [1, 2, 3]),
+    ("d", [1, 2, 3]),
+    ("dv", [2, 3]),
+    ("dvd", [2, 3]),
+    ("DVDs", [2, 3]),
+    ("media play", [3]),
+    ("brake", [1]),
+    ("transcoder", [1]),
+    ("dvds player", []),
+    ("xyz", []),
+])
+def test_search_finds_substrings_of_any_field(index, term, expected):
+    assert index.search(term) == expected
+
+
+def test_add_replaces_a_document(index):
+    index.add(3, "mpv", "Minimal player")
+    assert len(index) == 3
+    assert index.search("vlc") == []
+    assert index.search("dvd") == [2]
+    assert index.search("minimal") == [3]
+
+
+def test_remove_drops_a_document(index):
+    index.remove(2)
+    index.remove(42)
+    assert 2 not in index and len(index) == 2
+    assert index.search("dvd") == [3]
+    assert index.search("styler") == []
+    index.remove(1)
+    index.remove(3)
+    assert index.search("") == []
+    assert all(not postings for postings in index._postings)
+
+
+def test_store_keeps_its_index_in_step(store):
+    app_id = store.find("vlc", "1.0")
+    store.update(app_id, App("vlc", "1.0", ["true"], "Now without discs."))
+    assert names(store, store.search("dvd")) == ["dvdstyler", "handbrake"]
+    store.add(App("vlc", "1.0", ["true"], "A DVD player again."))
+    assert names(store, store.search("dvd")) == ["vlc", "dvdstyler", "handbrake"]
+    store.remove(store.find("dvdstyler", "1.0"))
+    assert names(store, store.search("dvd")) == ["vlc", "handbrake"]
+    assert names(store, store.rank("dvd")) == ["vlc", "handbrake"]
@@ -0,0 +1,94 @@
+import os
+import threading
+
+import pytest
+
+from session import ShellSession
+
+
+@pytest.fixture
+def session(tmp_path):
+    session = ShellSession(cwd=str(tmp_path))
+    # A step that hangs the session fails the test instead of blocking it
+    watchdog = threading.Timer(10, session.terminate)
+    watchdog.start()
+    yield session
+    watchdog.cancel()
+    session.close()
+
+
+def test_state_carries_over(session, tmp_path):
+    (tmp_path / "sub").mkdir()
+    assert session.run("cd sub && export CPM_TEST=value")[0] == 0
+    status, lines, _ = session.run('echo "$CPM_TEST"; pwd')
+    assert status == 0
+    assert lines == ["value", str(tmp_path / "sub")]
+    assert session.cwd == str(tmp_path / "sub")
+
+
+@pytest.mark.parametrize("command", ["echo 'unterminated", 'echo "unterminated', "if true; then echo x"])
+def test_syntax_error_fails_the_step(session, command):
+    status, lines, _ = session.run(command)
+    assert status == 2
+    assert any("unexpected" in line for line in lines)
+    # The session is still usable afterwards
+    assert session.run("echo next")[:2] == (0, ["next"])
+
+
+def test_unterminated_heredoc_ends_with_the_step(session):
+    status, lines, _ = session.run("cat <<EOF\nhello")
+    assert status == 0
+    assert "hello" in lines
+    assert session.run("echo next")[:2] == (0, ["next"])
+
+
+def test_exit_ends_the_shell(session):
+    assert session.run("echo a; exit 3")[:2] == (3, ["a"])
+    assert session.run("echo b")[:2] == (0, ["b"])
+
+
+FAKE_SUDO = """#!/bin/sh
+# Credentials are valid while $SUDO_STAMP exists
+echo "$*" >> "$SUDO_LOG"
+case "$1" in
+-S)
+    read password
+    [ "$password" = secret ] && touch "$SUDO_STAMP"
+    ;;
+-n)
+    shift
+    [ -e "$SUDO_STAMP" ] || { echo "sudo: a password is required" >&2; exit 1; }
+    [ "$1" = -v ] && exit 0
+    exec "$@"
+    ;;
+esac
+"""
+
+
+@pytest.fixture
+def fake_sudo(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    sudo = bin_dir / "sudo"
+    sudo.write_text(FAKE_SUDO)
+    sudo.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}:{os.environ['PATH']}")
+    monkeypatch.setenv("SUDO_LOG", str(tmp_path / "sudo.log"))
+    monkeypatch.setenv("SUDO_STAMP", str(tmp_path / "stamp"))
+    return tmp_path / "sudo.log", tmp_path / "stamp"
+
+
+def test_sudo_password_is_only_sent_again_once_expired(fake_sudo, tmp_path):
+    log, stamp = fake_sudo
+    session = ShellSession("secret", cwd=str(tmp_path))
+    try:
+        assert session.run("sudo echo one")[:2] == (0, ["one"])
+        assert session.run("sudo echo two")[:2] == (0, ["two"])
+        assert log.read_text().count("-S") == 1
+
+        # The cached credentials time out, e.g. during a long build
+        stamp.unlink()
+        assert session.run("sudo echo three")[:2] == (0, ["three"])
+        assert log.read_text().count("-S") == 2
+    finally:
+        session.close()
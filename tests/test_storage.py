@@ -0,0 +1,55 @@
+import os
+import time
+
+import storage
+from storage import FileWatcher
+
+
+def age(path, seconds):
+    mtime = time.time() - seconds
+    os.utime(path, (mtime, mtime))
+
+
+def test_watcher_hashes_only_recently_modified_files(tmp_path, monkeypatch):
+    old, new = tmp_path / "old", tmp_path / "new"
+    old.write_text("old")
+    new.write_text("new")
+    age(old, 60)
+    hashed = []
+    digest = FileWatcher._digest
+    monkeypatch.setattr(FileWatcher, "_digest", lambda self: hashed.append(self.paths) or digest(self))
+
+    FileWatcher([old])
+    assert hashed == []
+    FileWatcher([new])
+    assert hashed == [[new]]
+
+
+def test_watcher_sees_rewrites_within_the_same_mtime(tmp_path):
+    path = tmp_path / "pkg.cpm"
+    path.write_text("[1]")
+    stat = os.stat(path)
+    watcher = FileWatcher([path])
+    path.write_text("[2]")
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert watcher.changed()
+    assert not watcher.changed()
+
+
+def test_watcher_ignores_a_touch_once_hashed(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, "RACY_SECONDS", 0)
+    path = tmp_path / "pkg.cpm"
+    path.write_text("[]")
+    age(path, 60)
+    watcher = FileWatcher([path])
+    assert not watcher.changed()
+
+    age(path, 30)
+    # No hash was taken yet to tell a touch from a change
+    assert watcher.changed()
+    age(path, 20)
+    assert not watcher.changed()
+    path.write_text("[1]")
+    assert watcher.changed()
+    path.unlink()
+    assert watcher.changed()
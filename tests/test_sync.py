@@ -0,0 +1,175 @@
+import os
+import json
+import itertools
+import urllib.error
+
+import pytest
+
+from storage import CatalogFile
+from sync import Source, sync_catalog, sync_sources
+
+# Files are published with increasing mtimes, so Last-Modified changes even
+# when a test publishes twice within a second
+CLOCK = itertools.count(1_700_000_000, 10)
+
+
+def app(name, version="1.0"):
+    return {"name": name, "version": version, "commands": [f"echo {name}"], "description": ""}
+
+
+def publish(root, name, data):
+    path = root / name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(data))
+    stamp = next(CLOCK)
+    os.utime(path, (stamp, stamp))
+
+
+def publish_catalog(root, apps, revision=None, oldest=1):
+    publish(root, "pkg.cpm", apps)
+    if revision is not None:
+        publish(root, "manifest.json", {"revision": revision, "oldest": oldest})
+
+
+def publish_delta(root, revision, upsert=(), remove=()):
+    publish(root, f"deltas/{revision}.json", {
+        "revision": revision, "upsert": list(upsert),
+        "remove": [{"name": name, "version": version} for name, version in remove],
+    })
+
+
+@pytest.fixture
+def pkg_file(tmp_path):
+    (tmp_path / "client").mkdir()
+    return str(tmp_path / "client" / "pkg.cpm")
+
+
+def entries(pkg_file):
+    return list(CatalogFile(pkg_file).iter_entries())
+
+
+def sync(pkg_file, url):
+    return sync_catalog(pkg_file, url, log=lambda message: None)
+
+
+def test_first_sync_downloads_the_whole_catalog(http_server, pkg_file):
+    root, url, requests = http_server.root, http_server.url, http_server.requests
+    publish_catalog(root, [app("a"), app("b")], revision=3)
+    assert sync(pkg_file, url) == 3
+    assert entries(pkg_file) == [app("a"), app("b")]
+    assert "/pkg.cpm" in requests
+    assert not any(path.startswith("/deltas/") for path in requests)
+
+
+def test_deltas_are_applied_in_order(http_server, pkg_file):
+    root, url, requests = http_server.root, http_server.url, http_server.requests
+    publish_catalog(root, [app("a"), app("b"), app("c")], revision=1)
+    sync(pkg_file, url)
+
+    publish_delta(root, 2, upsert=[app("d")], remove=[("b", "1.0")])
+    publish_delta(root, 3, upsert=[dict(app("a"), description="changed")])
+    publish_catalog(root, [], revision=3)
+    requests.clear()
+    assert sync(pkg_file, url) == 3
+    assert entries(pkg_file) == [dict(app("a"), description="changed"), app("c"), app("d")]
+    assert requests == ["/manifest.json", "/deltas/2.json", "/deltas/3.json"]
+
+
+def test_up_to_date_catalog_is_left_alone(http_server, pkg_file):
+    root, url, requests = http_server.root, http_server.url, http_server.requests
+    publish_catalog(root, [app("a")], revision=4)
+    sync(pkg_file, url)
+    stamp = os.stat(pkg_file).st_mtime_ns
+
+    requests.clear()
+    assert sync(pkg_file, url) == 4
+    assert requests == ["/manifest.json"]
+    assert os.stat(pkg_file).st_mtime_ns == stamp
+
+
+def test_client_older_than_the_oldest_delta_downloads_everything(http_server, pkg_file):
+    root, url, requests = http_server.root, http_server.url, http_server.requests
+    publish_catalog(root, [app("a")], revision=2)
+    sync(pkg_file, url)
+
+    publish_catalog(root, [app("z")], revision=9, oldest=6)
+    requests.clear()
+    assert sync(pkg_file, url) == 9
+    assert entries(pkg_file) == [app("z")]
+    assert "/pkg.cpm" in requests
+
+
+def test_server_behind_the_client_downloads_everything(http_server, pkg_file):
+    root, url, requests = http_server.root, http_server.url, http_server.requests
+    publish_catalog(root, [app("a")], revision=5)
+    sync(pkg_file, url)
+
+    # The server was reset to an earlier revision
+    publish_catalog(root, [app("b"), app("c")], revision=2)
+    requests.clear()
+    assert sync(pkg_file, url) == 2
+    assert entries(pkg_file) == [app("b"), app("c")]
+    assert "/pkg.cpm" in requests
+
+    publish_delta(root, 3, upsert=[app("d")])
+    publish_catalog(root, [], revision=3)
+    assert sync(pkg_file, url) == 3
+    assert entries(pkg_file) == [app("b"), app("c"), app("d")]
+
+
+def test_server_without_manifest_is_fetched_conditionally(http_server, pkg_file):
+    root, url, requests = http_server.root, http_server.url, http_server.requests
+    publish_catalog(root, [app("a")])
+    assert sync(pkg_file, url) == 0
+    stamp = os.stat(pkg_file).st_mtime_ns
+
+    # Unchanged: the server answers 304 and the file is not rewritten
+    assert sync(pkg_file, url) == 0
+    assert os.stat(pkg_file).st_mtime_ns == stamp
+
+    publish_catalog(root, [app("a"), app("b")])
+    sync(pkg_file, url)
+    assert entries(pkg_file) == [app("a"), app("b")]
+
+
+def test_missing_delta_leaves_the_catalog_unchanged(http_server, pkg_file):
+    root, url = http_server.root, http_server.url
+    publish_catalog(root, [app("a")], revision=1)
+    sync(pkg_file, url)
+
+    publish_delta(root, 2, upsert=[app("b")])
+    publish_catalog(root, [], revision=3)
+    with pytest.raises(urllib.error.HTTPError):
+        sync(pkg_file, url)
+    assert entries(pkg_file) == [app("a")]
+
+
+def test_deltas_are_journaled(http_server, pkg_file):
+    root, url = http_server.root, http_server.url
+    publish_catalog(root, [app("a"), app("b")], revision=1)
+    sync(pkg_file, url)
+    stamp = os.stat(pkg_file).st_mtime_ns
+
+    publish_delta(root, 2, upsert=[app("c")], remove=[("a", "1.0")])
+    publish_catalog(root, [], revision=2)
+    sync(pkg_file, url)
+    assert os.stat(pkg_file).st_mtime_ns == stamp
+    assert CatalogFile(pkg_file).pending()
+    assert entries(pkg_file) == [app("b"), app("c")]
+
+
+def test_merged_sources_follow_journaled_deltas(http_server, tmp_path):
+    root, url = http_server.root, http_server.url
+    publish_catalog(root / "main", [app("a"), app("b")], revision=1)
+    publish_catalog(root / "extra", [dict(app("a"), description="extra")], revision=1)
+    sources = [Source("main", f"{url}/main"), Source("extra", f"{url}/extra", priority=5)]
+    pkg_file = str(tmp_path / "pkg.cpm")
+
+    assert sync_sources(sources, pkg_file, log=lambda message: None)
+    assert entries(pkg_file) == [dict(app("a"), description="extra"), app("b")]
+
+    publish_delta(root / "main", 2, upsert=[app("c")])
+    publish_catalog(root / "main", [], revision=2)
+    assert sync_sources(sources, pkg_file, log=lambda message: None)
+    assert entries(pkg_file) == [dict(app("a"), description="extra"), app("b"), app("c")]
+    assert not sync_sources(sources, pkg_file, log=lambda message: None)
@@ -0,0 +1,102 @@
+import pytest
+
+import transaction
+from steps import Step
+from transaction import MIN_SECONDS, PackageProgress, TimedProgress
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(transaction.time, "monotonic", clock)
+    return clock
+
+
+def chain(*packages):
+    """Steps that each wait for the one before, belonging to packages[i]."""
+    return [Step(i, f"step {i}", [i - 1] if i else [], (label,)) for i, label in enumerate(packages)]
+
+
+def test_progress_is_weighted_by_duration(clock):
+    steps = chain("a", "a")
+    timing = TimedProgress(steps, {0: 10.0, 1: 30.0}, workers=1)
+    assert timing.fraction() == 0.0
+    assert timing.seconds_left() == 40.0
+
+    timing.start(steps[0])
+    clock.now += 10
+    timing.done(steps[0])
+    assert timing.fraction() == 0.25
+    assert timing.seconds_left() == 30.0
+
+    timing.start(steps[1])
+    clock.now += 15
+    assert timing.fraction() == pytest.approx(0.625)
+    assert timing.seconds_left() == pytest.approx(15.0)
+
+
+def test_step_running_past_its_estimate_is_nearly_done(clock):
+    steps = chain("a")
+    timing = TimedProgress(steps, {0: 5.0}, workers=1)
+    timing.start(steps[0])
+    clock.now += 60
+    assert timing.seconds_left() == MIN_SECONDS
+    assert timing.fraction() == pytest.approx(1 - MIN_SECONDS / 5.0)
+    timing.done(steps[0])
+    assert timing.fraction() == 1.0
+    assert timing.seconds_left() == 0.0
+
+
+@pytest.mark.parametrize("workers, expected", [(1, 40.0), (2, 20.0), (4, 10.0), (8, 10.0)])
+def test_time_left_spreads_independent_steps_over_workers(clock, workers, expected):
+    steps = [Step(i, f"step {i}", [], ("a",)) for i in range(4)]
+    timing = TimedProgress(steps, {i: 10.0 for i in range(4)}, workers)
+    assert timing.seconds_left() == expected
+
+
+def test_time_left_follows_the_critical_path(clock):
+    steps = chain("a", "a", "a") + [Step(3, "step 3", [], ("b",))]
+    timing = TimedProgress(steps, {0: 10.0, 1: 10.0, 2: 10.0, 3: 5.0}, workers=2)
+    assert timing.seconds_left() == 30.0
+    timing.done(steps[0])
+    timing.done(steps[3])
+    assert timing.seconds_left() == 20.0
+
+
+def test_unknown_estimates_count_as_minimal(clock):
+    steps = chain("a", "a")
+    timing = TimedProgress(steps, {}, workers=1)
+    assert timing.seconds_left() == pytest.approx(2 * MIN_SECONDS)
+    timing.done(steps[0])
+    assert timing.fraction() == pytest.approx(0.5)
+
+
+def test_no_steps():
+    timing = TimedProgress([], {}, workers=1)
+    assert timing.fraction() == 1.0
+    assert timing.seconds_left() == 0.0
+
+
+def test_package_progress_counts_steps():
+    steps = chain("a", "a", "b")
+    steps.append(Step(3, "shared", [], ("a", "b")))
+    progress = PackageProgress(steps)
+    assert progress.step_done(steps[0]) == {"a": 33}
+    assert progress.step_done(steps[3]) == {"a": 66, "b": 50}
+    assert progress.step_done(steps[2]) == {"b": 100}
+    assert progress.step_done(steps[1]) == {"a": 100}
+
+
+def test_package_progress_weighs_steps_by_estimate():
+    steps = chain("a", "a")
+    progress = PackageProgress(steps, {0: 1.0, 1: 3.0})
+    assert progress.step_done(steps[0]) == {"a": 25}
+    assert progress.step_done(steps[1]) == {"a": 100}
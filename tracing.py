@@ -0,0 +1,128 @@
+import os
+import json
+import time
+import atexit
+import logging
+import threading
+from contextlib import contextmanager
+
+# Set CPM_DEBUG=1 for DEBUG logging; the default keeps logging cheap
+LOG_LEVEL = logging.DEBUG if os.environ.get("CPM_DEBUG") else logging.INFO
+
+_enabled = False
+_path = None
+_spans = []
+_lock = threading.Lock()
+_local = threading.local()
+_origin = time.perf_counter()
+
+
+class Span:
+    """One timed region. set() attaches fields such as exit codes or byte counts."""
+
+    __slots__ = ("name", "category", "args", "start", "wall", "cpu", "thread")
+
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+        self.thread = threading.get_ident()
+
+    def set(self, **args):
+        self.args.update(args)
+
+    def to_dict(self):
+        return {
+            "name": self.name, "cat": self.category, "start": self.start,
+            "wall": self.wall, "cpu": self.cpu, "thread": self.thread, **self.args,
+        }
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def set(self, **args):
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+def enabled():
+    return _enabled
+
+
+def enable(path=None):
+    """Start recording spans; they are written to path at exit, if given."""
+    global _enabled, _path
+    _enabled = True
+    _path = path
+    if path:
+        atexit.register(save)
+
+
+@contextmanager
+def span(name, category="cpm", **args):
+    """Time the block as a span. Costs one flag check while tracing is off.
+
+    Records wall time and the CPU time of the calling thread; the block can
+    add fields through the yielded span's set().
+    """
+    if not _enabled:
+        yield NULL_SPAN
+        return
+    record = Span(name, category, args)
+    stack = _local.__dict__.setdefault("stack", [])
+    stack.append(record)
+    cpu = time.thread_time()
+    record.start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record.wall = time.perf_counter() - record.start
+        record.cpu = time.thread_time() - cpu
+        record.start -= _origin
+        stack.pop()
+        with _lock:
+            _spans.append(record)
+
+
+def annotate(**args):
+    """Add fields to the innermost open span of this thread, if any."""
+    if _enabled:
+        stack = getattr(_local, "stack", None)
+        if stack:
+            stack[-1].set(**args)
+
+
+def spans():
+    with _lock:
+        return [record.to_dict() for record in _spans]
+
+
+def export(path):
+    """Write the spans as JSON lines (*.jsonl) or as a Chrome trace (anything else)."""
+    records = spans()
+    with open(path, "w") as file:
+        if path.endswith(".jsonl"):
+            for record in records:
+                file.write(json.dumps(record) + "\n")
+            return
+        events = [
+            {
+                "name": record["name"], "cat": record["cat"], "ph": "X",
+                "ts": record["start"] * 1e6, "dur": record["wall"] * 1e6,
+                "pid": os.getpid(), "tid": record["thread"],
+                "args": {key: value for key, value in record.items()
+                         if key not in ("name", "cat", "start", "wall", "thread")},
+            }
+            for record in records
+        ]
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
+
+
+def save():
+    """Export to the path given to enable(), if any."""
+    if _path:
+        export(_path)
+        logging.info(f"Wrote {len(_spans)} trace spans to {_path}")
@@ -0,0 +1,231 @@
+import time
+import shlex
+import threading
+from collections import Counter
+
+from steps import Step, parse_steps
+
+APT_TOOLS = ("apt", "apt-get")
+REPO_TOOLS = ("add-apt-repository", "apt-add-repository")
+# Options whose value is a separate word; installs using them are left alone
+OPTIONS_WITH_VALUES = ("-o", "-t", "-c", "--option", "--target-release", "--config-file")
+UPGRADE_COMMANDS = ("upgrade", "full-upgrade", "dist-upgrade")
+SHELL_CHARS = set("|&;<>$`(){}*?\\\n")
+# Least weight of a step, so instant and skipped steps still count
+MIN_SECONDS = 0.01
+
+
+def classify(command):
+    """Return (kind, sudo, options, packages) for apt housekeeping commands.
+
+    kind is "refresh", "upgrade", "install" or "repo". Anything else, including
+    commands using shell syntax, returns None and is never rewritten.
+    """
+    if SHELL_CHARS & set(command):
+        return None
+    try:
+        words = shlex.split(command)
+    except ValueError:
+        return None
+    sudo = bool(words) and words[0] == "sudo"
+    if sudo:
+        words = words[1:]
+    if not words:
+        return None
+
+    tool, args = words[0], words[1:]
+    if tool in REPO_TOOLS:
+        return ("repo", sudo, (), ())
+    if tool not in APT_TOOLS or not args:
+        return None
+
+    options = tuple(sorted(arg for arg in args[1:] if arg.startswith("-")))
+    packages = tuple(arg for arg in args[1:] if not arg.startswith("-"))
+    if any(option.split("=")[0] in OPTIONS_WITH_VALUES for option in options):
+        return None
+    if args[0] == "update" and not packages:
+        return ("refresh", sudo, options, ())
+    if args[0] in UPGRADE_COMMANDS and not packages:
+        return ("upgrade", sudo, options, ())
+    if args[0] == "install" and packages:
+        return ("install", sudo, options, packages)
+    return None
+
+
+def plan_transaction(apps):
+    """Plan the install of several apps as one list of Steps.
+
+    Each app's leading apt housekeeping (adding repositories, refreshing the
+    package index, apt-get install) is hoisted into a shared phase that adds
+    repositories once, refreshes the index once and installs every package
+    with compatible options in a single apt-get call. The remaining steps of
+    each app run afterwards, app after app; a later index refresh is dropped
+    when nothing changed the repositories since the last one. Every Step
+    records the labels of the apps it belongs to in step.packages.
+    """
+    repos = {}
+    refresh = None
+    installs = {}
+    tails = []
+
+    for app in apps:
+        label = app.label
+        steps = parse_steps(app.commands)
+        prelude = 0
+        for entry in app.commands:
+            kind = classify(entry) if isinstance(entry, str) else None
+            if kind is None or kind[0] == "upgrade":
+                break
+            prelude += 1
+            if kind[0] == "repo":
+                repos.setdefault(entry, []).append(label)
+            elif kind[0] == "refresh":
+                if refresh is None:
+                    refresh = (entry, [])
+                refresh[1].append(label)
+            else:
+                _, sudo, options, packages = kind
+                group = installs.setdefault((sudo, options), ([], [], []))
+                group[0].append(entry)
+                group[1].extend(p for p in packages if p not in group[1])
+                group[2].append(label)
+        tails.append((label, steps, prelude))
+
+    plan = []
+
+    def add(command, after, packages, creates=()):
+        step = Step(len(plan), command, after, tuple(dict.fromkeys(packages)), creates)
+        plan.append(step)
+        return step.index
+
+    anchor = []
+    for command, labels in repos.items():
+        anchor = [add(command, anchor, labels)]
+    refreshed = refresh is not None
+    if refreshed:
+        anchor = [add(refresh[0], anchor, refresh[1])]
+    for (sudo, options), (commands, packages, labels) in installs.items():
+        if len(commands) == 1:
+            command = commands[0]
+        else:
+            words = (["sudo"] if sudo else []) + ["apt-get", "install", *options, *packages]
+            command = " ".join(shlex.quote(word) for word in words)
+        anchor = [add(command, anchor, labels)]
+
+    for label, steps, prelude in tails:
+        mapping = {}
+        has_dependents = set()
+        for step in steps[prelude:]:
+            kind = classify(step.command)
+            kind = kind[0] if kind else None
+            after = []
+            for dep in step.after:
+                if dep >= prelude:
+                    after.extend(mapping[dep])
+                    has_dependents.update(mapping[dep])
+            if not after:
+                after = list(anchor)
+
+            if kind == "refresh" and refreshed:
+                mapping[step.index] = after
+                continue
+            if kind == "repo":
+                refreshed = False
+            elif kind == "refresh":
+                refreshed = True
+            mapping[step.index] = [add(step.command, after, [label], step.creates)]
+
+        added = [index for indices in mapping.values() for index in indices]
+        sinks = [index for index in dict.fromkeys(added) if index not in has_dependents]
+        if sinks:
+            anchor = sinks
+
+    return plan
+
+
+class PackageProgress:
+    """Track per-package completion of a transaction's steps.
+
+    With estimates, {step index: expected seconds}, steps count by their
+    expected duration rather than one each.
+    """
+
+    def __init__(self, steps, estimates=None):
+        self.weights = {
+            step.index: 1.0 if estimates is None else max(estimates.get(step.index, 0.0), MIN_SECONDS)
+            for step in steps
+        }
+        self.totals = Counter()
+        for step in steps:
+            for label in step.packages:
+                self.totals[label] += self.weights[step.index]
+        self.finished = Counter()
+
+    def step_done(self, step):
+        """Record a finished step and return {label: percent} for its packages."""
+        percents = {}
+        for label in step.packages:
+            self.finished[label] += self.weights[step.index]
+            percents[label] = min(100, int(self.finished[label] / self.totals[label] * 100))
+        return percents
+
+
+class TimedProgress:
+    """Duration-weighted progress and time left of a transaction.
+
+    estimates maps step indexes to expected seconds. Progress is the share
+    of the expected time held by finished steps, plus what running steps
+    have spent of theirs. The time left is the longer of the remaining
+    critical path and the remaining work spread over workers. start() and
+    done() may be called from another thread than the readers.
+    """
+
+    def __init__(self, steps, estimates, workers):
+        self.estimates = {step.index: max(estimates.get(step.index, 0.0), MIN_SECONDS) for step in steps}
+        self.total = sum(self.estimates.values())
+        self.workers = max(1, workers)
+        self.children = {step.index: [] for step in steps}
+        for step in steps:
+            for dep in step.after:
+                self.children[dep].append(step.index)
+        self.lock = threading.Lock()
+        self.started = {}
+        self.finished = set()
+
+    def start(self, step):
+        with self.lock:
+            self.started[step.index] = time.monotonic()
+
+    def done(self, step):
+        with self.lock:
+            self.started.pop(step.index, None)
+            self.finished.add(step.index)
+
+    def _left(self):
+        """Expected seconds left of every unfinished step."""
+        now = time.monotonic()
+        with self.lock:
+            left = {}
+            for index, seconds in self.estimates.items():
+                if index in self.finished:
+                    continue
+                started = self.started.get(index)
+                # A step running past its estimate is taken to be nearly done
+                left[index] = seconds if started is None else max(seconds - (now - started), MIN_SECONDS)
+        return left
+
+    def fraction(self):
+        if not self.total:
+            return 1.0
+        return 1.0 - sum(self._left().values()) / self.total
+
+    def seconds_left(self):
+        left = self._left()
+        if not left:
+            return 0.0
+        # Steps only wait for steps with lower indexes
+        path = {}
+        for index in sorted(left, reverse=True):
+            path[index] = left[index] + max((path[child] for child in self.children[index] if child in path),
+                                            default=0.0)
+        return max(max(path.values()), sum(left.values()) / self.workers)